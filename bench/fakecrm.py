@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Michael N. Gagnon
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+A stand-in for the crm binary, for benchmarks. Understands the programs that
+crm114.py generates: classify programs answer with canned output in the
+mock.classificationString format, learn programs touch the model file and
+output nothing, and learn on error programs answer with a classification and
+notLearnedMarker. Programs wrapped by crm114.loopProgram are answered one
+framed document at a time, so the stand-in also works with
+PersistentCrmRunner.
+
+Usage: fakecrm.py PROGRAM < data
+
+Environment variables:
+    FAKECRM_DELAY: seconds to sleep per document. Default: 0
+    FAKECRM_MODELS: the number of models to report in classify output.
+        Default: the number of models in PROGRAM
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crm114
+import mock
+
+import re
+import time
+import zlib
+
+classifyRe = re.compile(r"classify <[^>]*> \(([^)]*)\)")
+learnRe = re.compile(r"learn <[^>]*> \( (\S+) \)")
+
+def answer(program, document, delay, numModels):
+    """returns the output of program for document"""
+
+    if delay > 0:
+        time.sleep(delay)
+
+    output = ""
+    classify = classifyRe.search(program)
+    if classify:
+        models = classify.group(1).split()
+        if numModels != None:
+            models = (models + ["extra%d.css" % i for i in
+                xrange(numModels)])[:numModels]
+        # vary the pR scores from document to document, deterministically
+        seed = zlib.crc32(document)
+        output = mock.classificationString([mock.model(model,
+            pr = float((seed >> i) % 200 - 100), prob = 1.0 / len(models))
+            for i, model in enumerate(models)])
+        if crm114.learnedMarker in program:
+            output += "\n%s\n" % crm114.notLearnedMarker
+    else:
+        learn = learnRe.search(program)
+        if learn:
+            open(learn.group(1), "a").close()
+    return output
+
+def main():
+    program = sys.argv[-1]
+    delay = float(os.environ.get("FAKECRM_DELAY", 0))
+    numModels = os.environ.get("FAKECRM_MODELS")
+    if numModels != None:
+        numModels = int(numModels)
+
+    if crm114.documentDelimiter not in program:
+        sys.stdout.write(answer(program, sys.stdin.read(), delay, numModels))
+        return
+
+    terminator = crm114.documentDelimiter + "\n"
+    while True:
+        document = ""
+        while not document.endswith(terminator):
+            line = sys.stdin.readline()
+            if line == "":
+                return
+            document += line
+        sys.stdout.write(answer(program, document[:-len(terminator)], delay,
+            numModels) + "\n" + terminator)
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Michael N. Gagnon
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Micro-benchmark for normalize pipelines. Compares the compiled, fused
+pipelines from normalize.makeNormalizeFunction against calling each function
+in succession, on multi-megabyte documents. Prints the results as JSON.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import normalize
+
+import argparse
+import json
+import random
+import string
+import timeit
+
+def fixture(megabytes):
+    """returns a random document of mixed-case words and punctuation"""
+    random.seed(0)
+    alphabet = string.ascii_letters + string.punctuation + "     "
+    chunk = "".join(random.choice(alphabet) for i in xrange(1 << 16))
+    return chunk * (megabytes << 4)
+
+def reduced(functions):
+    """the uncompiled pipeline: calls each function in succession"""
+    functions = [getattr(normalize, f) for f in functions]
+    return lambda string: reduce(lambda string, f: f(string), functions,
+        string)
+
+def benchmark(megabytes = (1, 4), number = 5, repeat = 3):
+    """
+    returns a dict that maps each document size, in megabytes, to a dict that
+    maps each pipeline to the best time per document, in milliseconds, of the
+    uncompiled and compiled pipelines
+    """
+    pipelines = [p for p in normalize.pipelines if p != None] + [["lower",
+        "rmPunctuation", "startEnd"]]
+
+    results = {}
+    for size in megabytes:
+        document = fixture(size)
+        results[size] = {}
+        for pipeline in pipelines:
+            timings = {}
+            for name, f in [("reduce", reduced(pipeline)),
+                    ("compiled", normalize.makeNormalizeFunction(pipeline))]:
+                seconds = min(timeit.repeat(lambda: f(document),
+                    number = number, repeat = repeat))
+                timings[name] = seconds / number * 1e3
+            results[size][" ".join(pipeline)] = timings
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks the normalize " +
+        "pipelines")
+    parser.add_argument("--number", type=int, default=5,
+        help="documents per timing. Default: %(default)s")
+    parser.add_argument("--megabytes", type=int, nargs="+", default=[1, 4],
+        help="document sizes. Default: %(default)s")
+    args = parser.parse_args()
+
+    print json.dumps(benchmark(args.megabytes, args.number), indent = 4,
+        sort_keys = True)
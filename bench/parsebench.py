@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Michael N. Gagnon
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Micro-benchmark for parsing crm114's classify output into a Classification,
+on mock.classificationString fixtures with varying numbers of models. Prints
+the results as JSON.
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crm114
+import mock
+
+import argparse
+import json
+import timeit
+
+def fixture(numModels):
+    return mock.classificationString(
+        [mock.model("model%d.css" % i, features = 1000 + i, hits = 10 * i,
+            prob = 1.0 / numModels, pr = 100.0 - i) for i in range(numModels)],
+        totalFeatures = 2452)
+
+def benchmark(modelCounts = (2, 8, 32), number = 2000, repeat = 3):
+    """
+    returns a dict that maps each model count to a dict that holds the best
+    time per parse, in microseconds
+    """
+    results = {}
+    for numModels in modelCounts:
+        string = fixture(numModels)
+        seconds = min(timeit.repeat(lambda: crm114.Classification(string),
+            number = number, repeat = repeat))
+        results[numModels] = {"classification" : seconds / number * 1e6}
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks the parsers " +
+        "for crm114's classify output")
+    parser.add_argument("--number", type=int, default=2000,
+        help="parses per timing. Default: %(default)s")
+    args = parser.parse_args()
+
+    print json.dumps(benchmark(number = args.number), indent = 4,
+        sort_keys = True)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Michael N. Gagnon
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+Runs the benchmark suite against bench/fakecrm.py, a stand-in for the crm
+binary, and writes the results as JSON, so that they may be compared between
+commits. Measures:
+
+    spawn: the cost per document of CrmRunner.run, CrmRunner.runMany and
+        PersistentCrmRunner.run, and of the in-process osb.OsbRunner.run
+    parse: parsing classify output; see parsebench.py
+    normalize: each normalize pipeline; see normalizebench.py
+    corpus: corpus.accuracy, varyThreshold and partition, across corpus sizes
+
+Every timing is the best of several repetitions. Compare two result files
+with --compare OLD NEW.
+"""
+
+import os
+import sys
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchDir))
+sys.path.insert(0, benchDir)
+
+import corpus
+import crm114
+import mock
+import normalizebench
+import osb
+import parsebench
+
+import argparse
+import json
+import logging
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+
+def best(f, number, repeat = 3):
+    """returns the best time of f, in seconds per call"""
+    return min(timeit.repeat(f, number = number, repeat = repeat)) / number
+
+def fakeCrm(directory, delay = 0.0, numModels = None):
+    """
+    writes an executable that runs fakecrm.py with this python into
+    directory, and returns its path
+    """
+    path = os.path.join(directory, "crm")
+    with open(path, "w") as f:
+        f.write("#!/bin/sh\n")
+        if delay > 0:
+            f.write("FAKECRM_DELAY=%r; export FAKECRM_DELAY\n" % delay)
+        if numModels != None:
+            f.write("FAKECRM_MODELS=%d; export FAKECRM_MODELS\n" % numModels)
+        f.write("exec '%s' '%s' \"$@\"\n" % (sys.executable,
+            os.path.join(benchDir, "fakecrm.py")))
+    os.chmod(path, 0755)
+    return path
+
+def spawnBenchmark(documents = 100, number = 20):
+    """
+    returns a dict that maps each way of running crm to its time per
+    document, in milliseconds
+    """
+    directory = tempfile.mkdtemp(prefix = "crm114-bench-")
+    crmBinary = crm114.crmBinary
+    try:
+        crm114.crmBinary = fakeCrm(directory)
+        models = [os.path.join(directory, "a.css"), os.path.join(directory,
+            "b.css")]
+        crm = crm114.Crm114(models)
+        batch = ["document %d" % i for i in xrange(documents)]
+
+        runner = crm114.CrmRunner()
+        persistent = crm114.PersistentCrmRunner()
+        osbRunner = osb.OsbRunner()
+        osbCrm = crm.copy([os.path.join(directory, "a.osb"),
+            os.path.join(directory, "b.osb")])
+        osbCrm.crmRunner = osbRunner
+        osbCrm.learnMany([(batch[0], osbCrm.models[0]),
+            (batch[1], osbCrm.models[1])])
+        try:
+            results = {
+                "CrmRunner.run" : best(lambda: runner.run(batch[0],
+                    crm.classifyCommand), number),
+                "CrmRunner.runMany" : best(lambda: runner.runMany(batch,
+                    crm.classifyCommand), 1) / documents,
+                "PersistentCrmRunner.run" : best(lambda: [persistent.run(d,
+                    crm.classifyCommand) for d in batch], 1) / documents,
+                "OsbRunner.run" : best(lambda: [osbRunner.run(d,
+                    osbCrm.classifyCommand) for d in batch], 1) / documents,
+                }
+        finally:
+            persistent.close()
+            osbRunner.close()
+    finally:
+        crm114.crmBinary = crmBinary
+        shutil.rmtree(directory)
+
+    return dict((name, seconds * 1e3) for name, seconds in results.items())
+
+def classifiedItems(n):
+    """returns n classified LabeledItem objects, for two models"""
+    random.seed(0)
+    items = []
+    for i in xrange(n):
+        pr = random.uniform(-100, 100)
+        actual = "ham.css" if random.random() < pr / 200 + 0.5 else "spam.css"
+        items.append(corpus.LabeledItem(None, actual, mock.classification(
+            [mock.model("ham.css", pr = pr), mock.model("spam.css",
+            pr = -pr)])))
+    return items
+
+def corpusBenchmark(sizes = (1000, 10000, 100000)):
+    """
+    returns a dict that maps each corpus size to a dict that maps each
+    operation to its time, in milliseconds
+    """
+    crm = crm114.Crm114(["ham.css", "spam.css"])
+    results = {}
+    for n in sizes:
+        items = classifiedItems(n)
+        results[n] = {
+            "resultSet" : best(lambda: corpus.resultSet(crm.models, items), 1),
+            }
+        resultSet = corpus.resultSet(crm.models, items)
+        results[n].update({
+            "accuracy" : best(lambda: corpus.accuracy(crm, resultSet, None),
+                1),
+            "accuracy threshold" : best(lambda: corpus.accuracy(crm,
+                resultSet, 0.0), 1),
+            "varyThreshold" : best(lambda: corpus.varyThreshold(crm,
+                resultSet, 100), 1),
+            "roc" : best(lambda: corpus.roc(crm, resultSet), 1),
+            "partition" : best(lambda: corpus.partition(items, 10), 1),
+            "genCrossValidate" : best(lambda: [len(learn) for fold, learn,
+                classify in corpus.genCrossValidate(items, 10)], 1),
+            })
+        results[n] = dict((name, seconds * 1e3) for name, seconds in
+            results[n].items())
+    return results
+
+def revision():
+    """returns the current git commit, or None"""
+    with open(os.devnull, "w") as devnull:
+        try:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd = benchDir, stderr = devnull).strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+def benchmark(quick = False):
+    """runs every benchmark; quick runs smaller ones"""
+    return {
+        "meta" : {
+            "revision" : revision(),
+            "python" : sys.version.split()[0],
+            "time" : time.time(),
+            "quick" : quick,
+            },
+        "spawn" : spawnBenchmark(20 if quick else 100, 5 if quick else 20),
+        "parse" : parsebench.benchmark(number = 200 if quick else 2000),
+        "normalize" : normalizebench.benchmark((1,), 1 if quick else 5),
+        "corpus" : corpusBenchmark((1000, 10000) if quick else
+            (1000, 10000, 100000)),
+        }
+
+def flatten(results, prefix = ""):
+    """returns a dict that maps each "a/b/c" path in results to its value"""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, "%s%s/" % (prefix, key)))
+        elif isinstance(value, float) and key != "time":
+            flat[prefix + str(key)] = value
+    return flat
+
+def compare(old, new):
+    """
+    returns a dict that maps each timing in both old and new results to
+    new / old; above 1 is slower
+    """
+    old, new = flatten(old), flatten(new)
+    return dict((key, new[key] / old[key]) for key in new if key in old and
+        old[key] > 0)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Runs the benchmark suite " +
+        "against a stand-in crm binary, and outputs the results as JSON")
+    parser.add_argument("-o", "--output",
+        help="write the results to OUTPUT, rather than stdout")
+    parser.add_argument("--quick", action='store_true',
+        help="run smaller benchmarks")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+        help="rather than running the benchmarks, output the ratio NEW / OLD " +
+             "of each timing in two result files")
+    args = parser.parse_args()
+
+    if args.compare != None:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        result = compare(old, new)
+    else:
+        result = benchmark(args.quick)
+
+    output = json.dumps(result, indent = 4, sort_keys = True)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
@@ -13,9 +13,6 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
-#
-# TODO: iterate over classifiers, output ROC data
-# TODO: map/reduce learning via cssmerge and multiprocess module
 
 """
 Tests and/or train crm114 against a labeled corpus. For each model, X, computes
@@ -34,11 +31,23 @@ import crm114
 import normalize
 
 import argparse
+import array
+import bisect
+import collections
+import contextlib
+import cPickle
+import hashlib
+import itertools
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
 import random
+import shutil
 import sys
+import tempfile
 
 
 class LabeledItem:
@@ -51,24 +60,367 @@ class LabeledItem:
         self.classification = classification
 
 def limitItems(items, limit):
+    """
+    items is any iterable. If limit != None, then returns a list of limit
+    items, chosen uniformly at random by reservoir sampling and in random
+    order, so only limit items are ever held in memory.
+    """
     if limit != None:
-        items = items[:]
-        random.shuffle(items)
-        items = items[:limit]
+        reservoir = []
+        for i, item in enumerate(items):
+            if i < limit:
+                reservoir.append(item)
+            else:
+                j = random.randint(0, i)
+                if j < limit:
+                    reservoir[j] = item
+        random.shuffle(reservoir)
+        items = reservoir
     return items
 
+def genLineitems(path, model, limit = None):
+    """
+    like lineitems, but yields the LabeledItem objects. If limit == None, then
+    streams the lines from path, one at a time.
+    """
+
+    with open(path, "r") as f:
+        for line in limitItems(f, limit):
+            yield LabeledItem(line, model)
+
 def lineitems(path, model, limit = None):
     """
     creates a list of LabeledItem objects, by reading one data item per line
     from path.
     """
+    return list(genLineitems(path, model, limit))
 
-    with open(path, "r") as f:
-        lines = f.readlines()
+def normalizeWorker(crm, logger, task):
+    functions, documents = task
+    f = normalize.makeNormalizeFunction(functions)
+    return [f(document) for document in documents]
 
-    lines = limitItems(lines, limit)
+# the number of documents in each normalizeWorker task
+normalizeChunkSize = 1000
 
-    return [LabeledItem(line, model) for line in lines]
+def normalizeDocuments(documents, functions, workers = None):
+    """
+    returns the list of documents, which may be any iterable (e.g. a file),
+    each normalized by functions, a list of normalize function names. The
+    documents are read as they are normalized. If workers > 1, then chunks of
+    the documents are normalized by that many worker processes.
+    """
+    if workers == None or workers <= 1:
+        return normalizeWorker(None, None, (functions, documents))
+
+    normalized = []
+    for chunk in genMap(normalizeWorker, None, None, ((functions, chunk) for
+            chunk in chunks(documents, normalizeChunkSize)), workers):
+        normalized += chunk
+    return normalized
+
+def fileDigest(path):
+    """returns the hex sha1 digest of path's contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def normalizedLines(path, functions, cacheDir = None, workers = None,
+        metrics = None):
+    """
+    returns the list of lines of path, each normalized by functions, a list of
+    normalize function names, with normalizeDocuments. If cacheDir != None,
+    then the normalized lines are cached in cacheDir, keyed by the checksum of
+    path's contents and by the normalize.pipelineKey of functions; functions
+    without a pipelineKey (e.g. lambdas) are not cached. If metrics != None,
+    then normalizing (but not loading from the cache) is timed as the
+    "normalize" phase.
+    """
+
+    pipeline = normalize.pipelineKey(normalize.makeNormalizeFunction(
+        functions))
+    cachePath = None
+    if cacheDir != None and pipeline != None:
+        cachePath = os.path.join(cacheDir, "%s-%s.pickle" % (fileDigest(path),
+            hashlib.sha1(repr(pipeline)).hexdigest()))
+        if os.path.exists(cachePath):
+            with open(cachePath, "rb") as f:
+                return cPickle.load(f)
+
+    with timed(metrics, "normalize"), open(path, "r") as f:
+        lines = normalizeDocuments(f, functions, workers)
+
+    if cachePath != None:
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+        fd, tempPath = tempfile.mkstemp(dir = cacheDir, prefix = ".normalized-")
+        with os.fdopen(fd, "wb") as f:
+            cPickle.dump(lines, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tempPath, cachePath)
+
+    return lines
+
+def normalizedLineitems(path, model, functions, limit = None, cacheDir = None,
+        workers = None, metrics = None):
+    """
+    like lineitems, except each item's data is normalized once and marked as a
+    normalize.NormalizedText so that a Crm114 with the same normalize
+    functions does not normalize it again. If limit != None, then only the
+    sampled lines are normalized, and cacheDir is not used; otherwise all of
+    path's lines are normalized by normalizedLines. Either way, normalizing
+    is timed in metrics, if not None.
+    """
+    if limit == None:
+        lines = normalizedLines(path, functions, cacheDir, workers, metrics)
+    else:
+        with open(path, "r") as f:
+            sample = limitItems(f, limit)
+        with timed(metrics, "normalize"):
+            lines = normalizeDocuments(sample, functions, workers)
+    pipeline = normalize.pipelineKey(normalize.makeNormalizeFunction(
+        functions))
+    return [LabeledItem(normalize.NormalizedText(line, pipeline), model) for
+        line in lines]
+
+class LineCorpus:
+    """
+    an iterable over the LabeledItem objects for every line of every path,
+    where the lines of paths[i] are labeled models[i]. Reads the files again
+    each time it is iterated over, so it never holds the corpus in memory.
+    """
+
+    def __init__(self, paths, models):
+        self.paths = paths
+        self.models = models
+
+    def __iter__(self):
+        for path, model in zip(self.paths, self.models):
+            for item in genLineitems(path, model):
+                yield item
+
+class MappedItem(object):
+    """
+    like LabeledItem, except its data is the line of path at offset, which is
+    read from a memory map of path only when it is needed. line is the item's
+    position in its MappedCorpus.
+    """
+
+    __slots__ = ("path", "offset", "length", "line", "actualModel",
+        "classification")
+
+    def __init__(self, path, offset, length, line, actualModel,
+            classification = None):
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.line = line
+        self.actualModel = actualModel
+        self.classification = classification
+
+    @property
+    def data(self):
+        return mappedFile(self.path)[self.offset : self.offset + self.length]
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+# the memory maps and line indexes that this process has opened, by path
+mappedFiles = {}
+lineIndexes = {}
+
+def mappedFile(path):
+    """returns a read-only memory map of path, which is opened once per path"""
+    if path not in mappedFiles:
+        with open(path, "rb") as f:
+            mappedFiles[path] = mmap.mmap(f.fileno(), 0,
+                access = mmap.ACCESS_READ)
+    return mappedFiles[path]
+
+def indexPath(path):
+    """returns the filename of the sidecar file that holds path's line index"""
+    return path + ".idx"
+
+def indexHeader(path):
+    """identifies the version of path that an index was built for"""
+    stat = os.stat(path)
+    return "crmpy-index %d %d %r\n" % (array.array('l').itemsize,
+        stat.st_size, stat.st_mtime)
+
+# the number of bytes that buildLineIndex reads at a time
+indexChunkSize = 1 << 20
+
+def buildLineIndex(path):
+    """
+    returns an array of the offsets of each line in path, followed by the size
+    of path, so line i is at offsets[i] : offsets[i + 1]
+    """
+    offsets = array.array('l', [0])
+    append = offsets.append
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(indexChunkSize), ""):
+            # split() finds the newlines in C; only the sums are in Python
+            lines = chunk.split("\n")
+            lines.pop()
+            position = size
+            for line in lines:
+                position += len(line) + 1
+                append(position)
+            size += len(chunk)
+    if offsets[-1] != size:
+        # the last line has no newline
+        offsets.append(size)
+    return offsets
+
+def lineIndex(path):
+    """
+    returns the line index of path, as built by buildLineIndex. Loads it from
+    the sidecar file indexPath(path) if that was built for the current version
+    of path; otherwise builds it and saves it there, if possible.
+    """
+    if path in lineIndexes:
+        return lineIndexes[path]
+
+    header = indexHeader(path)
+    offsets = None
+    try:
+        with open(indexPath(path), "rb") as f:
+            if f.readline() == header:
+                offsets = array.array('l')
+                offsets.fromstring(f.read())
+    except IOError:
+        pass
+
+    if offsets == None:
+        offsets = buildLineIndex(path)
+        try:
+            fd, tempPath = tempfile.mkstemp(dir = os.path.dirname(
+                os.path.abspath(path)), prefix = ".crmpy-index-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(header)
+                offsets.tofile(f)
+            os.rename(tempPath, indexPath(path))
+        except (IOError, OSError):
+            # e.g. the directory is read-only; just keep the index in memory
+            pass
+
+    lineIndexes[path] = offsets
+    return offsets
+
+class MappedCorpus(object):
+    """
+    a sequence of MappedItem objects, one for each line of each path, where
+    the lines of paths[i] are labeled models[i]. Only holds the line indexes
+    and an array of line numbers in memory; items are built as they are
+    accessed, so setting an item's classification does not persist.
+
+    Supports len, indexing, slicing, concatenation and assignment of items,
+    so it may be shuffled, partitioned and cross validated like a list. Slices
+    and concatenations are new MappedCorpus objects that share the indexes.
+    When pickled, only the line numbers are kept; the indexes are reloaded by
+    lineIndex.
+    """
+
+    def __init__(self, paths, models, lines = None):
+        self.paths = paths
+        self.models = models
+        self.load()
+        if lines == None:
+            lines = array.array('l', xrange(self.starts[-1]))
+        self.lines = lines
+
+    def load(self):
+        self.offsets = [lineIndex(path) for path in self.paths]
+        # starts[i] is the line number of the first line of paths[i]
+        self.starts = [0]
+        for offsets in self.offsets:
+            self.starts.append(self.starts[-1] + len(offsets) - 1)
+
+    def __getstate__(self):
+        return (self.paths, self.models, self.lines)
+
+    def __setstate__(self, state):
+        self.paths, self.models, self.lines = state
+        self.load()
+
+    def item(self, line):
+        """returns the MappedItem for line number line"""
+        i = bisect.bisect_right(self.starts, line) - 1
+        offset = self.offsets[i][line - self.starts[i]]
+        length = self.offsets[i][line - self.starts[i] + 1] - offset
+        return MappedItem(self.paths[i], offset, length, line, self.models[i])
+
+    def view(self, lines):
+        """returns a MappedCorpus like this one, over lines"""
+        corpus = MappedCorpus.__new__(MappedCorpus)
+        corpus.paths = self.paths
+        corpus.models = self.models
+        corpus.offsets = self.offsets
+        corpus.starts = self.starts
+        corpus.lines = lines
+        return corpus
+
+    def relabel(self, names):
+        """
+        returns a MappedCorpus like this one, whose models are renamed
+        according to the dict names
+        """
+        corpus = self.view(self.lines)
+        corpus.models = [names[model] for model in self.models]
+        return corpus
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.view(self.lines[index])
+        return self.item(self.lines[index])
+
+    def __getslice__(self, start, end):
+        return self.view(self.lines[start:end])
+
+    def __setitem__(self, index, item):
+        self.lines[index] = item.line
+
+    def __add__(self, that):
+        if that.paths != self.paths or that.models != self.models:
+            raise ValueError("can only concatenate views of the same corpus")
+        return self.view(self.lines + that.lines)
+
+    def __iter__(self):
+        for line in self.lines:
+            yield self.item(line)
+
+def shuffle(items):
+    """
+    shuffles the list items in place, like random.shuffle. A MappedCorpus
+    shuffles its array of line numbers, without building its items.
+    """
+    if isinstance(items, MappedCorpus):
+        random.shuffle(items.lines)
+    else:
+        random.shuffle(items)
+
+def mappedCorpus(paths, models, limit = None):
+    """
+    returns a MappedCorpus over the lines of paths, where the lines of paths[i]
+    are labeled models[i]. If limit != None, then keeps a random sample of
+    limit lines of each path, like lineitems.
+    """
+    corpus = MappedCorpus(paths, models)
+    if limit != None:
+        lines = array.array('l')
+        for start, end in zip(corpus.starts, corpus.starts[1:]):
+            lines.extend(limitItems(xrange(start, end), limit))
+        corpus.lines = lines
+    return corpus
 
 class Accuracy:
 
@@ -89,6 +441,79 @@ class Accuracy:
     def __ne__(self, that):
         return not self.__eq__(that)
 
+nan = float("nan")
+
+class ResultSet:
+    """
+    Compact, columnar storage for the classifications of many items. Rather
+    than one Classification object per item, holds one typed array per field:
+
+    models: the model names; the other columns refer to models by index
+    actual: the index of each item's actual model
+    bestMatch: the index of each item's best match, according to CRM114
+    pr, prob, features: for each model, a column of that model's values. A
+        missing value is NaN.
+    hits: for each model, a column of that model's hits. A missing value is -1.
+
+    accuracy, minMaxPr and varyThreshold accept a ResultSet in place of a list
+    of items. A ResultSet is never post-processed in place, so a threshold of
+    None always means CRM114's own best match.
+    """
+
+    def __init__(self, models):
+        self.models = list(models)
+        self.index = dict((model, i) for i, model in enumerate(self.models))
+        self.actual = array.array('i')
+        self.bestMatch = array.array('i')
+        self.pr = [array.array('d') for model in self.models]
+        self.prob = [array.array('d') for model in self.models]
+        self.features = [array.array('d') for model in self.models]
+        self.hits = [array.array('l') for model in self.models]
+
+    def __len__(self):
+        return len(self.actual)
+
+    def add(self, actualModel, classification):
+        self.actual.append(self.index[actualModel])
+        self.bestMatch.append(self.index[classification.bestMatch.model])
+        for i, model in enumerate(self.models):
+            modelMatch = classification.model[model]
+            self.pr[i].append(modelMatch.pr)
+            self.prob[i].append(nan if modelMatch.prob == None else
+                modelMatch.prob)
+            self.features[i].append(nan if modelMatch.features == None else
+                modelMatch.features)
+            self.hits[i].append(-1 if modelMatch.hits == None else
+                modelMatch.hits)
+
+    def extend(self, that):
+        """appends the results in that, a ResultSet for the same models"""
+        if that.models != self.models:
+            raise ValueError("results are for models %s, not %s" %
+                (that.models, self.models))
+        self.actual.extend(that.actual)
+        self.bestMatch.extend(that.bestMatch)
+        for i in xrange(len(self.models)):
+            self.pr[i].extend(that.pr[i])
+            self.prob[i].extend(that.prob[i])
+            self.features[i].extend(that.features[i])
+            self.hits[i].extend(that.hits[i])
+
+    def rename(self, models):
+        """renames the models to models, which are in the same order"""
+        self.models = list(models)
+        self.index = dict((model, i) for i, model in enumerate(self.models))
+
+def resultSet(models, items):
+    """
+    returns a ResultSet that holds the classifications of items, a list of
+    classified LabeledItem objects
+    """
+    results = ResultSet(models)
+    for item in items:
+        results.add(item.actualModel, item.classification)
+    return results
+
 def toJson(obj):
     """
     useful for converting structs containing accuracy objects
@@ -96,6 +521,15 @@ def toJson(obj):
     return json.dumps(obj, indent = 4, sort_keys = True,
         default = lambda x: x.__dict__ )
 
+@contextlib.contextmanager
+def timed(metrics, phase):
+    """times the body of a with statement as phase, if metrics != None"""
+    if metrics == None:
+        yield
+    else:
+        with metrics.timer(phase):
+            yield
+
 def delmodels(models):
     """
     deletes models if they exist
@@ -104,124 +538,718 @@ def delmodels(models):
         if os.path.exists(model):
             os.remove(model)
 
+# the number of items that learn and classifyStream hold in memory at once
+streamChunkSize = 10000
+
 def learn(crm, learnItems, logger, logHeader = ""):
     """
-    learnItems is a list of LabeledItem objects
-    runs crm.learn on each item in learnItems
+    learnItems is a list, or any iterable, of LabeledItem objects
+    learns every item with crm.learnMany, which uses one crm114 process per
+    model
     """
 
-    for i, item in enumerate(learnItems):
-        crm.learn(item.data, item.actualModel)
-        logger.debug("%slearned %d/%d, %s", logHeader, i + 1, len(learnItems),
-            item.actualModel)
+    total = len(learnItems) if hasattr(learnItems, "__len__") else "?"
+    i = 0
+    for chunk in chunks(learnItems, streamChunkSize):
+        learned = crm.learnMany((item.data, item.actualModel) for item in
+            chunk)
+        for item, wasLearned in zip(chunk, learned):
+            i += 1
+            logger.debug("%slearned %d/%s, %s%s", logHeader, i, total,
+                item.actualModel, "" if wasLearned else
+                " (already classified correctly)")
+
+# the Crm114 and logger objects used by a worker process
+workerCrm = None
+workerLogger = None
+
+def initWorker(crm, logger):
+    global workerCrm, workerLogger
+    workerCrm = crm
+    workerLogger = logger
+
+def callWorker(args):
+    """
+    returns (result, metrics), where metrics is what the worker's crm.metrics
+    recorded during the call, if any, so that the parent can merge it
+    """
+    function, task = args
+    metrics = getattr(workerCrm, "metrics", None)
+    if metrics == None:
+        return (function(workerCrm, workerLogger, task), None)
+    metrics.reset()
+    result = function(workerCrm, workerLogger, task)
+    return (result, metrics.dict())
+
+def genMap(function, crm, logger, tasks, workers):
+    """
+    yields function(crm, logger, task) for each task in tasks, in order.
+    if workers > 1, then the calls run in a pool of that many worker processes.
+    function must be a module-level function, and each task must be picklable.
+    crm and logger are passed to the workers when they fork, so they need not
+    be picklable. What the workers record in crm.metrics is merged into
+    crm.metrics.
+    tasks may be any iterable; at most 2 * workers tasks are read ahead of the
+    results, so a lazy iterable is never held in memory.
+    """
+
+    if workers == None or workers <= 1:
+        for task in tasks:
+            yield function(crm, logger, task)
+        return
+
+    def finish(asyncResult):
+        result, metrics = asyncResult.get()
+        if metrics != None:
+            crm.metrics.merge(metrics)
+        return result
+
+    pool = multiprocessing.Pool(workers, initWorker, (crm, logger))
+    try:
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(callWorker, ((function, task),)))
+            if len(pending) >= 2 * workers:
+                yield finish(pending.popleft())
+        while len(pending) > 0:
+            yield finish(pending.popleft())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def classifyWorker(crm, logger, documents):
+    return crm.classifyMany(documents)
+
+def chunks(items, size):
+    """
+    yields successive size-length lists of the items in items, which may be
+    any iterable
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def genClassifications(crm, classifyItems, workers):
+    """
+    yields the Classification for each item in classifyItems, in order.
+    if workers > 1, then the items are classified by a pool of workers
+    processes.
+    """
 
-def classify(crm, classifyItems, logger, logHeader = ""):
+    if workers == None or workers <= 1:
+        for classification in crm.classifyMany(item.data for item in
+                classifyItems):
+            yield classification
+        return
+
+    # several chunks per worker, so that workers finish at about the same time
+    size = max(1, len(classifyItems) / (workers * 4))
+    documents = [item.data for item in classifyItems]
+
+    for classifications in genMap(classifyWorker, crm, None,
+            chunks(documents, size), workers):
+        for classification in classifications:
+            yield classification
+
+def logClassification(logger, logHeader, i, total, item, classification):
+    """logs the classification of item, the i-th of total items"""
+    classifiedAs = classification.bestMatch.model
+    if item.actualModel == classifiedAs:
+        logger.debug("%sclassified %d/%s, correctly classified %s", logHeader,
+            i, total, item.actualModel)
+    else:
+        logger.debug("%sclassified %d/%s, misclassified %s as %s", logHeader,
+            i, total, item.actualModel, classifiedAs)
+
+def classify(crm, classifyItems, logger, logHeader = "", workers = None,
+        results = None):
     """
     classifyItems is a list of LabeledItem objects
-    runs crm.classify on each item in learnItems; sets item.classification
-    returns items that were classified, which is classifyItems
+    classifies every item with crm.classifyMany; sets item.classification
+    if results != None, then rather than setting item.classification, adds
+    each classification to the ResultSet results as it comes back, so that it
+    may be freed
+    if workers > 1, then spreads the items over that many worker processes
+    returns items that were classified, which is classifyItems, or results
     """
 
-    for i, item in enumerate(classifyItems):
-        item.classification = crm.classify(item.data)
-        classifiedAs = item.classification.bestMatch.model
-        if item.actualModel == classifiedAs:
-            logger.debug("%sclassified %d/%d, correctly classified %s", logHeader,
-                i + 1, len(classifyItems), item.actualModel)
+    classifications = genClassifications(crm, classifyItems, workers)
+
+    for i, (item, classification) in enumerate(itertools.izip(classifyItems,
+            classifications)):
+        if results == None:
+            item.classification = classification
         else:
-            logger.debug("%sclassified %d/%d, misclassified %s as %s", logHeader,
-                i + 1, len(classifyItems), item.actualModel,
-                item.classification.bestMatch.model)
-    return classifyItems
+            results.add(item.actualModel, classification)
+        logClassification(logger, logHeader, i + 1, len(classifyItems), item,
+            classification)
+    return classifyItems if results == None else results
 
+def classifyStream(crm, classifyItems, logger, logHeader = "", workers = None):
+    """
+    like classify, except classifyItems may be any iterable of LabeledItem
+    objects, e.g. a LineCorpus, and their classifications are stored in a
+    ResultSet. Classifies the items in chunks, which are spread over a single
+    pool of workers if workers > 1, so only about streamChunkSize items are
+    held in memory at once.
+    returns the ResultSet
+    """
 
-def learnClassify(crm, learnItems, classifyItems, logger, logHeader = ""):
+    if workers == None or workers <= 1:
+        size = streamChunkSize
+    else:
+        # genMap reads 2 * workers chunks ahead
+        size = max(1, streamChunkSize / (2 * workers))
+
+    # the chunks whose documents genMap has read, but whose classifications
+    # have not come back yet
+    pending = collections.deque()
+    def tasks():
+        for chunk in chunks(classifyItems, size):
+            pending.append(chunk)
+            yield [item.data for item in chunk]
+
+    total = len(classifyItems) if hasattr(classifyItems, "__len__") else "?"
+    results = ResultSet(crm.models)
+    for classifications in genMap(classifyWorker, crm, None, tasks(),
+            workers):
+        for item, classification in zip(pending.popleft(), classifications):
+            results.add(item.actualModel, classification)
+            logClassification(logger, logHeader, len(results), total, item,
+                classification)
+    return results
+
+def learnClassify(crm, learnItems, classifyItems, logger, logHeader = "",
+        workers = None, results = None):
     """
     learnItems and classifyItems are a lists of LabeledItem objects
     learns and classified the items, setting item.classification for each item
-    in classifyItems
-    returns items that were classified, which is classifyItems
+    in classifyItems, or adding it to results; see classify
+    returns items that were classified, which is classifyItems, or results
     """
 
     delmodels(crm.models)
     learn(crm, learnItems, logger, logHeader)
-    return classify(crm, classifyItems, logger, logHeader)
+    return classify(crm, classifyItems, logger, logHeader, workers, results)
+
+def foldBounds(n, folds):
+    """
+    divides range(n) into approximately equal folds; the first n % folds folds
+    get one more item than the rest.
+    returns a list of (start, end) pairs, one per fold
+    """
+    small_fold_size = n / folds
+    num_big_folds = n % folds
+
+    bounds = []
+    start = 0
+    for i in xrange(0, folds):
+        end = start + small_fold_size + (1 if i < num_big_folds else 0)
+        bounds.append((start, end))
+        start = end
+
+    assert(start == n)
+
+    return bounds
 
 def partition(items, folds):
     """
     items is a list; divide items into approximately equal folds
     """
-    small_fold_size = len(items) / folds
-    big_fold_size = small_fold_size + 1
+    return [items[start : end] for start, end in foldBounds(len(items), folds)]
 
-    num_big_folds = len(items) % folds
-    num_small_folds = folds - num_big_folds
+class ItemView(object):
+    """
+    a read-only view of the items in items whose indexes fall in ranges, a
+    list of (start, end) pairs, in order. Lets each fold of a cross validation
+    refer to the items without copying them. Compares equal to a list of the
+    same items.
+
+    If names != None, then the view holds relabeled copies of the items,
+    whose actualModel is renamed according to the dict names; see relabel.
+    Each copy is made only when it is accessed.
+    """
 
-    result = []
-    for i in xrange(0, num_big_folds):
-        subresult = items[0 : big_fold_size]
-        result.append(subresult)
-        items = items[big_fold_size:]
-    for i in xrange(0, num_small_folds):
-        subresult = items[0 : small_fold_size]
-        result.append(subresult)
-        items = items[small_fold_size:]
+    def __init__(self, items, ranges, names = None):
+        self.items = items
+        self.ranges = ranges
+        self.names = names
+
+    def item(self, i):
+        """returns the view of self.items[i]"""
+        item = self.items[i]
+        if self.names == None:
+            return item
+        return LabeledItem(item.data, self.names[item.actualModel])
+
+    def __len__(self):
+        return sum(end - start for start, end in self.ranges)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        for start, end in self.ranges:
+            if index < end - start:
+                return self.item(start + index)
+            index -= end - start
+        raise IndexError("ItemView index out of range")
+
+    def __iter__(self):
+        for start, end in self.ranges:
+            for i in xrange(start, end):
+                yield self.item(i)
 
-    assert(len(items) == 0)
+    def __eq__(self, that):
+        return list(self) == list(that)
 
-    return result
+    def __ne__(self, that):
+        return not self.__eq__(that)
+
+    def __repr__(self):
+        return repr(list(self))
 
 def genCrossValidate(items, folds):
     """
-    generates a series of (learnItems, classifyItems) pairs
+    generates a series of (fold, learnItems, classifyItems) tuples, where
+    learnItems and classifyItems are ItemViews of items
     """
 
-    parts = partition(items, folds)
+    bounds = foldBounds(len(items), folds)
 
-    for fold in xrange(0, folds):
-        learnParts = parts[:]
-        del(learnParts[fold])
-        learn = [item for part in learnParts for item in part]
-        classify = parts[fold]
+    for fold, (start, end) in enumerate(bounds):
+        learn = ItemView(items, [(0, start), (end, len(items))])
+        classify = ItemView(items, [(start, end)])
         yield (fold + 1, learn, classify)
 
-def crossValidate(crm, items, folds, logger):
+def reorder(items, order):
+    """
+    returns the items of items, in the order of the indexes in order. A
+    MappedCorpus stays a MappedCorpus.
+    """
+    if isinstance(items, MappedCorpus):
+        return items.view(array.array('l', (items.lines[i] for i in order)))
+    return [items[i] for i in order]
+
+def stratify(items, folds):
+    """
+    returns the items of items, reordered so that when they are divided by
+    foldBounds, each fold holds (about) the same proportion of each model's
+    items. Within each model, items keep their relative order.
+    """
+    byModel = collections.OrderedDict()
+    for i, item in enumerate(items):
+        byModel.setdefault(item.actualModel, []).append(i)
+
+    # deal the items, grouped by model, round robin into the folds
+    foldIndexes = [[] for fold in xrange(folds)]
+    dealt = 0
+    for indexes in byModel.values():
+        for i in indexes:
+            foldIndexes[dealt % folds].append(i)
+            dealt += 1
+
+    return reorder(items, [i for indexes in foldIndexes for i in indexes])
+
+def renameModels(classification, names):
+    """
+    renames the models in classification, according to the dict names, which
+    maps old model names to new model names
+    """
+    for modelMatch in classification.model.values():
+        modelMatch.model = names[modelMatch.model]
+    classification.model = dict((modelMatch.model, modelMatch) for modelMatch
+        in classification.model.values())
+
+def crmInDir(crm, modelDir):
+    """
+    returns a copy of crm whose models are in modelDir. If crm's runner holds
+    processes or open models (i.e. it has copy()), then the copy gets a fresh
+    runner of its own; release it with closeCopy.
+    """
+    crmRunner = None
+    if hasattr(crm.crmRunner, "copy"):
+        crmRunner = crm.crmRunner.copy()
+    # prefix with the model's index, in case basenames collide
+    return crm.copy([os.path.join(modelDir, "%d-%s" % (i,
+        os.path.basename(model))) for i, model in enumerate(crm.models)],
+        crmRunner)
+
+def closeCopy(crm, copy):
+    """closes copy's runner, if crmInDir gave it one of its own"""
+    if copy.crmRunner is not crm.crmRunner:
+        copy.crmRunner.close()
+
+def relabel(items, paths):
+    """
+    returns copies of items, whose actualModel is renamed according to the dict
+    paths. A MappedCorpus is relabeled without reading its items, and an
+    ItemView only copies the items in its ranges, as they are accessed.
+    """
+    if isinstance(items, MappedCorpus):
+        return items.relabel(paths)
+    if isinstance(items, ItemView):
+        if isinstance(items.items, MappedCorpus):
+            return ItemView(items.items.relabel(paths), items.ranges,
+                items.names)
+        if items.names != None:
+            paths = dict((model, paths[name]) for model, name in
+                items.names.iteritems())
+        return ItemView(items.items, items.ranges, paths)
+    return [LabeledItem(item.data, paths[item.actualModel]) for item in items]
+
+def foldResults(crm, foldCrm, classifyItems, results):
+    """
+    returns the classifications of classifyItems by foldCrm, a copy of crm
+    made by crmInDir, with the models renamed to crm.models: results, if it is
+    a ResultSet, and otherwise the list of Classifications
+    """
+    if results != None:
+        results.rename(crm.models)
+        return results
+
+    names = dict(zip(foldCrm.models, crm.models))
+    for item in classifyItems:
+        renameModels(item.classification, names)
+    return [item.classification for item in classifyItems]
+
+def validateFold(crm, logger, task):
+    """
+    task is a (fold, folds, learnItems, classifyItems, columnar) tuple, where
+    the first four are as generated by genCrossValidate. Learns and classifies
+    the items using a copy of crm whose models are in a fresh temporary
+    directory, so that folds may run concurrently.
+    returns the classifications of classifyItems, which refer to the models by
+    the names in crm.models: a ResultSet if columnar, and otherwise a list of
+    Classifications
+    """
+
+    fold, folds, learnItems, classifyItems, columnar = task
+    logger.info("beginning fold %d", fold)
+    logHeader = "fold %d/%d, " % (fold, folds)
+
+    modelDir = tempfile.mkdtemp(prefix = "crm114-fold%d-" % fold)
+    foldCrm = crmInDir(crm, modelDir)
+    try:
+        paths = dict(zip(crm.models, foldCrm.models))
+        learnItems = relabel(learnItems, paths)
+        classifyItems = list(relabel(classifyItems, paths))
+        results = ResultSet(foldCrm.models) if columnar else None
+        learnClassify(foldCrm, learnItems, classifyItems, logger, logHeader,
+            results = results)
+    finally:
+        closeCopy(crm, foldCrm)
+        shutil.rmtree(modelDir)
+
+    return foldResults(crm, foldCrm, classifyItems, results)
+
+def learnShard(crm, logger, task):
+    """
+    task is a (shard, modelDir, learnItems) tuple. Learns the items into a copy
+    of crm whose models are in modelDir.
+    returns the shard's model filenames, in the same order as crm.models
+    """
+
+    shard, modelDir, learnItems = task
+    logger.info("learning shard %d", shard)
+
+    shardCrm = crmInDir(crm, modelDir)
+    try:
+        learn(shardCrm, relabel(learnItems, dict(zip(crm.models,
+            shardCrm.models))), logger, "shard %d, " % shard)
+    finally:
+        closeCopy(crm, shardCrm)
+    return shardCrm.models
+
+def mergeShards(crm, shardModels):
+    """
+    shardModels is a list that holds, for each shard, the shard's model
+    filenames, in the same order as crm.models. Merges the shards into
+    crm.models with crm.merge, which runs cssmerge with crm's runner.
+    A shard that never learned an item of some model lacks that model's file,
+    so it is skipped for that model.
+    """
+    for i, model in enumerate(crm.models):
+        sources = [shard[i] for shard in shardModels if os.path.exists(shard[i])]
+        if len(sources) > 0:
+            crm.merge(model, sources)
+
+def learnSharded(crm, learnItems, logger, workers, logHeader = ""):
+    """
+    learns learnItems into fresh models, like learn, but map/reduce style: the
+    items are split into one shard per worker, each worker process learns its
+    shard into private models, and the shards are then merged into crm.models
+    with cssmerge.
+    Falls back to learn if workers <= 1 or crm.trainOnError, since then what a
+    shard learns would depend on the other shards.
+    learnItems may be any iterable; unless it is a list or a MappedCorpus, it
+    is read into a list to be sharded.
+    """
+
+    delmodels(crm.models)
+
+    if workers == None or workers <= 1 or crm.trainOnError:
+        learn(crm, learnItems, logger, logHeader)
+        return
+
+    if not isinstance(learnItems, (list, MappedCorpus)):
+        learnItems = list(learnItems)
+
+    shardDir = tempfile.mkdtemp(prefix = "crm114-shards-")
+    try:
+        tasks = [(shard + 1, os.path.join(shardDir, str(shard + 1)), part)
+            for shard, part in enumerate(partition(learnItems, workers))]
+        for task in tasks:
+            os.mkdir(task[1])
+        shardModels = list(genMap(learnShard, crm, logger, tasks, workers))
+        logger.info("%smerging %d shards", logHeader, len(shardModels))
+        mergeShards(crm, shardModels)
+    finally:
+        shutil.rmtree(shardDir)
+
+def validateMergedFold(crm, logger, task):
+    """
+    task is a (fold, folds, shardModels, classifyItems, columnar) tuple, where
+    shardModels holds the model filenames of every other fold. Like
+    validateFold, except the fold's models are merged from the other folds'
+    shards, rather than learned.
+    """
+
+    fold, folds, shardModels, classifyItems, columnar = task
+    logger.info("beginning fold %d", fold)
+    logHeader = "fold %d/%d, " % (fold, folds)
+
+    modelDir = tempfile.mkdtemp(prefix = "crm114-fold%d-" % fold)
+    foldCrm = crmInDir(crm, modelDir)
+    try:
+        mergeShards(foldCrm, shardModels)
+        classifyItems = list(relabel(classifyItems, dict(zip(crm.models,
+            foldCrm.models))))
+        results = ResultSet(foldCrm.models) if columnar else None
+        classify(foldCrm, classifyItems, logger, logHeader, results = results)
+    finally:
+        closeCopy(crm, foldCrm)
+        shutil.rmtree(modelDir)
+
+    return foldResults(crm, foldCrm, classifyItems, results)
+
+def addFoldResults(tasks, foldResults, results):
+    """
+    foldResults holds the classifications returned for each of tasks, by
+    validateFold or validateMergedFold. Adds them to the ResultSet results, or
+    if results == None, sets item.classification for each classified item.
+    returns results, or the items that were classified
+    """
+    if results != None:
+        for fold in foldResults:
+            results.extend(fold)
+        return results
+
+    classified = []
+    for task, classifications in itertools.izip(tasks, foldResults):
+        for item, classification in zip(task[3], classifications):
+            item.classification = classification
+            classified.append(item)
+    return classified
+
+def crossValidate(crm, items, folds, logger, workers = None,
+        stratified = False, results = None):
     """
     classififies every item using N-fold cross validation.
-    returns items that were classified, which is all items
+    if workers > 1, then that many folds run at once, each in its own process.
+    if stratified, then each fold holds the same proportion of each model's
+    items.
+    if results != None, then adds the classifications to the ResultSet results
+    as each fold finishes, rather than setting item.classification, and
+    returns results. Otherwise returns items that were classified, which is
+    all items
     """
     logger.info("crossValidate, folds = %d", folds)
 
     items = items[:]
-    random.shuffle(items)
+    shuffle(items)
+    if stratified:
+        items = stratify(items, folds)
 
-    for fold, learn, classify in genCrossValidate(items, folds):
-        logger.info("beginning fold %d", fold)
-        logHeader = "fold %d/%d, " % (fold, folds)
-        learnClassify(crm, learn, classify, logger, logHeader)
+    tasks = [(fold, folds, learn, classify, results != None) for fold, learn,
+        classify in genCrossValidate(items, folds)]
 
-    return items
+    return addFoldResults(tasks, genMap(validateFold, crm, logger, tasks,
+        workers), results)
+
+def mergeCrossValidate(crm, items, folds, logger, workers = None,
+        stratified = False, results = None):
+    """
+    like crossValidate, except each fold is learned only once, into its own
+    shard of models. The models for each fold are then built by merging the
+    shards of the other folds with cssmerge. Therefore, every item is learned
+    once, rather than (folds - 1) times.
+    Requires a classifier whose models cssmerge understands, and does not
+    support train on error, since then what a shard learns depends on the
+    other shards.
+    returns items that were classified, which is all items, or results; see
+    crossValidate
+    """
+    logger.info("mergeCrossValidate, folds = %d", folds)
+
+    if crm.trainOnError:
+        raise ValueError("mergeCrossValidate does not support trainOnError")
+
+    items = items[:]
+    shuffle(items)
+    if stratified:
+        items = stratify(items, folds)
+
+    parts = partition(items, folds)
 
-def holdoutValidate(crm, items, holdout, logger):
+    shardDir = tempfile.mkdtemp(prefix = "crm114-shards-")
+    try:
+        learnTasks = [(fold + 1, os.path.join(shardDir, str(fold + 1)), part)
+            for fold, part in enumerate(parts)]
+        for task in learnTasks:
+            os.mkdir(task[1])
+        shardModels = list(genMap(learnShard, crm, logger, learnTasks,
+            workers))
+
+        classifyTasks = [(fold + 1, folds, shardModels[:fold] +
+            shardModels[fold + 1:], part, results != None) for fold, part in
+            enumerate(parts)]
+        classified = addFoldResults(classifyTasks, genMap(validateMergedFold,
+            crm, logger, classifyTasks, workers), results)
+    finally:
+        shutil.rmtree(shardDir)
+
+    return classified
+
+def holdoutValidate(crm, items, holdout, logger, workers = None,
+        results = None):
     """
     trains on (1 - holdout)-proportion of items, classifies the rest.
-    Returns the items that were classified
+    Returns the items that were classified, or if results != None, adds the
+    classifications to the ResultSet results and returns it; see classify
     """
 
     logger.info("holdoutValidate, holdout = %f", holdout)
 
     items = items[:]
-    random.shuffle(items)
+    shuffle(items)
 
     if holdout <= 0.0 or holdout >= 1.0:
             raise ValueError("holdout must be in range (0, 1)")
 
     splitIndex = int(len(items) * holdout)
-    classifyItems = items[:splitIndex]
+    classifyItems = list(items[:splitIndex])
     learnItems = items[splitIndex:]
-    learnClassify(crm, learnItems, classifyItems, logger, "")
+    return learnClassify(crm, learnItems, classifyItems, logger, "", workers,
+        results)
+
+def evaluateCandidate(crm, logger, task):
+    """
+    task is a (classifier, pipeline, learnItems, classifyItems) tuple, where
+    pipeline is a list of normalize function names. Learns and classifies the
+    items using a copy of crm with that classifier and normalize pipeline,
+    whose models are in a fresh temporary directory.
+    returns (score, error): the proportion of classifyItems that were
+    classified correctly, and None; or, if the candidate failed, None and the
+    error message
+    """
+
+    classifier, pipeline, learnItems, classifyItems = task
+    logger.info("evaluating classifier '%s', normalize = %s, on %d items",
+        classifier, pipeline, len(learnItems) + len(classifyItems))
+
+    try:
+        candidate = crm114.Crm114(crm.models, classifier, crm.threshold,
+            crm.trainOnError, normalize.makeNormalizeFunction(pipeline),
+            crm.crmRunner, metrics = crm.metrics)
+        classifications = validateFold(candidate, logger, (1, 1, learnItems,
+            classifyItems, False))
+    except (crm114.Crm114Error, ValueError, EnvironmentError), e:
+        logger.warning("classifier '%s', normalize = %s failed: %s",
+            classifier, pipeline, e)
+        return (None, "%s: %s" % (e.__class__.__name__, e))
+
+    correct = sum(1 for item, classification in zip(classifyItems,
+        classifications) if classification.bestMatch.model == item.actualModel)
+    return (float(correct) / len(classifyItems) if classifyItems else 0.0,
+        None)
+
+def search(crm, items, candidates, logger, workers = None, sample = 100,
+        eta = 3, holdout = 0.25):
+    """
+    searches candidates, a list of (classifier, pipeline) pairs, for the
+    candidate that classifies items most accurately, using successive halving:
+    scores every candidate by holdout validation on a sample of SAMPLE items,
+    then keeps the best 1/ETA of the candidates and scores them again on ETA
+    times as many items, until one candidate remains or every item is used.
+    if workers > 1, then that many candidates are scored at once.
+    returns a ranked list, best first, of dicts that describe each candidate's
+    classifier, normalize pipeline, the last round it ran in, the number of
+    items in that round, and its score in that round: the proportion of the
+    held out items that were classified correctly. A candidate that fails
+    (e.g. crm114 rejects its classifier) is dropped from the search and
+    ranked last, with score None and its error; every other candidate has
+    error None.
+    """
+
+    if eta < 2:
+        raise ValueError("eta must be at least 2")
+    if holdout <= 0.0 or holdout >= 1.0:
+        raise ValueError("holdout must be in range (0, 1)")
 
-    return classifyItems
+    items = items[:]
+    shuffle(items)
+
+    survivors = list(candidates)
+    size = sample
+    eliminated = []
+    failed = []
+    searchRound = 1
+    while True:
+        size = min(size, len(items))
+        splitIndex = int(size * holdout)
+        classifyItems = items[:splitIndex]
+        learnItems = items[splitIndex:size]
+        logger.info("search round %d: %d candidates, %d items", searchRound,
+            len(survivors), size)
+
+        tasks = [(classifier, pipeline, learnItems, classifyItems) for
+            classifier, pipeline in survivors]
+        outcomes = genMap(evaluateCandidate, crm, logger, tasks, workers)
+        results = [{"classifier" : classifier, "normalize" : pipeline,
+                    "round" : searchRound, "items" : size, "score" : score,
+                    "error" : error}
+                   for (score, error), (classifier, pipeline) in zip(outcomes,
+                       survivors)]
+        failed += [result for result in results if result["error"] != None]
+        # sorted() is stable, so ties keep the order of candidates
+        ranked = sorted([result for result in results if result["error"] ==
+            None], key = lambda result: -result["score"])
+
+        keep = int(math.ceil(len(ranked) / float(eta)))
+        if keep <= 1 or size == len(items):
+            break
+
+        eliminated.append(ranked[keep:])
+        survivors = [(result["classifier"], result["normalize"]) for result in
+            ranked[:keep]]
+        size *= eta
+        searchRound += 1
+
+    # candidates that survived more rounds rank higher, and failed ones last
+    for results in reversed(eliminated):
+        ranked += results
+    ranked += failed
+    for rank, result in enumerate(ranked):
+        result["rank"] = rank + 1
+    return ranked
 
 def accuracy(crm, items, threshold):
     """
@@ -229,6 +1257,9 @@ def accuracy(crm, items, threshold):
     returns a dict that maps the model name to its Accuracy object
     """
 
+    if isinstance(items, ResultSet):
+        return resultSetAccuracy(crm, items, threshold)
+
     accuracy = {}
 
     # post process all classified items
@@ -256,24 +1287,139 @@ def accuracy(crm, items, threshold):
 
     return accuracy
 
+def resultSetAccuracy(crm, results, threshold):
+    """
+    like accuracy, for a ResultSet. Makes a single pass over the items.
+    """
+
+    if results.models != crm.models:
+        raise ValueError("results are for models %s, not %s" %
+            (results.models, crm.models))
+
+    n = len(crm.models)
+
+    if threshold == None:
+        predicted = results.bestMatch
+    else:
+        predicted = [0 if pr >= threshold else 1 for pr in results.pr[0]]
+
+    # confusion[actual][predicted] counts the items
+    confusion = [[0] * n for m in crm.models]
+    for actual, classified in zip(results.actual, predicted):
+        confusion[actual][classified] += 1
+
+    accuracy = {}
+    for i, m in enumerate(crm.models):
+        tp = confusion[i][i]
+        fn = sum(confusion[i]) - tp
+        fp = sum(row[i] for row in confusion) - tp
+        tn = len(results) - tp - fn - fp
+        accuracy[m] = Accuracy(tp, fp, tn, fn)
+
+    return accuracy
+
 def minMaxPr(items):
     """
     returns (min, max) where min the minimum pr score in items, and max is the
     maximum
     """
+    if isinstance(items, ResultSet):
+        return (min(min(column) for column in items.pr),
+                max(max(column) for column in items.pr))
+
     # determine lower- and upper-bounds for all pr scores
     prScores = [model.pr for item in items for model in
                     item.classification.model.values()]
 
     return (min(prScores), max(prScores))
 
+class ThresholdSweep:
+    """
+    Sorts the items' pR scores for the first model once, so that the accuracy
+    at any threshold can then be computed in O(log n) time, without
+    post-processing the items. Only makes sense when there are two models.
+
+    scores: the first model's pR score for each item, sorted
+    positivesBelow: positivesBelow[k] is the number of items, among those with
+        the k lowest scores, whose actual model is the first model
+    """
+
+    def __init__(self, crm, items):
+        if len(crm.models) != 2:
+            raise ValueError("threshold sweeps only make sense when there " +
+                "are two models")
+        self.models = crm.models
+
+        if isinstance(items, ResultSet):
+            if items.models != crm.models:
+                raise ValueError("results are for models %s, not %s" %
+                    (items.models, crm.models))
+            pairs = zip(items.pr[0], (actual == 0 for actual in items.actual))
+        else:
+            first = crm.models[0]
+            pairs = [(item.classification.model[first].pr,
+                      item.actualModel == first) for item in items]
+        pairs.sort()
+
+        self.scores = [score for score, positive in pairs]
+        self.positivesBelow = [0]
+        for score, positive in pairs:
+            self.positivesBelow.append(self.positivesBelow[-1] + positive)
+        self.positives = self.positivesBelow[-1]
+
+    def accuracy(self, threshold):
+        """
+        returns a dict that maps each model to its Accuracy, if the first
+        model is the best match iff its pr score >= threshold
+        """
+        # the number of items classified as the second model
+        below = bisect.bisect_left(self.scores, threshold)
+        n = len(self.scores)
+
+        tp = self.positives - self.positivesBelow[below]
+        fn = self.positivesBelow[below]
+        fp = (n - below) - tp
+        tn = below - fn
+
+        return { self.models[0] : Accuracy(tp, fp, tn, fn),
+                 self.models[1] : Accuracy(tn, fn, tp, fp) }
+
+    def roc(self):
+        """
+        returns the exact ROC curve for the first model, and its area: a dict
+        with "points", a list of {threshold, fpr, tpr} dicts, one for each
+        distinct score (from highest to lowest threshold), and "auc"
+        """
+        n = len(self.scores)
+        negatives = n - self.positives
+
+        points = []
+        auc = 0.0
+        lastFpr = lastTpr = 0.0
+        for below in xrange(n - 1, -1, -1):
+            if below > 0 and self.scores[below - 1] == self.scores[below]:
+                continue
+            tp = self.positives - self.positivesBelow[below]
+            fp = (n - below) - tp
+            tpr = float(tp) / self.positives if self.positives > 0 else 0.0
+            fpr = float(fp) / negatives if negatives > 0 else 0.0
+            points.append({"threshold" : self.scores[below], "tpr" : tpr,
+                "fpr" : fpr})
+            auc += (fpr - lastFpr) * (tpr + lastTpr) / 2
+            lastFpr, lastTpr = fpr, tpr
+
+        return {"points" : points, "auc" : auc}
+
 def varyThreshold(crm, items, dataPoints = 100):
     """
-    items is a list of classified LabeledItem objects.
-    Explores N different values for threshold, where N = dataPoints.
+    items is a list of classified LabeledItem objects, or a ResultSet.
+    Explores N different values for threshold, where N = dataPoints. If
+    dataPoints == None, then explores every distinct pR score of the first
+    model.
     Returns a result dict where:
         result[model][threshold] = accuracy
-    where accuracy is an Accuracy object for that threshold and model
+    where accuracy is an Accuracy object for that threshold and model.
+    Does not modify items.
     """
 
     if len(crm.models) != 2:
@@ -282,18 +1428,34 @@ def varyThreshold(crm, items, dataPoints = 100):
 
     result = dict((m, dict()) for m in crm.models)
 
-    low, high = minMaxPr(items)
-    increment = (high - low) / (dataPoints + 1)
+    sweep = ThresholdSweep(crm, items)
+
+    if dataPoints == None:
+        thresholds = sorted(set(sweep.scores))
+    else:
+        low, high = minMaxPr(items)
+        increment = (high - low) / (dataPoints + 1)
 
-    threshold = low + increment
-    for i in xrange(dataPoints):
-        a = accuracy(crm, items, threshold)
+        thresholds = []
+        threshold = low + increment
+        for i in xrange(dataPoints):
+            thresholds.append(threshold)
+            threshold += increment
+
+    for threshold in thresholds:
+        a = sweep.accuracy(threshold)
         for m in crm.models:
             result[m][threshold] = a[m]
-        threshold += increment
 
     return result
 
+def roc(crm, items):
+    """
+    returns the exact ROC curve and AUC for the first model; see
+    ThresholdSweep.roc
+    """
+    return ThresholdSweep(crm, items).roc()
+
 def pathToModel(path, modelDir):
     """
     converts path == "foo/bar/modelname.txt" to "modelDir/modelname.css"
@@ -314,10 +1476,29 @@ if __name__ == "__main__":
         help="save final models in OUTPUT_DIR. Default: %(default)s")
     parser.add_argument("-f", "--fold", type=int,
         help="perform FOLD-fold cross validation")
+    parser.add_argument("-m", "--merge", action='store_true',
+        help="with --fold, learn each fold only once, and build the models " +
+             "for each fold by merging the other folds' models with cssmerge")
+    parser.add_argument("--stratified", action='store_true',
+        help="with --fold, keep the proportion of each LINEDATA's items the " +
+             "same in every fold")
     parser.add_argument("--holdout", type=float,
         help="use HOLDOUT proportion of the data as the classification set. " +
              "Use the rest as the classification set. If defined, then " +
              "overrides --fold.")
+    parser.add_argument("-s", "--search", action='store_true',
+        help="search every classifier and combination of classifier " +
+             "options, with every normalize pipeline in normalize.py (or " +
+             "just NORMALIZE, if given), for the most accurate one, using " +
+             "successive halving and HOLDOUT validation. Outputs a ranked " +
+             "report.")
+    parser.add_argument("--search_sample", type=int, default=100,
+        help="with --search, score every candidate on SEARCH_SAMPLE items in " +
+             "the first round. Default: %(default)s")
+    parser.add_argument("--search_eta", type=int, default=3,
+        help="with --search, keep the best 1/SEARCH_ETA candidates after " +
+             "each round, and score them on SEARCH_ETA times as many items. " +
+             "Default: %(default)s")
     parser.add_argument("-l", "--learn", action='store_true',
         help="learn the labeled data into fresh models.")
     parser.add_argument("-c", "--classify", action='store_true',
@@ -325,12 +1506,19 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--vary_threshold", type=int, default=None,
         help="if classifying against two models, then vary the threshold at " +
              "VARY_THRESHOLD different data points")
+    parser.add_argument("--roc", action='store_true',
+        help="if classifying against two models, then output the exact ROC " +
+             "curve and its AUC for the first model")
     parser.add_argument("--threshold", type=float, default=None,
         help="if classifying against two models, then set the classification" +
              "threshold for the first model. See crm114.py for more details.")
     parser.add_argument("--linedata", nargs="+",
         help="for each line LINEDATA file, read line of data an label it " + 
              "after LINEDATA")
+    parser.add_argument("--mmap", action='store_true',
+        help="memory-map the LINEDATA files rather than loading them, and " +
+             "only keep an index of their line offsets in memory. Each index " +
+             "is saved next to its file, as LINEDATA.idx")
     parser.add_argument("--limit", type=int,
         help="limit each dataset to LIMIT items")
     parser.add_argument("-t", "--toe", action='store_true',
@@ -339,6 +1527,24 @@ if __name__ == "__main__":
         help="A list of normalize functions, e.g. 'lower startEnd'; see " +
              "normalize.py. Before learning or classifying, the input string" +
              "will be passed through each normalize function, in order.")
+    parser.add_argument("--normalize_cache", default=None,
+        help="with --normalize, cache each LINEDATA's normalized lines in " +
+             "NORMALIZE_CACHE, keyed by the checksum of LINEDATA and the " +
+             "normalize functions. Without --limit only. Default: no cache")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="classify, run cross validation folds, or learn the final " +
+             "model with JOBS worker processes. With --learn, each worker " +
+             "learns a shard of the data, and the shards are merged with " +
+             "cssmerge. Default: %(default)s")
+    parser.add_argument("--profile", action='store_true',
+        help="time each phase (loading, learning, classifying, and within " +
+             "crm114.py: normalizing, starting crm114, writing to it, " +
+             "waiting for it, parsing its output), and print a breakdown to " +
+             "stderr at the end")
+    parser.add_argument("--profile_output",
+        help="with --profile, also write the latency histograms to " +
+             "PROFILE_OUTPUT, in the Prometheus text format if it ends in " +
+             ".prom, and as JSON otherwise")
     parser.add_argument("--log", choices=["debug", "info", "warning", "error",
         "critical"], default='info',
         help="logging level. Default: %(default)s")
@@ -362,9 +1568,14 @@ if __name__ == "__main__":
     logger.info("classifier = '%s'", args.classifier)
     logger.info("linedata = %s", args.linedata)
     logger.info("limit = %s", args.limit)
+    logger.info("mmap = %s", args.mmap)
     logger.info("output_dir = %s", args.output_dir)
     logger.info("toe = %s", args.toe)
     logger.info("normalize = %s", args.normalize)
+    logger.info("jobs = %d", args.jobs)
+    logger.info("merge = %s", args.merge)
+    logger.info("stratified = %s", args.stratified)
+    logger.info("search = %s", args.search)
 
     normalizeFunction = normalize.makeNormalizeFunction(args.normalize)
 
@@ -374,34 +1585,86 @@ if __name__ == "__main__":
     models = [pathToModel(linedata, args.output_dir) for linedata in
         args.linedata]
 
-    items = []
-
-    for (path, model) in zip(args.linedata, models):
-        newItems = lineitems(path, model, args.limit)
-        logger.info("loaded %d %s items", len(newItems), model)
-        items += newItems
+    metrics = crm114.Metrics() if args.profile else None
 
-    crm = crm114.Crm114(models, args.classifier, None, args.toe,
-        normalizeFunction)
+    # classifying and learning just make passes over the items, so unless
+    # they are sampled with --limit, stream them rather than loading them
+    streaming = args.limit == None and not args.search and (args.classify or
+        (args.holdout == None and args.fold == None))
 
-    classifyItems = None
+    with timed(metrics, "corpus.load"):
+        if args.mmap:
+            items = mappedCorpus(args.linedata, models, args.limit)
+            logger.info("mapped %d items", len(items))
+        elif streaming:
+            logger.info("streaming items from %s", args.linedata)
+            items = LineCorpus(args.linedata, models)
+        else:
+            items = []
+            for (path, model) in zip(args.linedata, models):
+                if args.normalize != None and not args.search:
+                    # normalize each item once, rather than on every fold
+                    newItems = normalizedLineitems(path, model,
+                        args.normalize, args.limit, args.normalize_cache,
+                        args.jobs, metrics)
+                else:
+                    newItems = lineitems(path, model, args.limit)
+                logger.info("loaded %d %s items", len(newItems), model)
+                items += newItems
 
-    if args.classify:
-        classifyItems = classify(crm, items, logger)
-    elif args.holdout != None:
-        classifyItems = holdoutValidate(crm, items, args.holdout, logger)
-    elif args.fold != None:
-        classifyItems = crossValidate(crm, items, args.fold, logger)
+    crm = crm114.Crm114(models, args.classifier, None, args.toe,
+        normalizeFunction, metrics = metrics)
+
+    results = None
+    report = None
+
+    # the classifications are kept in compact columns as they come back, in a
+    # ResultSet, rather than as Classification objects
+    with timed(metrics, "corpus.validate"):
+        if args.search:
+            pipelines = (normalize.pipelines if args.normalize == None else
+                [args.normalize])
+            candidates = [(classifier, pipeline) for classifier in
+                crm114.classifierConfigurations() for pipeline in pipelines]
+            report = search(crm, items, candidates, logger, args.jobs,
+                args.search_sample, args.search_eta,
+                0.25 if args.holdout == None else args.holdout)
+        elif args.classify:
+            results = classifyStream(crm, items, logger, workers = args.jobs)
+        elif args.holdout != None:
+            results = holdoutValidate(crm, items, args.holdout, logger,
+                args.jobs, ResultSet(crm.models))
+        elif args.fold != None and args.merge:
+            results = mergeCrossValidate(crm, items, args.fold, logger,
+                args.jobs, args.stratified, ResultSet(crm.models))
+        elif args.fold != None:
+            results = crossValidate(crm, items, args.fold, logger,
+                args.jobs, args.stratified, ResultSet(crm.models))
 
     if args.learn:
         logger.info("Building final model")
-        learn(crm, items, logger, "final model ")
-
-    if classifyItems != None:
-        if args.vary_threshold == None:
-            result = accuracy(crm, classifyItems, args.threshold)
-        else:
-            result = varyThreshold(crm, classifyItems, args.vary_threshold)
+        with timed(metrics, "corpus.learn"):
+            learnSharded(crm, items, logger, args.jobs, "final model ")
+
+    if results != None:
+        with timed(metrics, "corpus.score"):
+            if args.roc:
+                result = roc(crm, results)
+            elif args.vary_threshold == None:
+                result = accuracy(crm, results, args.threshold)
+            else:
+                result = varyThreshold(crm, results, args.vary_threshold)
         print toJson(result)
 
-
+    if report != None:
+        print toJson(report)
+
+    if metrics != None:
+        sys.stderr.write(metrics.report() + "\n")
+        if args.profile_output != None:
+            with open(args.profile_output, "w") as f:
+                if args.profile_output.endswith(".prom"):
+                    f.write(metrics.prometheus())
+                else:
+                    f.write(json.dumps(metrics.dict(), indent = 4,
+                        sort_keys = True) + "\n")
@@ -37,22 +37,74 @@ the output parsers here.
 
 Performance note: Every call to learn() or classify() invokes the Crm114 binary
 as a separate process, whose performance tends to be dominated by disk io.
-To improve performance, store your model files in a ramdisk.
+To improve performance, store your model files in a ramdisk (see ModelStore),
+use classifyMany() to classify many documents with a single process, or pass a
+PersistentCrmRunner to Crm114. Where the crm binary is not available, pass an
+osb.OsbRunner, which classifies in process. For many short-lived clients, run
+crm114.py --serve, which keeps warm crm114 processes behind a Unix domain
+socket; see Crm114Server. To merge concurrent classify() calls from many
+threads into fewer crm114 invocations, see BatchScheduler.
 """ 
 
 import normalize
 
 import argparse
+import atexit
+import bisect
+import collections
+import contextlib
+import errno
+import fcntl
+import hashlib
+import itertools
 import re
 import os
+import Queue
+import select
+import shutil
+import signal
+import socket
+import SocketServer
+import stat
 import subprocess
 import sys
 import json
+import tempfile
+import threading
+import time
 
 classifyTemplate = "-{ isolate (:stats:); classify <%(classifier)s> " + \
     "(%(models)s) (:stats:); output /:*:stats:/ }"
 learnTemplate = "-{ learn <%(classifier)s> ( %(model)s ) }"
+# Classifies stdin, and learns stdin into model only if the best match is not
+# model. Outputs the classification, followed by learnedMarker or
+# notLearnedMarker on a line of its own.
+learnOnErrorTemplate = ("-{ isolate (:stats:); " +
+    "classify <%(classifier)s> (%(models)s) (:stats:); " +
+    "output /:*:stats:/; " +
+    "{ match [:stats:] /Best match to file #[0-9]+ \\(%(modelRe)s\\)/; " +
+    "output /\\n%(notLearned)s\\n/ } " +
+    "alius { learn <%(classifier)s> ( %(model)s ); " +
+    "output /\\n%(learned)s\\n/ } }")
+learnedMarker = "CRM114PY_LEARNED"
+notLearnedMarker = "CRM114PY_NOT_LEARNED"
 crmBinary = "crm"
+cssmergeBinary = "cssmerge"
+
+# Wraps the body of a single-document program, so that the body runs once for
+# each document read from stdin. Each document on stdin is followed by
+# documentDelimiter and a newline. After each document, the program outputs
+# documentDelimiter on a line of its own. See loopProgram, frameDocument and
+# splitOutput.
+documentDelimiter = "CRM114PY_END_OF_DOCUMENT"
+loopTemplate = ("-{ window; " +
+    "{ isolate (:crmpy_doc:) //; " +
+    "window <byline> (:crmpy_doc:) // /%(delimiter)s/; " +
+    "match [:crmpy_doc:] (:: :crmpy_data:) /(.*)%(delimiter)s/; " +
+    "alter (:_dw:) /:*:crmpy_data:/; " +
+    "%(body)s; " +
+    "output /\\n%(delimiter)s\\n/; " +
+    "liaf } }")
 
 # See "Current Classifiers in CRM114" in the CRM114 book for explanations
 defaultClassifier = "osb unique microgroom"
@@ -72,6 +124,23 @@ classifierOptions = [
     "microgroom",   # automaticall manages size of model files
     "unique"]       # treat features as sets, not multisets. I.e. repeated
                     # features have no effect
+unigramClassifiers = ["osb", "winnow", "hyperspace"]
+
+def classifierConfigurations(classifiers = classifiers,
+        options = classifierOptions):
+    """
+    returns a list of classifier strings, one for each classifier combined with
+    each subset of options. Skips "unigram" for classifiers that don't
+    support it.
+    """
+    configurations = []
+    for classifier in classifiers:
+        valid = [option for option in options if option != "unigram" or
+            classifier in unigramClassifiers]
+        for n in xrange(len(valid) + 1):
+            for subset in itertools.combinations(valid, n):
+                configurations.append(" ".join((classifier,) + subset).strip())
+    return configurations
 
 # regex to match the floating point values, as produced by Crm114
 flotingPointReStr = r"(\+|-)?\d+\.?\d*(e(\+|-))?\d*"
@@ -104,7 +173,85 @@ subClassificationReStr = (r"#\d+\s+\((?P<model>.*)\):\s+" +
         { 'float' : flotingPointReStr }
 subClassificationRe = re.compile(subClassificationReStr)
 
-class Classification:
+def parseModelLine(modelLine):
+    """
+    returns (model, features, hits, prob, pr) for modelLine, a line of
+    crm114's classify output that describes one model. Fields that modelLine
+    lacks are None.
+    """
+    match = subClassificationRe.match(modelLine)
+    if not match:
+        raise ValueError("Could not parse modelLine: %s" % modelLine)
+
+    featuresStr = match.group('features')
+    hitsStr = match.group('hits')
+    probStr = match.group('prob')
+
+    return (match.group('model'),
+        float(featuresStr) if featuresStr else None,
+        int(hitsStr) if hitsStr else None,
+        float(probStr) if probStr else None,
+        float(match.group('pr')))
+
+def parseClassification(classificationString):
+    """
+    returns (totalFeatures, bestMatch, modelLines) for classificationString,
+    the output of crm114's classify. bestMatch is the name of the best
+    matching model, and modelLines are the lines that describe each model.
+    """
+    match = classificationRe.match(classificationString)
+    if not match:
+        raise ValueError("Could not parse classificationString: %s" %
+            classificationString)
+
+    lines = classificationString.split("\n")
+    modelLines = filter(lambda line: line.startswith("#"), lines)
+
+    return (int(match.group('totalFeatures')), match.group('bestMatch'),
+        modelLines)
+
+class ModelMatch(object):
+
+    # a Classification holds one ModelMatch per model, so save the memory of
+    # a per-instance __dict__
+    __slots__ = ("model", "features", "hits", "prob", "pr")
+
+    def __init__(self, modelLine):
+        """
+        For a particular CRM114 classification, there is one ModelMatch
+        object for each model used in the classification. Each ModelMatch
+        object stores information about how closely the input data matches
+        the model. Note, some of the fields may be None because different
+        classifiers produce values for different fields. There will always
+        be a pr field.
+
+        Fields:
+        model: which model this ModelMatch is for
+        features: the number of features that have been learned into this
+            model
+        hits: the number of features in input that that hit the model-
+        pr: the pR score that represents the likelihood that the input data
+            matches this model. Typically a value in the range [-320.0,
+            320.0]. This value is intended to be more human readable than
+            prob. See section "Why pR?" on page 171 of the CRM114 book.
+        prob: the "probability" that the input data matches this model. pr
+            scores are better.
+        """
+        (self.model, self.features, self.hits, self.prob, self.pr) = \
+            parseModelLine(modelLine)
+
+    def dict(self):
+        """returns a dict representation of object"""
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __getstate__(self):
+        return self.dict()
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
+class Classification(object):
     """
     Holds the result of a CRM114 classification.
 
@@ -114,70 +261,25 @@ class Classification:
     model: a dict that maps model filenames to ModelMatch objects
     """
 
-    class ModelMatch:
-
-        def __init__(self, modelLine):
-            """
-            For a particular CRM114 classification, there is one ModelMatch
-            object for each model used in the classification. Each ModelMatch
-            object stores information about how closely the input data matches
-            the model. Note, some of the fields may be None because different
-            classifiers produce values for different fields. There will always
-            be a pr field.
-
-            Fields:
-            model: which model this ModelMatch is for
-            features: the number of features that have been learned into this
-                model
-            hits: the number of features in input that that hit the model-
-            pr: the pR score that represents the likelihood that the input data
-                matches this model. Typically a value in the range [-320.0,
-                320.0]. This value is intended to be more human readable than
-                prob. See section "Why pR?" on page 171 of the CRM114 book.
-            prob: the "probability" that the input data matches this model. pr
-                scores are better.
-            """
-            match = subClassificationRe.match(modelLine)
-            if not match:
-                raise ValueError("Could not parse modelLine: %s" % modelLine)
-            self.model = match.group('model')
-
-            self.pr = float(match.group('pr'))
-
-            featuresStr = match.group('features')
-            self.features = float(featuresStr) if featuresStr else None
-
-            hitsStr = match.group('hits')
-            self.hits = int(hitsStr) if hitsStr else None
-
-            probStr = match.group('prob')
-            self.prob = float(probStr) if probStr else None
+    # ModelMatch is defined at module level so that it can be pickled
+    ModelMatch = ModelMatch
 
     def __init__(self, classificationString):
-        match = classificationRe.match(classificationString)
-        if not match:
-            raise ValueError("Could not parse classificationString: %s" %
-                classificationString)
-        self.totalFeatures = int(match.group('totalFeatures'))
-
-        lines = classificationString.split("\n")
-        modelLines = filter(lambda line: line.startswith("#"), lines)
-
-        modelMatches = [Classification.ModelMatch(line) for line in modelLines]
-        pairs = [(modelMatch.model, modelMatch) for modelMatch in modelMatches]
-
-        self.model = dict(pairs)
-
-        self.bestMatch = self.model[match.group('bestMatch')]
+        (self.totalFeatures, bestMatch, modelLines) = \
+            parseClassification(classificationString)
+        modelMatches = [ModelMatch(line) for line in modelLines]
+        self.model = dict((modelMatch.model, modelMatch) for modelMatch in
+            modelMatches)
+        self.bestMatch = self.model[bestMatch]
 
     def dict(self):
         """returns a dict representation of object; for debugging and
         testing"""
         if self.bestMatch:
-            bestMatch = self.bestMatch.__dict__
+            bestMatch = self.bestMatch.dict()
         else:
             bestMatch = None
-        model = [(m[0], m[1].__dict__ ) for m in self.model.iteritems()]
+        model = [(m[0], m[1].dict() ) for m in self.model.iteritems()]
 
         return {"bestMatch" : bestMatch, "totalFeatures" : self.totalFeatures,
             "model" : dict(model) }
@@ -189,24 +291,778 @@ class Classification:
 class Crm114Error(Exception):
     pass
 
+def crmRegexEscape(string):
+    """escapes string for use in a crm114 regex, delimited by slashes"""
+    return re.sub(r"([\\^$.|?*+()\[\]{}/])", r"\\\1", string)
+
+def loopProgram(program):
+    """
+    converts program, a crm114 program of the form "-{ ... }" that processes
+    all of stdin as one document, into a program that processes each framed
+    document on stdin in turn
+    """
+    if not (program.startswith("-{") and program.endswith("}")):
+        raise ValueError("Cannot loop program: %s" % program)
+    return loopTemplate % { "delimiter" : documentDelimiter,
+        "body" : program[2:-1].strip() }
+
+def frameDocument(data):
+    """returns data framed for a program created by loopProgram"""
+    if documentDelimiter in data:
+        raise ValueError("data contains the document delimiter: %s" %
+            documentDelimiter)
+    return data + documentDelimiter + "\n"
+
+def splitOutput(output):
+    """
+    splits the output of a program created by loopProgram into a list, which
+    holds the output for each document
+    """
+    outputs = output.split("\n" + documentDelimiter + "\n")
+    if outputs[-1] != "":
+        raise Crm114Error("Unterminated output: %s" % outputs[-1])
+    return outputs[:-1]
+
+class Metrics:
+    """
+    Optional instrumentation for Crm114 and the crm runners. Records a latency
+    histogram for each phase, e.g.:
+
+        normalize: normalizing a document
+        spawn: starting a crm114 process
+        write: writing to crm114's stdin
+        wait: waiting for crm114's output, after writing
+        parse: parsing crm114's output
+
+    and counters, e.g. bytesIn and bytesOut, the bytes written to and read
+    from crm114. Export with dict() (for JSON), prometheus() or report().
+    Thread safe.
+    """
+
+    # upper bounds of the histogram buckets, in seconds
+    buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf")]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # maps each phase to a [count, sum, bucket counts...] list
+            self.phases = {}
+            self.counters = {}
+
+    def observe(self, phase, seconds):
+        """records that phase took seconds"""
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.phases.get(phase)
+            if histogram == None:
+                histogram = self.phases[phase] = [0, 0.0] + [0] * len(
+                    self.buckets)
+            histogram[0] += 1
+            histogram[1] += seconds
+            histogram[2 + i] += 1
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """times the body of a with statement as phase"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.time() - start)
+
+    def count(self, counter, n = 1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def dict(self):
+        """
+        returns a dict with the counters, and for each phase: its count, its
+        total seconds, and its histogram, a list of [upper bound, count] pairs
+        """
+        with self.lock:
+            return {
+                "counters" : dict(self.counters),
+                "phases" : dict((phase, {"count" : h[0], "seconds" : h[1],
+                    "histogram" : [[bound, n] for bound, n in zip(self.buckets,
+                    h[2:]) if n > 0]}) for phase, h in self.phases.items()) }
+
+    def merge(self, metrics):
+        """adds metrics, as returned by another Metrics' dict(), to self"""
+        with self.lock:
+            for counter, n in metrics["counters"].items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            for phase, summary in metrics["phases"].items():
+                histogram = self.phases.get(phase)
+                if histogram == None:
+                    histogram = self.phases[phase] = [0, 0.0] + [0] * len(
+                        self.buckets)
+                histogram[0] += summary["count"]
+                histogram[1] += summary["seconds"]
+                for bound, n in summary["histogram"]:
+                    histogram[2 + self.buckets.index(bound)] += n
+
+    def quantile(self, phase, q):
+        """
+        returns an upper bound on the q-quantile of phase's latency, from its
+        histogram
+        """
+        with self.lock:
+            histogram = self.phases[phase]
+        seen = 0
+        for bound, n in zip(self.buckets, histogram[2:]):
+            seen += n
+            if seen >= q * histogram[0]:
+                return bound
+        return self.buckets[-1]
+
+    def prometheus(self, prefix = "crmpy"):
+        """returns the metrics in the Prometheus text exposition format"""
+        metrics = self.dict()
+        lines = ["# TYPE %s_phase_seconds histogram" % prefix]
+        for phase, summary in sorted(metrics["phases"].items()):
+            counts = dict((bound, n) for bound, n in summary["histogram"])
+            seen = 0
+            for bound in self.buckets:
+                seen += counts.get(bound, 0)
+                lines.append('%s_phase_seconds_bucket{phase="%s",le="%s"} %d' %
+                    (prefix, phase, "+Inf" if bound == float("inf") else
+                    repr(bound), seen))
+            lines.append('%s_phase_seconds_sum{phase="%s"} %r' % (prefix,
+                phase, summary["seconds"]))
+            lines.append('%s_phase_seconds_count{phase="%s"} %d' % (prefix,
+                phase, summary["count"]))
+        for counter, n in sorted(metrics["counters"].items()):
+            lines.append("# TYPE %s_%s_total counter" % (prefix, counter))
+            lines.append("%s_%s_total %d" % (prefix, counter, n))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        """returns a human readable breakdown of the phases and counters"""
+        metrics = self.dict()
+        lines = ["%-16s %8s %10s %10s %10s %10s" % ("phase", "count",
+            "seconds", "mean ms", "p50 ms", "p99 ms")]
+        for phase, summary in sorted(metrics["phases"].items(), key =
+                lambda (phase, summary): -summary["seconds"]):
+            lines.append("%-16s %8d %10.3f %10.3f %10.3g %10.3g" % (
+                phase, summary["count"], summary["seconds"],
+                1e3 * summary["seconds"] / summary["count"],
+                1e3 * self.quantile(phase, 0.5),
+                1e3 * self.quantile(phase, 0.99)))
+        for counter, n in sorted(metrics["counters"].items()):
+            lines.append("%-16s %8d" % (counter, n))
+        return "\n".join(lines)
+
 # implemented as a class for mockability
 class CrmRunner:
 
+    metrics = None
+
+    def __init__(self, metrics = None):
+        """metrics: an optional Metrics, which times spawn, write and wait"""
+        self.metrics = metrics
+
     def run(self, data, command):
+        if self.metrics != None:
+            return self.measuredRun(data, command)
+
         p = subprocess.Popen(command, stdin = subprocess.PIPE, stdout =
             subprocess.PIPE, stderr = subprocess.PIPE)
-        p.stdin.write(data)
-        (stdout, stderr) = p.communicate()
+        (stdout, stderr) = p.communicate(data)
         if stderr != "" or p.returncode != 0:
             raise Crm114Error("commond = " + str(command) + "\n" + stdout + stderr)
         return stdout
 
+    def measuredRun(self, data, command):
+        """
+        like run, but records the spawn, write and wait phases in
+        self.metrics. Writes stdin from a separate thread, so that it can be
+        timed apart from reading stdout without risking a deadlock.
+        """
+        start = time.time()
+        stderr = tempfile.TemporaryFile()
+        try:
+            p = subprocess.Popen(command, stdin = subprocess.PIPE, stdout =
+                subprocess.PIPE, stderr = stderr)
+            spawned = time.time()
+
+            written = []
+            def write():
+                try:
+                    p.stdin.write(data)
+                    p.stdin.close()
+                except IOError:
+                    pass
+                written.append(time.time())
+            writer = threading.Thread(target = write)
+            writer.start()
+            stdout = p.stdout.read()
+            writer.join()
+            p.wait()
+            finished = time.time()
+
+            stderr.seek(0)
+            message = stderr.read()
+        finally:
+            stderr.close()
+
+        self.metrics.observe("spawn", spawned - start)
+        self.metrics.observe("write", written[0] - spawned)
+        self.metrics.observe("wait", finished - written[0])
+        self.metrics.count("runs")
+        self.metrics.count("bytesIn", len(data))
+        self.metrics.count("bytesOut", len(stdout))
+
+        if message != "" or p.returncode != 0:
+            raise Crm114Error("commond = " + str(command) + "\n" + stdout +
+                message)
+        return stdout
+
+    def runMany(self, documents, command):
+        """
+        runs command once for each document in documents, using a single
+        crm114 process. Returns the list of outputs, one for each document.
+        """
+        data = "".join(frameDocument(document) for document in documents)
+        loopCommand = command[:-1] + [loopProgram(command[-1])]
+        outputs = splitOutput(self.run(data, loopCommand))
+        if len(outputs) != len(documents):
+            raise Crm114Error("commond = %s\nexpected %d outputs, got %d" %
+                (str(command), len(documents), len(outputs)))
+        return outputs
+
+def mergeModels(target, sources, crmRunner = None):
+    """
+    merges the model files in sources into a new model file, target, using
+    cssmerge. Only works for classifiers whose model files cssmerge
+    understands (e.g. the default classifier), and all sources must have the
+    same size. Does not invalidate cached classifications that used target;
+    see Crm114.merge.
+    """
+    if len(sources) == 0:
+        raise ValueError("no model files to merge into %s" % target)
+    if crmRunner == None:
+        crmRunner = CrmRunner()
+
+    shutil.copyfile(sources[0], target)
+    for source in sources[1:]:
+        crmRunner.run("", [cssmergeBinary, target, source])
+
+class PersistentCrmRunner:
+    """
+    A drop-in replacement for CrmRunner that keeps one crm114 process alive for
+    each distinct command, rather than starting a new process on every call.
+    Each process runs loopProgram(command), and reads one framed document per
+    call. A process that dies is restarted on the next call.
+
+    A running crm114 process may hold a stale view of a model file that
+    another process has learned into (or created). Therefore, running a learn
+    command stops every other process, which then reload their models when
+    they are restarted. Other commands, e.g. the cssmerge of mergeModels, stop
+    every process, and then run once, like CrmRunner.
+    """
+
+    learnRe = re.compile(r"\blearn\b")
+
+    def __init__(self, metrics = None):
+        """metrics: an optional Metrics, which times spawn, write and wait"""
+        # maps tuple(command) to a (process, stderr file) pair
+        self.processes = {}
+        self.pid = os.getpid()
+        self.metrics = metrics
+
+    def start(self, command):
+        start = time.time()
+        stderr = tempfile.TemporaryFile()
+        loopCommand = command[:-1] + [loopProgram(command[-1])]
+        p = subprocess.Popen(loopCommand, stdin = subprocess.PIPE, stdout =
+            subprocess.PIPE, stderr = stderr)
+        self.processes[tuple(command)] = (p, stderr)
+        if self.metrics != None:
+            self.metrics.observe("spawn", time.time() - start)
+        return p
+
+    def stop(self, key):
+        p, stderr = self.processes.pop(key)
+        try:
+            p.stdin.close()
+        except IOError:
+            pass
+        p.wait()
+        stderr.close()
+
+    def close(self):
+        """stops every crm114 process"""
+        for key in self.processes.keys():
+            self.stop(key)
+
+    def copy(self):
+        """returns a new PersistentCrmRunner, which shares no processes"""
+        return PersistentCrmRunner(self.metrics)
+
+    def error(self, command, stdout):
+        """stops the process for command, and returns a Crm114Error"""
+        p, stderr = self.processes[tuple(command)]
+        stderr.seek(0)
+        message = stderr.read()
+        self.stop(tuple(command))
+        return Crm114Error("commond = " + str(command) + "\n" + stdout +
+            message)
+
+    def run(self, data, command):
+        if self.pid != os.getpid():
+            # after a fork, the processes belong to the parent process
+            self.processes = {}
+            self.pid = os.getpid()
+
+        if not command[-1].startswith("-{"):
+            self.close()
+            return CrmRunner(self.metrics).run(data, command)
+
+        key = tuple(command)
+        frame = frameDocument(data)
+
+        if self.learnRe.search(command[-1]):
+            for other in self.processes.keys():
+                if other != key:
+                    self.stop(other)
+
+        if key in self.processes and self.processes[key][0].poll() != None:
+            self.stop(key)
+        if key in self.processes:
+            p, stderr = self.processes[key]
+        else:
+            p = self.start(command)
+
+        start = time.time()
+        try:
+            p.stdin.write(frame)
+            p.stdin.flush()
+        except IOError:
+            raise self.error(command, "")
+        written = time.time()
+
+        lines = []
+        while True:
+            line = p.stdout.readline()
+            if line == "":
+                raise self.error(command, "".join(lines))
+            elif line == documentDelimiter + "\n":
+                break
+            lines.append(line)
+
+        if self.metrics != None:
+            self.metrics.observe("write", written - start)
+            self.metrics.observe("wait", time.time() - written)
+            self.metrics.count("runs")
+            self.metrics.count("bytesIn", len(frame))
+            self.metrics.count("bytesOut", sum(len(line) for line in lines))
+
+        if os.fstat(self.processes[key][1].fileno()).st_size > 0:
+            raise self.error(command, "".join(lines))
+
+        # drop the newline that preceeds the delimiter
+        return "".join(lines)[:-1]
+
+    def runMany(self, documents, command):
+        return [self.run(document, command) for document in documents]
+
+class ModelStore:
+    """
+    Stages the model files of a Crm114 object in a RAM-backed directory (a
+    private directory in /dev/shm, if it exists), and points the Crm114 object
+    at the staged copies. Changes are written back to the original, durable
+    files by sync(), which runs every syncInterval seconds (if not None), on
+    close(), and at exit. Each file is written back atomically, by writing a
+    temporary file in the same directory and renaming it.
+
+    After staging, learn() accepts either the durable or the staged filename,
+    but Classifications name the staged files; see path().
+
+    sync() copies whatever the staged files hold at the time, so to write back
+    a consistent model, sync while no process is learning into it. Written
+    back files keep the durable file's permissions. A store stays open until
+    close() (or exit), whether or not it is still referenced.
+    """
+
+    ramDirectory = "/dev/shm"
+
+    def __init__(self, crm, syncInterval = None, directory = None):
+        if directory == None and os.path.isdir(self.ramDirectory):
+            directory = self.ramDirectory
+
+        self.crm = crm
+        self.durableModels = list(crm.models)
+        self.directory = tempfile.mkdtemp(prefix = "crm114-models-",
+            dir = directory)
+        # prefix with the model's index, in case basenames collide
+        self.stagedModels = [os.path.join(self.directory, "%d-%s" % (i,
+            os.path.basename(model))) for i, model in
+            enumerate(self.durableModels)]
+
+        for durable, staged in zip(self.durableModels, self.stagedModels):
+            if os.path.exists(durable):
+                shutil.copyfile(durable, staged)
+        crm.setModels(self.stagedModels)
+        crm.aliases = dict(zip(self.durableModels, self.stagedModels))
+
+        self.lock = threading.Lock()
+        self.closed = False
+        self.syncInterval = syncInterval
+        self.timer = None
+        self.schedule()
+        openModelStores.add(self)
+
+    def path(self, model):
+        """returns the staged filename for model, a durable filename"""
+        return self.stagedModels[self.durableModels.index(model)]
+
+    def schedule(self):
+        if self.syncInterval != None:
+            self.timer = threading.Timer(self.syncInterval, self.periodicSync)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def periodicSync(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.syncFiles()
+        self.schedule()
+
+    def syncFiles(self):
+        for durable, staged in zip(self.durableModels, self.stagedModels):
+            if not os.path.exists(staged):
+                continue
+            if os.path.exists(durable):
+                mode = stat.S_IMODE(os.stat(durable).st_mode)
+            else:
+                # what open() would have created
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0666 & ~umask
+            fd, temp = tempfile.mkstemp(prefix = ".crm114-",
+                dir = os.path.dirname(os.path.abspath(durable)))
+            try:
+                # mkstemp creates the file readable by its owner only
+                os.fchmod(fd, mode)
+                with os.fdopen(fd, "wb") as f, open(staged, "rb") as source:
+                    shutil.copyfileobj(source, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(temp, durable)
+            except:
+                os.remove(temp)
+                raise
+
+    def sync(self):
+        """writes the staged model files back to the durable files"""
+        with self.lock:
+            if self.closed:
+                raise ValueError("ModelStore is closed")
+            self.syncFiles()
+
+    def close(self):
+        """
+        writes the staged model files back, points the Crm114 object back at
+        the durable files, and removes the staged files
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.timer != None:
+                self.timer.cancel()
+            self.syncFiles()
+            self.crm.setModels(self.durableModels)
+            self.crm.aliases = {}
+            shutil.rmtree(self.directory)
+            openModelStores.discard(self)
+
+# the ModelStores that have not been closed; closed at exit. This keeps a
+# store alive until it is closed, even if nothing else refers to it, since
+# its Crm114 object still points at the staged files.
+openModelStores = set()
+
+def closeModelStores():
+    for store in list(openModelStores):
+        store.close()
+
+atexit.register(closeModelStores)
+
+class ClassificationCache:
+    """
+    A bounded, least-recently-used cache of crm114's classify output, which
+    may be shared by several Crm114 objects. Entries are keyed by a hash of
+    the normalized text, the classifier, and the models. Each model has a
+    generation number that is part of the key, and that Crm114 increments
+    when it learns into the model, so that learning invalidates every cached
+    classification that used the model.
+
+    Holds at most maxEntries entries, and at most maxBytes bytes of output.
+    hits and misses count the lookups that did and did not find an entry.
+    """
+
+    def __init__(self, maxEntries = 10000, maxBytes = 64 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        # maps the absolute path of a model to its generation
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, data, classifier, models):
+        paths = tuple(os.path.abspath(model) for model in models)
+        with self.lock:
+            generations = tuple(self.generations.get(path, 0) for path in
+                paths)
+        return (hashlib.sha1(data).digest(), classifier, paths, generations)
+
+    def get(self, key):
+        """returns the cached output for key, or None"""
+        with self.lock:
+            output = self.entries.pop(key, None)
+            if output == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries[key] = output
+            return output
+
+    def put(self, key, output):
+        with self.lock:
+            if key in self.entries or len(output) > self.maxBytes:
+                return
+            self.entries[key] = output
+            self.bytes += len(output)
+            while (len(self.entries) > self.maxEntries or
+                   self.bytes > self.maxBytes):
+                oldKey, oldOutput = self.entries.popitem(last = False)
+                self.bytes -= len(oldOutput)
+
+    def invalidate(self, model):
+        """invalidates every entry that used model"""
+        path = os.path.abspath(model)
+        with self.lock:
+            self.generations[path] = self.generations.get(path, 0) + 1
+
+    def stats(self):
+        return { "hits" : self.hits, "misses" : self.misses,
+            "entries" : len(self.entries), "bytes" : self.bytes }
+
+class Pending:
+    """
+    The pending result of a call to AsyncCrmRunner.submit, or of a function
+    chained onto one with then(). result() drives the runner until the result
+    is available.
+    """
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.finished = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def finish(self, value = None, error = None):
+        self.finished = True
+        self.value = value
+        self.error = error
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def addCallback(self, callback):
+        """calls callback(self) once self is finished"""
+        if self.finished:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def then(self, function):
+        """
+        returns a Pending for function(self.result()). If function returns a
+        Pending, then the returned Pending finishes when that one does.
+        """
+        chained = Pending(self.runner)
+
+        def callback(pending):
+            if pending.error != None:
+                chained.finish(error = pending.error)
+                return
+            try:
+                value = function(pending.value)
+            except Exception, e:
+                chained.finish(error = e)
+                return
+            if isinstance(value, Pending):
+                value.addCallback(lambda p: chained.finish(p.value, p.error))
+            else:
+                chained.finish(value)
+
+        self.addCallback(callback)
+        return chained
+
+    def result(self):
+        """waits until finished; returns the result or raises the error"""
+        while not self.finished:
+            self.runner.poll()
+        if self.error != None:
+            raise self.error
+        return self.value
+
+class AsyncCrmRunner:
+    """
+    A CrmRunner that runs many crm114 processes at once, from one thread.
+    submit() starts a process (or queues it, if maxInFlight processes are
+    already running) and returns a Pending. poll() waits until some process
+    can make progress, feeds stdin and collects stdout and stderr for every
+    running process, and finishes the Pendings of processes that exit.
+
+    poll() uses select(), which limits the number of open file descriptors;
+    each process uses three, so keep maxInFlight to a few hundred.
+    """
+
+    # bytes written to a process' stdin at a time
+    chunkSize = 65536
+
+    metrics = None
+
+    def __init__(self, maxInFlight = 64, metrics = None):
+        """
+        metrics: an optional Metrics, which times spawn, write and wait. Since
+            processes run concurrently, write and wait are the time each
+            process spends with its stdin open and then until it exits.
+        """
+        self.maxInFlight = maxInFlight
+        self.metrics = metrics
+        # (pending, data, command) tuples that have not yet started
+        self.queued = collections.deque()
+        # maps a file descriptor to the state of the process that owns it
+        self.fds = {}
+        self.running = 0
+
+    def submit(self, data, command):
+        """starts running command on data; returns a Pending for its output"""
+        pending = Pending(self)
+        self.queued.append((pending, data, command))
+        self.startQueued()
+        return pending
+
+    def run(self, data, command):
+        return self.submit(data, command).result()
+
+    def startQueued(self):
+        while len(self.queued) > 0 and self.running < self.maxInFlight:
+            pending, data, command = self.queued.popleft()
+            start = time.time()
+            try:
+                p = subprocess.Popen(command, stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                    close_fds = True)
+            except OSError, e:
+                pending.finish(error = Crm114Error("commond = " + str(command) +
+                    "\n" + str(e)))
+                continue
+            spawned = time.time()
+            if self.metrics != None:
+                self.metrics.observe("spawn", spawned - start)
+            flags = fcntl.fcntl(p.stdin, fcntl.F_GETFL)
+            fcntl.fcntl(p.stdin, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+            state = { "pending" : pending, "command" : command,
+                "process" : p, "data" : data, "written" : 0,
+                "stdout" : [], "stderr" : [], "open" : 3,
+                "spawned" : spawned, "closed" : spawned }
+            for name, f in [("stdin", p.stdin), ("stdout", p.stdout),
+                    ("stderr", p.stderr)]:
+                self.fds[f.fileno()] = (state, name, f)
+            self.running += 1
+            if data == "":
+                self.closeFile(p.stdin.fileno())
+
+    def closeFile(self, fd):
+        state, name, f = self.fds.pop(fd)
+        f.close()
+        if name == "stdin":
+            state["closed"] = time.time()
+        state["open"] -= 1
+        if state["open"] == 0:
+            self.finishProcess(state)
+
+    def finishProcess(self, state):
+        p = state["process"]
+        p.wait()
+        self.running -= 1
+        stdout = "".join(state["stdout"])
+        stderr = "".join(state["stderr"])
+        if self.metrics != None:
+            self.metrics.observe("write", state["closed"] - state["spawned"])
+            self.metrics.observe("wait", time.time() - state["closed"])
+            self.metrics.count("runs")
+            self.metrics.count("bytesIn", len(state["data"]))
+            self.metrics.count("bytesOut", len(stdout))
+        if stderr != "" or p.returncode != 0:
+            state["pending"].finish(error = Crm114Error("commond = " +
+                str(state["command"]) + "\n" + stdout + stderr))
+        else:
+            state["pending"].finish(stdout)
+
+    def poll(self, timeout = None):
+        """
+        waits up to timeout seconds (forever, if None) for processes to make
+        progress, and handles their I/O.
+        """
+        if len(self.fds) == 0:
+            return
+
+        writable = [fd for fd, (state, name, f) in self.fds.iteritems() if
+            name == "stdin"]
+        readable = [fd for fd, (state, name, f) in self.fds.iteritems() if
+            name != "stdin"]
+        readable, writable, _ = select.select(readable, writable, [], timeout)
+
+        for fd in writable:
+            state = self.fds[fd][0]
+            start = state["written"]
+            try:
+                state["written"] += os.write(fd,
+                    state["data"][start : start + self.chunkSize])
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    continue
+                elif e.errno != errno.EPIPE:
+                    raise
+                # the process exited early; its exit status tells why
+                state["written"] = len(state["data"])
+            if state["written"] >= len(state["data"]):
+                self.closeFile(fd)
+
+        for fd in readable:
+            state, name, f = self.fds[fd]
+            chunk = os.read(fd, self.chunkSize)
+            if chunk == "":
+                self.closeFile(fd)
+            else:
+                state[name].append(chunk)
+
+        self.startQueued()
+
 class Crm114:
     """CRM114 wrapper. Provides learn and classify methods."""
 
     def __init__(self, models, classifier = defaultClassifier,
             threshold = None, trainOnError = False, normalizeFunction = None,
-            crmRunner=None):
+            crmRunner=None, cache=None, metrics=None):
         """
         models -- list of all model filenames
         classifer -- a string a describing a valid CRM114 classifer. See CRM114
@@ -223,6 +1079,14 @@ class Crm114:
             makes a mistake when classifying the data.
         normalizeFunction: a function that "normalizes" a string before
             learning or classifying
+        crmRunner: runs the crm114 binary. Default: a new CrmRunner. Pass a
+            PersistentCrmRunner to keep crm114 processes alive across calls.
+        cache: an optional ClassificationCache, which classify() consults
+            before running crm114
+        metrics: an optional Metrics, which times normalizing and parsing.
+            The crmRunner also records its phases there, if it has a metrics
+            attribute that is None (as CrmRunner, PersistentCrmRunner and
+            AsyncCrmRunner do by default).
         """
 
         if len(models) < 2:
@@ -230,27 +1094,58 @@ class Crm114:
         if len(models) > 2 and threshold != None:
             raise ValueError("threshold only makes sense when len(models)==2")
 
-        self.models = models
-
         self.classifier = classifier
         self.threshold = threshold
         self.trainOnError = trainOnError
-        self.normalize = normalizeFunction
+        if normalizeFunction == None:
+            self.normalize = normalize.identity
+        else:
+            self.normalize = normalizeFunction
 
-        self.classifyCommand = [crmBinary, classifyTemplate %
-            { "classifier" : self.classifier, "models" : " ".join(models) }]
+        self.setModels(models)
+        # maps other names for models, e.g. the durable filenames of a
+        # ModelStore, to their filenames in self.models
+        self.aliases = {}
 
         if crmRunner == None:
-            self.crmRunner = CrmRunner()
+            self.crmRunner = CrmRunner(metrics)
         else:
             self.crmRunner = crmRunner
+            if (metrics != None and hasattr(crmRunner, "metrics") and
+                    crmRunner.metrics == None):
+                crmRunner.metrics = metrics
+
+        self.cache = cache
+        self.metrics = metrics
+
+    def setModels(self, models):
+        """
+        changes the model filenames to models, which must be in the same order
+        as self.models
+        """
+        self.models = models
+        self.classifyCommand = [crmBinary, classifyTemplate %
+            { "classifier" : self.classifier, "models" : " ".join(models) }]
+
+    def copy(self, models, crmRunner = None):
+        """
+        returns a new Crm114 with the same settings as self, but which uses
+        models instead of self.models, and crmRunner (if not None) instead of
+        self.crmRunner
+        """
+        if crmRunner == None:
+            crmRunner = self.crmRunner
+        return Crm114(models, self.classifier, self.threshold,
+            self.trainOnError, self.normalize, crmRunner, self.cache,
+            self.metrics)
 
     def postprocess(self, classification, threshold):
         """
         post-process classification according to threshold
         """
         if threshold == None:
-            newModel = classification.bestMatch.model
+            # keep crm114's bestMatch
+            return
         elif classification.model[self.models[0]].pr >= threshold:
             newModel = self.models[0]
         else:
@@ -258,46 +1153,557 @@ class Crm114:
 
         classification.bestMatch = classification.model[newModel]
 
+    def normalizeText(self, data):
+        """
+        returns self.normalize(data), unless data is a normalize.NormalizedText
+        that has already been normalized by the same pipeline. A
+        NormalizedText from another pipeline is normalized again.
+        """
+        if (isinstance(data, normalize.NormalizedText) and
+                data.pipeline != None and
+                data.pipeline == normalize.pipelineKey(self.normalize)):
+            return data
+        if self.metrics == None:
+            return self.normalize(data)
+        with self.metrics.timer("normalize"):
+            return self.normalize(data)
+
     def preprocess(self, data):
         """
         override this to pre-process strings before classifying or learning
         """
         return data
 
+    def modelFile(self, model):
+        """returns the filename of model, which may be an alias"""
+        return self.aliases.get(model, model)
+
+    def learnCommand(self, model):
+        """returns the command that learns stdin into model"""
+        if model not in self.models:
+            raise ValueError("Invalid model file: %s" % model)
+        return [ crmBinary, learnTemplate % { "classifier" : self.classifier,
+                                              "model" : model} ]
+
+    def learnOnErrorCommand(self, model):
+        """
+        returns the command that classifies stdin, and learns it into model
+        only if the best match is not model
+        """
+        if model not in self.models:
+            raise ValueError("Invalid model file: %s" % model)
+        return [ crmBinary, learnOnErrorTemplate % {
+            "classifier" : self.classifier, "models" : " ".join(self.models),
+            "model" : model, "modelRe" : crmRegexEscape(model),
+            "learned" : learnedMarker, "notLearned" : notLearnedMarker } ]
+
+    def runMany(self, documents, command):
+        """
+        runs command on each of documents, with a single crm114 process if
+        self.crmRunner supports it
+        """
+        if hasattr(self.crmRunner, "runMany"):
+            return self.crmRunner.runMany(documents, command)
+        else:
+            return [self.crmRunner.run(data, command) for data in documents]
+
+    def parseClassification(self, output):
+        """
+        returns the Classification for output, the output of crm114's
+        classify, post-processed according to self.threshold
+        """
+        if self.metrics == None:
+            c = Classification(output)
+            self.postprocess(c, self.threshold)
+            return c
+        with self.metrics.timer("parse"):
+            c = Classification(output)
+            self.postprocess(c, self.threshold)
+            return c
+
+    def cacheKey(self, data):
+        return self.cache.key(data, self.classifier, self.models)
+
+    def learned(self, model):
+        """invalidates cached classifications, after learning into model"""
+        if self.cache != None:
+            self.cache.invalidate(model)
+
+    def classifyOutput(self, data):
+        """returns crm114's classify output for data, which is normalized"""
+        if self.cache == None:
+            return self.crmRunner.run(data, self.classifyCommand)
+
+        key = self.cacheKey(data)
+        output = self.cache.get(key)
+        if output == None:
+            output = self.crmRunner.run(data, self.classifyCommand)
+            self.cache.put(key, output)
+        return output
+
     def classify(self, data):
         """return the Classification from running crm114 on data"""
         
-        data = self.normalize(data)
-        c = Classification(self.crmRunner.run(data, self.classifyCommand))
+        data = self.normalizeText(data)
+        return self.parseClassification(self.classifyOutput(data))
 
-        self.postprocess(c, self.threshold)
+    def classifyMany(self, documents):
+        """
+        classifies every document in the iterable documents with a single
+        crm114 invocation. Returns the list of Classifications, in the same
+        order as documents.
+        """
 
-        return c
+        documents = [self.normalizeText(data) for data in documents]
+        if len(documents) == 0:
+            return []
+
+        if self.cache == None:
+            outputs = self.runMany(documents, self.classifyCommand)
+        else:
+            keys = [self.cacheKey(data) for data in documents]
+            outputs = [self.cache.get(key) for key in keys]
+            # maps each missed key to the indexes of its documents, so that
+            # duplicates are only classified once
+            misses = collections.OrderedDict()
+            for i, output in enumerate(outputs):
+                if output == None:
+                    misses.setdefault(keys[i], []).append(i)
+            if len(misses) > 0:
+                for (key, indexes), output in zip(misses.iteritems(),
+                        self.runMany([documents[indexes[0]] for indexes in
+                        misses.itervalues()], self.classifyCommand)):
+                    for i in indexes:
+                        outputs[i] = output
+                    self.cache.put(key, output)
+
+        return [self.parseClassification(output) for output in outputs]
 
     def learn(self, data, model):
         """
         returns True if learned; returns False otherwise
         """
 
-        data = self.normalize(data)
+        model = self.modelFile(model)
+        if self.trainOnError:
+            return self.learnOnError(data, model)[0]
+
+        data = self.normalizeText(data)
+        self.crmRunner.run(data, self.learnCommand(model))
+        self.learned(model)
+        return True
+
+    def merge(self, model, sources):
+        """
+        merges the model files in sources into model, with mergeModels and
+        self.crmRunner. Replaces model, if it exists.
+        """
+        model = self.modelFile(model)
+        if model not in self.models:
+            raise ValueError("Invalid model file: %s" % model)
+        mergeModels(model, sources, self.crmRunner)
+        self.learned(model)
+
+    def parseLearnOnError(self, output):
+        """
+        returns (learned, classification) for output, the output of
+        learnOnErrorCommand()
+        """
+        output, marker, end = output.rsplit("\n", 2)
+        if end != "" or marker not in [learnedMarker, notLearnedMarker]:
+            raise Crm114Error("Could not parse learn on error output: %s" %
+                output)
+        return (marker == learnedMarker, self.parseClassification(output))
+
+    def learnOnError(self, data, model):
+        """
+        learns data into model only if the classifier makes a mistake when
+        classifying data. Classifies and learns with a single crm114 process,
+        unless self.threshold != None, in which case the threshold is applied
+        before deciding whether to learn.
+        returns (learned, classification), where learned is True if learned,
+        and classification is the Classification of data before learning. If
+        some model file does not exist yet, then data is always learned, and
+        classification is None.
+        """
+
+        model = self.modelFile(model)
+        data = self.normalizeText(data)
 
         # true iff every model file exists
-        allAvailable = all(os.path.exists(model) for model in self.models)
-
-        if (self.trainOnError and allAvailable and
-            self.classify(data).bestMatch != None and
-            self.classify(data).bestMatch.model == model):
-            # no need to learn because the classifier already knows how to
-            # correctly classify data
-            return False
+        allAvailable = all(os.path.exists(m) for m in self.models)
+
+        if not allAvailable:
+            self.crmRunner.run(data, self.learnCommand(model))
+            self.learned(model)
+            return (True, None)
+
+        if self.threshold != None:
+            classification = self.parseClassification(
+                self.classifyOutput(data))
+            learned = classification.bestMatch.model != model
+            if learned:
+                self.crmRunner.run(data, self.learnCommand(model))
         else:
+            output = self.crmRunner.run(data, self.learnOnErrorCommand(model))
+            learned, classification = self.parseLearnOnError(output)
+
+        if learned:
+            self.learned(model)
+        return (learned, classification)
+
+    def asyncRunner(self):
+        if not hasattr(self.crmRunner, "submit"):
+            raise ValueError("crmRunner must be an AsyncCrmRunner")
+        return self.crmRunner
+
+    def aclassify(self, data):
+        """
+        like classify, except returns immediately with a Pending, whose
+        result() is the Classification. Requires an AsyncCrmRunner.
+        """
+        runner = self.asyncRunner()
+        data = self.normalizeText(data)
+
+        if self.cache == None:
+            return runner.submit(data, self.classifyCommand).then(
+                self.parseClassification)
+
+        key = self.cacheKey(data)
+        output = self.cache.get(key)
+        if output != None:
+            pending = Pending(runner)
+            pending.finish(output)
+        else:
+            def put(output):
+                self.cache.put(key, output)
+                return output
+            pending = runner.submit(data, self.classifyCommand).then(put)
+        return pending.then(self.parseClassification)
+
+    def alearn(self, data, model):
+        """
+        like learn, except returns immediately with a Pending, whose result()
+        is True if learned and False otherwise. Requires an AsyncCrmRunner.
+        """
+        runner = self.asyncRunner()
+        model = self.modelFile(model)
+        data = self.normalizeText(data)
+        command = self.learnCommand(model)
+
+        allAvailable = all(os.path.exists(m) for m in self.models)
+
+        def learned(output):
+            self.learned(model)
+            return True
+
+        if not (self.trainOnError and allAvailable):
+            return runner.submit(data, command).then(learned)
+
+        if self.threshold == None:
+            def learnedOnError(output):
+                learned = self.parseLearnOnError(output)[0]
+                if learned:
+                    self.learned(model)
+                return learned
+            return runner.submit(data, self.learnOnErrorCommand(model)).then(
+                learnedOnError)
+
+        def learnOnError(classification):
+            if (classification.bestMatch != None and
+                classification.bestMatch.model == model):
+                return False
+            return runner.submit(data, command).then(learned)
+
+        return runner.submit(data, self.classifyCommand).then(
+            self.parseClassification).then(learnOnError)
+
+    def learnMany(self, items):
+        """
+        items is an iterable of (data, model) pairs. Learns each data into its
+        model, using a single crm114 process per model. Within each model,
+        items are learned in order.
+        returns a list that holds, for each item, True if learned and False
+        otherwise
+
+        if self.trainOnError, then whether or not an item is learned depends on
+        the items learned before it, so every item is learned with learn(), in
+        order.
+        """
+
+        items = list(items)
+
+        if self.trainOnError:
+            return [self.learn(data, model) for data, model in items]
+
+        groups = collections.OrderedDict()
+        for data, model in items:
+            model = self.modelFile(model)
             if model not in self.models:
                 raise ValueError("Invalid model file: %s" % model)
-            command = [ crmBinary,
-                        learnTemplate % { "classifier" : self.classifier,
-                                          "model" : model} ]
-            self.crmRunner.run(data, command)
-            return True
+            groups.setdefault(model, []).append(self.normalizeText(data))
+
+        for model, documents in groups.iteritems():
+            self.runMany(documents, self.learnCommand(model))
+            self.learned(model)
+
+        return [True] * len(items)
+
+class BatchScheduler:
+    """
+    Merges concurrent calls to classify() into calls to crm.classifyMany().
+    classify() may be called from many threads at once; it queues data and
+    blocks until its Classification is ready. A background thread waits for
+    the first queued document, gathers more for up to window seconds, or
+    until it has maxBatch documents, and classifies them with one crm114
+    invocation. So each call waits at most window seconds longer than it
+    would otherwise, but under load, many calls share one crm114 process.
+
+    crm should only be used through the scheduler while it runs. Once the
+    scheduler is closed, classify() raises Crm114Error.
+    """
+
+    # seconds between checks for a finished request; waiting without a
+    # timeout would keep Python 2 from delivering KeyboardInterrupt
+    pollInterval = 0.1
+
+    def __init__(self, crm, window = 0.005, maxBatch = 64):
+        self.crm = crm
+        self.window = window
+        self.maxBatch = maxBatch
+        self.queue = Queue.Queue()
+        # guards closed, so that no request is queued after close's sentinel
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def classify(self, data):
+        """returns the Classification of data"""
+        request = {"data" : data, "done" : threading.Event(), "value" : None,
+            "error" : None}
+        with self.lock:
+            if self.closed:
+                raise Crm114Error("the BatchScheduler is closed")
+            self.queue.put(request)
+        while not request["done"].is_set():
+            request["done"].wait(self.pollInterval)
+        if request["error"] != None:
+            raise request["error"]
+        return request["value"]
+
+    def gather(self):
+        """returns the next batch of requests; [] means close"""
+        first = self.queue.get()
+        if first == None:
+            return []
+        batch = [first]
+        deadline = time.time() + self.window
+        while len(batch) < self.maxBatch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout = timeout)
+            except Queue.Empty:
+                break
+            if request == None:
+                # finish this batch, then close
+                self.queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def serve(self):
+        while True:
+            batch = self.gather()
+            if batch == []:
+                return
+            try:
+                classifications = self.crm.classifyMany(
+                    [request["data"] for request in batch])
+                for request, classification in zip(batch, classifications):
+                    request["value"] = classification
+            except Exception, e:
+                for request in batch:
+                    request["error"] = e
+            for request in batch:
+                request["done"].set()
+
+    def close(self):
+        """classifies the queued requests, then stops the background thread"""
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self.queue.put(None)
+        self.thread.join()
+
+def removeStaleSocket(path):
+    """
+    removes path, if it is a Unix domain socket that no server is accepting
+    connections on. Raises Crm114Error if path is not a socket, or if a server
+    is still listening on it.
+    """
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise Crm114Error("%s exists and is not a socket" % path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error, e:
+        if e.errno != errno.ECONNREFUSED:
+            raise
+        os.remove(path)
+    else:
+        raise Crm114Error("a server is already listening on %s" % path)
+    finally:
+        probe.close()
+
+class Crm114Server(SocketServer.ThreadingUnixStreamServer):
+    """
+    A local classification server, listening on the Unix domain socket path.
+    Holds a pool of copies of crm, each with its own crmRunner() (by default,
+    a PersistentCrmRunner, so the crm114 processes stay warm), and serves
+    each request with one of them. So at most workers requests run at once.
+
+    The protocol is newline-delimited JSON. Each request is one of:
+
+        {"op": "classify", "data": TEXT}
+        {"op": "learn", "data": TEXT, "model": MODEL}
+
+    and is answered, in order, with Classification.dict() for classify,
+    {"learned": true|false} for learn, or {"error": MESSAGE}. See
+    Crm114Client.
+
+    Learning waits for every worker to be idle, and then restarts the other
+    workers' crm114 processes, which would otherwise hold stale models.
+
+    The socket is created with mode (by default, only its owner may connect).
+    A stale socket left at path by a server that exited is replaced, but if
+    another server is listening on path, then Crm114Error is raised.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, crm, workers = 4, crmRunner = PersistentCrmRunner,
+            mode = 0600):
+        removeStaleSocket(path)
+        self.path = path
+        self.mode = mode
+        SocketServer.ThreadingUnixStreamServer.__init__(self, path,
+            Crm114RequestHandler)
+        self.models = crm.models
+        self.workers = workers
+        self.pool = Queue.Queue()
+        for i in xrange(workers):
+            worker = crm.copy(crm.models)
+            worker.crmRunner = crmRunner()
+            self.pool.put(worker)
+        self.learnLock = threading.Lock()
+
+    def server_bind(self):
+        # the umask keeps the socket from ever being more open than self.mode
+        umask = os.umask(0777 & ~self.mode)
+        try:
+            SocketServer.ThreadingUnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, self.mode)
+
+    def classify(self, data):
+        worker = self.pool.get()
+        try:
+            return worker.classify(data)
+        finally:
+            self.pool.put(worker)
+
+    def learn(self, data, model):
+        with self.learnLock:
+            workers = [self.pool.get() for i in xrange(self.workers)]
+            try:
+                learned = workers[0].learn(data, model)
+                if learned:
+                    for worker in workers[1:]:
+                        if hasattr(worker.crmRunner, "close"):
+                            worker.crmRunner.close()
+                return learned
+            finally:
+                for worker in workers:
+                    self.pool.put(worker)
+
+    def answer(self, request):
+        """returns the reply to request, a dict"""
+        op = request.get("op")
+        data = request["data"]
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        if op == "classify":
+            return self.classify(data).dict()
+        elif op == "learn":
+            return {"learned" : self.learn(data, str(request["model"]))}
+        else:
+            raise ValueError("unknown op: %s" % op)
+
+    def server_close(self):
+        SocketServer.ThreadingUnixStreamServer.server_close(self)
+        while not self.pool.empty():
+            worker = self.pool.get_nowait()
+            if hasattr(worker.crmRunner, "close"):
+                worker.crmRunner.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Crm114RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+                reply = self.server.answer(request)
+            except Exception, e:
+                reply = {"error" : "%s: %s" % (e.__class__.__name__, e)}
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class Crm114Client:
+    """
+    A client for Crm114Server. Requests on one client are answered in order.
+    Data must be UTF-8 text.
+    """
+
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.rfile = self.socket.makefile("rb")
+        self.wfile = self.socket.makefile("wb")
+
+    def request(self, request):
+        """sends request, a dict, and returns the reply"""
+        self.wfile.write(json.dumps(request) + "\n")
+        self.wfile.flush()
+        line = self.rfile.readline()
+        if line == "":
+            raise Crm114Error("server closed the connection")
+        reply = json.loads(line)
+        if "error" in reply:
+            raise Crm114Error(reply["error"])
+        return reply
+
+    def classify(self, data):
+        """returns the server's Classification of data, as a dict"""
+        return self.request({"op" : "classify", "data" : data})
+
+    def learn(self, data, model):
+        """returns True if learned; returns False otherwise"""
+        return self.request({"op" : "learn", "data" : data,
+            "model" : model})["learned"]
+
+    def close(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.socket.close()
 
 if __name__ == "__main__":
 
@@ -318,8 +1724,38 @@ if __name__ == "__main__":
         help="A list of normalize functions, e.g. 'lower startEnd'; see " +
              "normalize.py. Before learning or classifying, the input string" +
              "will be passed through each normalize function, in order.")
+    parser.add_argument("--serve", metavar="SOCKET",
+        help="with --classify MODELS, rather than reading stdin, serve " +
+             "classify and learn requests for MODELS on the Unix domain " +
+             "socket SOCKET; see Crm114Server")
+    parser.add_argument("--workers", type=int, default=4,
+        help="with --serve, keep WORKERS warm crm114 workers, and serve at " +
+             "most WORKERS requests at once. Default: %(default)s")
     args = parser.parse_args()
 
+    if args.serve != None:
+        if args.classify == None:
+            sys.stderr.write("--serve requires --classify MODELS\n")
+            parser.print_help()
+            sys.exit(1)
+
+        f = normalize.makeNormalizeFunction(args.normalize)
+        crm = Crm114(args.classify, args.classifier, args.threshold, args.toe,
+            f)
+        server = Crm114Server(args.serve, crm, args.workers)
+
+        def terminate(signum, frame):
+            sys.exit(0)
+        signal.signal(signal.SIGTERM, terminate)
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        sys.exit(0)
+
     if args.learn == None and args.classify == None :
         parser.print_help()
         sys.exit(1)
@@ -20,8 +20,31 @@ Normalization funcions. Each normalization function pre-processes a string
 before learning and classification.
 """
 
+import hashlib
 import re
 import string
+import types
+
+class NormalizedText(str):
+    """
+    a string that has already been normalized, e.g. when a corpus is loaded,
+    by the normalize function whose pipelineKey is pipeline. A Crm114 whose
+    normalize function has the same (not None) pipelineKey learns and
+    classifies it as is, rather than normalizing it again.
+    """
+
+    def __new__(cls, text, pipeline = None):
+        self = str.__new__(cls, text)
+        self.pipeline = pipeline
+        return self
+
+# pipelines worth comparing, e.g. with corpus.py --search; each is a list of
+# normalize function names, suitable for makeNormalizeFunction
+pipelines = [
+    None,
+    ["lower"],
+    ["lower", "rmPunctuation"],
+    ["echen"]]
 
 def functionObjects(functions):
     """
@@ -39,7 +62,7 @@ def makeNormalizeFunction(functions):
 
     if functions == None, then returns the identity function
     if functions is a list of functions (or function names), yield a function
-        that calls each function in succession.
+        that calls each function in succession. See compileNormalizeFunction.
     """
 
     if functions == None:
@@ -57,9 +80,141 @@ def makeNormalizeFunction(functions):
         if not functionObjects(functions):
             raise ValueError("functions contains a non-function object")
 
-        def normalize(string):
-            return reduce(lambda string, f: f(string), functions, string)
-        return normalize    
+        return compileNormalizeFunction(functions)
+
+# compiled normalize functions, by the tuple of functions they were compiled
+# from
+compiledFunctions = {}
+
+# maps each compiled normalize function to its pipelineKey
+pipelineKeys = {}
+
+def pipelineKey(function):
+    """
+    returns a picklable key for the normalize function, which is the same in
+    every process: for a function made by makeNormalizeFunction, the
+    functionKey of each function it was compiled from (identity aside). Else,
+    or if some function has no functionKey, returns None.
+    """
+    return pipelineKeys.get(function)
+
+def codeDigest(code):
+    """returns a hex digest of a code object's bytecode, constants and names"""
+    digest = hashlib.sha1(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            digest.update(codeDigest(const))
+        else:
+            digest.update(repr(const))
+    digest.update(repr(code.co_names))
+    return digest.hexdigest()
+
+def functionKey(function):
+    """
+    returns (module, name, codeDigest) for function, or None if function has
+    no stable identity: if it is a lambda, a closure, or not a Python function
+    """
+    code = getattr(function, "func_code", None)
+    if (code == None or function.__name__ == "<lambda>" or
+            function.func_closure != None):
+        return None
+    return (function.__module__, function.__name__, codeDigest(code))
+
+def chain(functions):
+    """returns a function that calls each function in succession"""
+    def normalize(string):
+        for f in functions:
+            string = f(string)
+        return string
+    return normalize
+
+def fuse(lowercase, punctuation, prefix, suffix, functions):
+    """
+    returns a function equivalent to chain(functions), which are all known
+    normalize functions, that returns prefix + s' + suffix, where s' is s,
+    lower-cased iff lowercase, with punctuation removed iff punctuation.
+    Falls back to chain(functions) for unicode strings, which str.translate
+    does not handle the same way.
+    """
+
+    table = string.maketrans(string.ascii_uppercase,
+        string.ascii_lowercase) if lowercase else None
+    delete = string.punctuation if punctuation else ""
+    slow = chain(functions)
+
+    if table == None and delete == "":
+        def normalize(s):
+            if isinstance(s, unicode):
+                return slow(s)
+            return prefix + s + suffix
+    else:
+        def normalize(s):
+            if isinstance(s, unicode):
+                return slow(s)
+            return prefix + s.translate(table, delete) + suffix
+    return normalize
+
+def compileNormalizeFunction(functions):
+    """
+    compiles functions, a list of function objects, into a single normalize
+    function equivalent to calling each function in succession.
+
+    Runs of known normalize functions are fused into one pass: lower and
+    rmPunctuation become a single str.translate, and every startEnd becomes a
+    constant prefix and suffix, which are added in one concatenation. (Since
+    translation works character by character, a startEnd that comes before a
+    lower or rmPunctuation is simply translated at compile time.) Any other
+    function is called as is, between the fused runs.
+
+    Compiled functions are memoized by functions.
+    """
+
+    key = tuple(functions)
+    if key in compiledFunctions:
+        return compiledFunctions[key]
+
+    steps = []
+    for f in functions:
+        steps += [lower, rmPunctuation, startEnd] if f == echen else [f]
+
+    stages = []
+    run = []
+    lowercase = punctuation = False
+    prefix = suffix = ""
+    for f in steps + [None]:
+        if f == identity:
+            continue
+        elif f == lower:
+            lowercase = True
+            prefix, suffix = lower(prefix), lower(suffix)
+        elif f == rmPunctuation:
+            punctuation = True
+            prefix, suffix = rmPunctuation(prefix), rmPunctuation(suffix)
+        elif f == startEnd:
+            prefix, suffix = "START " + prefix, suffix + " END"
+        else:
+            if len(run) > 0:
+                stages.append(fuse(lowercase, punctuation, prefix, suffix, run))
+            if f != None:
+                stages.append(f)
+            run = []
+            lowercase = punctuation = False
+            prefix = suffix = ""
+            continue
+        run.append(f)
+
+    if len(stages) == 0:
+        normalize = identity
+    elif len(stages) == 1:
+        normalize = stages[0]
+    else:
+        normalize = chain(stages)
+
+    compiledFunctions[key] = normalize
+    keys = tuple(functionKey(f) for f in functions if f != identity)
+    if None not in keys:
+        pipelineKeys[normalize] = keys
+    return normalize
 
 # Normalize functions
 ###############################################################################
@@ -80,3 +235,5 @@ def startEnd(string):
 def echen(string):
     return startEnd(rmPunctuation(lower(string)))
 
+
+pipelineKeys[identity] = ()
@@ -0,0 +1,298 @@
+#
+# Copyright 2012 Michael N. Gagnon
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""
+An in-process OSB (Orthogonal Sparse Bigram) classifier, for hosts where the
+crm binary is not installed. OsbRunner is a drop-in replacement for CrmRunner:
+it interprets the classify, learn, learn on error and loop programs that
+crm114.py generates, and answers in crm114's output format, so Crm114 returns
+the same Classification objects:
+
+    crm = crm114.Crm114(models, crmRunner = osb.OsbRunner())
+
+Its models are not crm114 .css files, so the two cannot be mixed.
+
+Features: each pair of whitespace-delimited tokens up to 4 tokens apart, as
+in crm114's OSB, hashed into a fixed number of buckets. With "unique", each
+feature counts once per document. With "unigram", the features are the
+tokens. "microgroom" is accepted, but has no effect, since the buckets never
+grow.
+
+Classification: each model's probability is the naive Bayes product of a
+smoothed local probability for each feature, normalized over the models;
+pR = log10(p) - log10(1 - p).
+
+Model files: a header, then one unsigned 32-bit count per bucket. Files are
+memory-mapped; learning updates the touched buckets in place, and bumps a
+generation number in the header, so that every OsbRunner notices the change.
+"""
+
+import crm114
+
+import array
+import math
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+
+headerFormat = "<8sIIIQ"  # magic, buckets, generation, documents, features
+headerSize = struct.calcsize(headerFormat)
+magic = "CRMPYOSB"
+defaultBuckets = 1 << 18
+maxCount = 0xffffffff
+
+# the multiplier for each distance between the two tokens of a feature
+distanceMultipliers = [0, 0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F]
+
+classifyRe = re.compile(r"classify <([^>]*)> \(([^)]*)\)")
+learnRe = re.compile(r"learn <([^>]*)> \( (\S+) \)")
+
+def features(data, unique = True, unigram = False, buckets = defaultBuckets):
+    """returns the list of feature buckets for data"""
+    hashes = [zlib.crc32(token) & 0xffffffff for token in data.split()]
+    if unigram:
+        result = [h % buckets for h in hashes]
+    else:
+        result = []
+        for i, h in enumerate(hashes):
+            for d in xrange(1, min(i, 4) + 1):
+                result.append(((hashes[i - d] * distanceMultipliers[d] + h) &
+                    0xffffffff) % buckets)
+    if unique:
+        result = list(set(result))
+    return result
+
+class OsbModel:
+    """a memory-mapped model file"""
+
+    def __init__(self, path, buckets = defaultBuckets, create = False):
+        """
+        opens the model file at path. If create and it does not exist, creates
+        it with buckets buckets.
+        """
+        if create and not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(struct.pack(headerFormat, magic, buckets, 0, 0, 0))
+                f.truncate(headerSize + 4 * buckets)
+
+        self.path = path
+        with open(path, "r+b") as f:
+            self.identity = self.stat()
+            self.map = mmap.mmap(f.fileno(), 0)
+
+        header = struct.unpack_from(headerFormat, self.map)
+        if header[0] != magic:
+            raise crm114.Crm114Error("%s is not an OSB model file" % path)
+        self.buckets = header[1]
+        self.generation = None
+        self.refresh()
+
+    def stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_dev, stat.st_ino)
+
+    def header(self):
+        """returns (generation, documents, features)"""
+        return struct.unpack_from(headerFormat, self.map)[2:]
+
+    def refresh(self):
+        """reloads the counts if the file was learned into since last time"""
+        generation, self.documents, self.features = self.header()
+        if generation != self.generation:
+            self.counts = array.array('I')
+            self.counts.fromstring(self.map[headerSize : headerSize + 4 *
+                self.buckets])
+            self.generation = generation
+
+    def learn(self, buckets):
+        """adds one to the count of each bucket in buckets"""
+        self.refresh()
+        for b in buckets:
+            if self.counts[b] < maxCount:
+                self.counts[b] += 1
+                struct.pack_into("<I", self.map, headerSize + 4 * b,
+                    self.counts[b])
+        self.generation += 1
+        self.documents += 1
+        self.features += len(buckets)
+        struct.pack_into(headerFormat, self.map, 0, magic, self.buckets,
+            self.generation, self.documents, self.features)
+
+    def merge(self, source):
+        """adds the counts of source, another OsbModel, into this model"""
+        if source.buckets != self.buckets:
+            raise crm114.Crm114Error("cannot merge %s into %s: different sizes"
+                % (source.path, self.path))
+        self.refresh()
+        source.refresh()
+        for b, count in enumerate(source.counts):
+            if count > 0:
+                self.counts[b] = min(maxCount, self.counts[b] + count)
+        self.map[headerSize:] = self.counts.tostring()
+        self.generation += 1
+        self.documents += source.documents
+        self.features += source.features
+        struct.pack_into(headerFormat, self.map, 0, magic, self.buckets,
+            self.generation, self.documents, self.features)
+
+    def close(self):
+        self.map.close()
+
+def formatClassification(models, buckets):
+    """
+    classifies data against models, a list of (name, OsbModel) pairs, and
+    returns the result in crm114's classify output format
+    """
+
+    logs = [0.0] * len(models)
+    hits = [0] * len(models)
+    n = len(models)
+    for b in buckets:
+        counts = [model.counts[b] for name, model in models]
+        total = sum(counts)
+        if total == 0:
+            continue
+        for i, count in enumerate(counts):
+            hits[i] += count
+            logs[i] += math.log((count + 0.5) / (total + 0.5 * n))
+
+    # normalize in log space, so that tiny probabilities do not underflow
+    high = max(logs)
+    logTotal = high + math.log(sum(math.exp(l - high) for l in logs))
+    matches = []
+    for i, (name, model) in enumerate(models):
+        others = [l for j, l in enumerate(logs) if j != i]
+        othersHigh = max(others)
+        logOthers = othersHigh + math.log(sum(math.exp(l - othersHigh) for l
+            in others))
+        prob = math.exp(logs[i] - logTotal)
+        pr = (logs[i] - logOthers) / math.log(10)
+        matches.append((name, model.features, hits[i], prob, pr))
+
+    best = max(xrange(n), key = lambda i: matches[i][3])
+    name, modelFeatures, modelHits, prob, pr = matches[best]
+    output = ("CLASSIFY succeeds; success probability: %.4f  pR: %.4f\n" +
+        "Best match to file #%d (%s) prob: %.4f  pR: %.4f  \n" +
+        "Total features in input file: %d\n") % (prob, pr, best, name, prob,
+        pr, len(buckets))
+    for i, (name, modelFeatures, modelHits, prob, pr) in enumerate(matches):
+        output += ("#%d (%s): features: %d, hits: %d, prob: %.2e, " +
+            "pR: %6.2f \n") % (i, name, modelFeatures, modelHits, prob, pr)
+    return output
+
+class OsbRunner(crm114.CrmRunner):
+    """
+    runs crm114.py's programs in process, with an OSB classifier; see the
+    module docstring. Also understands the cssmerge command of
+    crm114.mergeModels, and merges by adding counts.
+
+    buckets: the number of buckets in the model files it creates
+    metrics: an optional crm114.Metrics, which times the classify and learn
+        phases of each document
+    """
+
+    def __init__(self, buckets = defaultBuckets, metrics = None):
+        crm114.CrmRunner.__init__(self, metrics)
+        self.buckets = buckets
+        self.models = {}
+
+    def model(self, path, create = False):
+        """returns the OsbModel for path, reopening it if the file changed"""
+        model = self.models.get(path)
+        if model != None:
+            try:
+                if model.stat() == model.identity:
+                    model.refresh()
+                    return model
+            except OSError:
+                pass
+            model.close()
+            del self.models[path]
+        if not create and not os.path.exists(path):
+            raise crm114.Crm114Error("model file %s does not exist" % path)
+        model = OsbModel(path, self.buckets, create)
+        self.models[path] = model
+        return model
+
+    def close(self):
+        for model in self.models.values():
+            model.close()
+        self.models = {}
+
+    def copy(self):
+        """returns a new OsbRunner, which shares no open models"""
+        return OsbRunner(self.buckets, self.metrics)
+
+    def observe(self, phase, start):
+        """records the time since start as phase, if self.metrics != None"""
+        if self.metrics != None:
+            self.metrics.observe(phase, time.time() - start)
+
+    def answer(self, data, program):
+        """returns the output of program, a single-document program, for data"""
+
+        classify = classifyRe.search(program)
+        learn = learnRe.search(program)
+        classifier = (classify or learn).group(1).split()
+        if len(classifier) == 0 or classifier[0] != "osb":
+            raise crm114.Crm114Error("OsbRunner only supports osb " +
+                "classifiers, not '%s'" % " ".join(classifier))
+        unique = "unique" in classifier
+        unigram = "unigram" in classifier
+        if self.metrics != None:
+            self.metrics.count("runs")
+            self.metrics.count("bytesIn", len(data))
+
+        output = ""
+        if classify:
+            start = time.time()
+            models = [(name, self.model(name)) for name in
+                classify.group(2).split()]
+            buckets = features(data, unique, unigram, models[0][1].buckets)
+            output = formatClassification(models, buckets)
+            self.observe("classify", start)
+            if crm114.learnedMarker in program:
+                if re.match(r"[^\n]*\nBest match to file #\d+ \(%s\)" %
+                        re.escape(learn.group(2)), output):
+                    return output + "\n%s\n" % crm114.notLearnedMarker
+                output += "\n%s\n" % crm114.learnedMarker
+            else:
+                return output
+
+        start = time.time()
+        model = self.model(learn.group(2), create = True)
+        model.learn(features(data, unique, unigram, model.buckets))
+        self.observe("learn", start)
+        return output
+
+    def run(self, data, command):
+        if command[0] == crm114.cssmergeBinary:
+            self.model(command[1]).merge(self.model(command[2]))
+            return ""
+
+        program = command[-1]
+        if crm114.documentDelimiter not in program:
+            return self.answer(data, program)
+
+        terminator = crm114.documentDelimiter + "\n"
+        return "".join(self.answer(document, program) + "\n" + terminator for
+            document in data.split(terminator)[:-1])
+
+    def runMany(self, documents, command):
+        return [self.answer(document, command[-1]) for document in documents]
@@ -18,12 +18,240 @@
 from corpus import *
 from crm114 import *
 import mock
+import normalize
+import osb
 
+import corpus
+import crm114
+import logging
+import os
+import pickle
 import pprint
+import random
+import re
+import shutil
+import tempfile
 import unittest
 
+class MockCrmRunner:
+    """
+    classifies "ham..." documents as the first model, and everything else as
+    the second model. Ignores learning.
+    """
+    def run(self, data, command):
+        match = re.search(r"classify <[^>]*> \((.*?)\)", command[-1])
+        if not match:
+            return ""
+        ham, spam = match.group(1).split()
+        if data.startswith("ham"):
+            return mock.classificationString(
+                [mock.model(ham, pr=10.0),
+                 mock.model(spam, pr=-10.0)])
+        else:
+            return mock.classificationString(
+                [mock.model(ham, pr=-10.0),
+                 mock.model(spam, pr=10.0)])
+
+class MockSearchCrmRunner(MockCrmRunner):
+    """
+    like MockCrmRunner, but the Markovian classifier classifies every document
+    as the second model, and the "bogus" classifier fails
+    """
+    def run(self, data, command):
+        if "<bogus>" in command[-1]:
+            raise Crm114Error("unsupported classifier")
+        if "classify <>" in command[-1]:
+            data = "spam"
+        return MockCrmRunner.run(self, data, command)
+
+logger = logging.getLogger("test_corpus")
+
 class TestCorpus(unittest.TestCase):
 
+    def test_classify(self):
+        crm = Crm114(["ham.css", "spam.css"], crmRunner = MockCrmRunner())
+        for workers in [None, 1, 3]:
+            items = [LabeledItem("ham%d" % i, "ham.css") for i in range(10)] + \
+                [LabeledItem("spam%d" % i, "spam.css") for i in range(7)]
+            crm.metrics = crm114.Metrics()
+            self.assertEqual(classify(crm, items, logger, workers = workers),
+                items)
+            for item in items:
+                self.assertEqual(item.classification.bestMatch.model,
+                    item.actualModel)
+            # the workers' metrics are merged back
+            self.assertEqual(crm.metrics.dict()["phases"]["parse"]["count"],
+                len(items))
+
+    def test_limitItems(self):
+        self.assertEqual(limitItems([3, 1, 2], None), [3, 1, 2])
+        self.assertEqual(sorted(limitItems(iter(range(5)), 10)), range(5))
+        sample = limitItems(xrange(1000), 10)
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(len(set(sample)), 10)
+
+    def test_classifyStream(self):
+        testDir = tempfile.mkdtemp()
+        streamChunkSize = corpus.streamChunkSize
+        Pool = corpus.multiprocessing.Pool
+        try:
+            corpus.streamChunkSize = 3
+            paths = [os.path.join(testDir, "ham"), os.path.join(testDir,
+                "spam")]
+            for path, n in zip(paths, [5, 4]):
+                with open(path, "w") as f:
+                    f.writelines("%s%d\n" % (os.path.basename(path), i) for i
+                        in range(n))
+
+            items = LineCorpus(paths, ["ham.css", "spam.css"])
+            self.assertEqual(["ham0\n", "ham1\n"],
+                [item.data for item in genLineitems(paths[0], "ham.css")][:2])
+            self.assertEqual(9, len(list(items)))
+            self.assertEqual(9, len(list(items)))
+            self.assertEqual(2, len(lineitems(paths[1], "spam.css", 2)))
+
+            crm = Crm114(["ham.css", "spam.css"], crmRunner = MockCrmRunner())
+            results = classifyStream(crm, items, logger)
+            self.assertEqual(list(results.actual), [0] * 5 + [1] * 4)
+            self.assertEqual(list(results.bestMatch), list(results.actual))
+
+            # the chunks are fed to a single pool of workers
+            pools = []
+            def countingPool(*args):
+                pools.append(args)
+                return Pool(*args)
+            corpus.multiprocessing.Pool = countingPool
+            results = classifyStream(crm, items, logger, workers = 2)
+            self.assertEqual(len(pools), 1)
+            self.assertEqual(list(results.actual), [0] * 5 + [1] * 4)
+            self.assertEqual(list(results.bestMatch), list(results.actual))
+        finally:
+            corpus.streamChunkSize = streamChunkSize
+            corpus.multiprocessing.Pool = Pool
+            shutil.rmtree(testDir)
+
+    def test_normalizedLineitems(self):
+        testDir = tempfile.mkdtemp()
+        normalizeChunkSize = corpus.normalizeChunkSize
+        try:
+            path = os.path.join(testDir, "ham")
+            with open(path, "w") as f:
+                f.write("".join("Ham-%d!\n" % i for i in range(10)))
+            cacheDir = os.path.join(testDir, "cache")
+            corpus.normalizeChunkSize = 3
+
+            metrics = crm114.Metrics()
+            self.assertEqual(10, len(normalizedLineitems(path, "ham.css",
+                ["echen"], metrics = metrics)))
+            self.assertEqual(3, len(normalizedLineitems(path, "ham.css",
+                ["echen"], 3, metrics = metrics)))
+            self.assertEqual(2, metrics.dict()["phases"]["normalize"]["count"])
+            self.assertFalse(os.path.exists(cacheDir))
+
+            for workers in [None, 3, None]:
+                items = normalizedLineitems(path, "ham.css", ["echen"],
+                    cacheDir = cacheDir, workers = workers)
+                self.assertEqual([item.data for item in items],
+                    ["START ham%d\n END" % i for i in range(10)])
+                self.assertTrue(all(isinstance(item.data,
+                    normalize.NormalizedText) for item in items))
+                self.assertTrue(all(item.data.pipeline ==
+                    normalize.pipelineKey(normalize.makeNormalizeFunction(
+                    ["echen"])) for item in items))
+            self.assertEqual(1, len(os.listdir(cacheDir)))
+
+            for workers in [None, 3]:
+                items = normalizedLineitems(path, "ham.css", ["lower"], 3,
+                    cacheDir, workers)
+                self.assertEqual(3, len(items))
+                self.assertTrue(all(item.data in ["ham-%d!\n" % i for i in
+                    range(10)] for item in items))
+            self.assertEqual(1, len(os.listdir(cacheDir)))
+
+            with open(path, "a") as f:
+                f.write("Ham-10!\n")
+            self.assertEqual(11, len(normalizedLineitems(path, "ham.css",
+                ["echen"], cacheDir = cacheDir)))
+            self.assertEqual(2, len(os.listdir(cacheDir)))
+
+            # a lambda has no stable identity, so it is not cached
+            items = normalizedLineitems(path, "ham.css", [lambda s: s[:3]],
+                cacheDir = cacheDir)
+            self.assertEqual("Ham", items[0].data)
+            self.assertEqual(None, items[0].data.pipeline)
+            self.assertEqual(2, len(os.listdir(cacheDir)))
+        finally:
+            corpus.normalizeChunkSize = normalizeChunkSize
+            shutil.rmtree(testDir)
+
+    def test_MappedCorpus(self):
+        testDir = tempfile.mkdtemp()
+        try:
+            paths = [os.path.join(testDir, "ham"), os.path.join(testDir,
+                "spam")]
+            with open(paths[0], "w") as f:
+                f.write("".join("ham%d\n" % i for i in range(10)))
+            with open(paths[1], "w") as f:
+                f.write("\n".join("spam%d" % i for i in range(7)))
+            models = ["ham.css", "spam.css"]
+
+            items = mappedCorpus(paths, models)
+            expected = lineitems(paths[0], models[0]) + lineitems(paths[1],
+                models[1])
+            self.assertEqual([(item.data, item.actualModel) for item in items],
+                [(item.data, item.actualModel) for item in expected])
+            self.assertTrue(os.path.exists(paths[0] + ".idx"))
+
+            # the index is reloaded from the sidecar file
+            corpus.lineIndexes.clear()
+            self.assertEqual(list(corpus.lineIndex(paths[1])),
+                list(corpus.buildLineIndex(paths[1])))
+
+            # the index does not depend on the size of the chunks read
+            indexChunkSize = corpus.indexChunkSize
+            try:
+                corpus.indexChunkSize = 4
+                self.assertEqual(list(corpus.buildLineIndex(paths[0])),
+                    [i * 5 for i in range(11)])
+                self.assertEqual(list(corpus.buildLineIndex(paths[1])),
+                    [i * 6 for i in range(7)] + [41])
+            finally:
+                corpus.indexChunkSize = indexChunkSize
+
+            # shuffling permutes the line numbers, like shuffling a list
+            shuffled = items[:]
+            lines = range(17)
+            random.seed(5)
+            shuffle(shuffled)
+            random.seed(5)
+            random.shuffle(lines)
+            self.assertEqual(list(shuffled.lines), lines)
+
+            # pickled views keep their lines, but not the index
+            view = pickle.loads(pickle.dumps(items[3:5] + items[12:13]))
+            self.assertEqual(["ham3\n", "ham4\n", "spam2\n"],
+                [item.data for item in view])
+            self.assertEqual(["spam2\n"], [item.data for item in
+                pickle.loads(pickle.dumps(list(view[2:]), 2))])
+
+            self.assertEqual(3, len(mappedCorpus(paths, models, 3)[:3]))
+            self.assertEqual(6, len(mappedCorpus(paths, models, 3)))
+
+            # cross validation gives the same results as with a list
+            crm = Crm114(models, crmRunner = MockCrmRunner())
+            for workers in [None, 2]:
+                results = []
+                for items in [expected, mappedCorpus(paths, models)]:
+                    random.seed(3)
+                    classified = crossValidate(crm, items, 3, logger, workers)
+                    results.append([(item.data, item.classification.dict())
+                        for item in classified])
+                self.assertEqual(results[0], results[1])
+        finally:
+            corpus.mappedFiles.clear()
+            corpus.lineIndexes.clear()
+            shutil.rmtree(testDir)
+
     def test_accuracy(self):
         crm = Crm114(["ham.css", "spam.css"])
 
@@ -93,6 +321,217 @@ class TestCorpus(unittest.TestCase):
         self.assertEquals(result["spam.css"].precision, 1.0 / 2.0)
         self.assertEquals(result["spam.css"].recall, 1.0 / 3.0)
 
+    def test_crossValidate(self):
+        crm = Crm114(["ham.css", "spam.css"], crmRunner = MockCrmRunner())
+        items = [LabeledItem("ham%d" % i, "ham.css") for i in range(10)] + \
+            [LabeledItem("spam%d" % i, "spam.css") for i in range(7)]
+
+        results = []
+        for workers in [None, 3]:
+            random.seed(7)
+            classified = crossValidate(crm, items, 3, logger, workers)
+            results.append([(item.data, item.classification.dict()) for item in
+                classified])
+
+        self.assertEqual(results[0], results[1])
+        for data, classification in results[0]:
+            self.assertEqual(classification["bestMatch"]["model"],
+                data[:-1].rstrip("0123456789") + ".css")
+
+        # the classifications go straight into a ResultSet, in the same order
+        for validate in [crossValidate, mergeCrossValidate]:
+            for workers in [None, 3]:
+                random.seed(7)
+                columns = validate(crm, items, 3, logger, workers,
+                    results = ResultSet(crm.models))
+                random.seed(7)
+                expected = resultSet(crm.models, validate(crm, items, 3, logger))
+                self.assertEqual(list(columns.actual), list(expected.actual))
+                self.assertEqual(list(columns.pr[0]), list(expected.pr[0]))
+        random.seed(7)
+        columns = holdoutValidate(crm, items, 0.5, logger,
+            results = ResultSet(crm.models))
+        self.assertEqual(len(columns), 8)
+        self.assertEqual(list(columns.actual), list(columns.bestMatch))
+
+        class CopyingCrmRunner(MockCrmRunner):
+            """a runner that holds processes, so each fold copies it"""
+            closed = []
+            def copy(self):
+                return CopyingCrmRunner()
+            def close(self):
+                CopyingCrmRunner.closed.append(self)
+
+        crm.crmRunner = CopyingCrmRunner()
+        crossValidate(crm, items, 3, logger)
+        # each fold used, and closed, a runner of its own
+        self.assertEqual(3, len(set(CopyingCrmRunner.closed)))
+        self.assertFalse(crm.crmRunner in CopyingCrmRunner.closed)
+
+    def test_mergeCrossValidate(self):
+        # a runner that really learns and merges, so that the folds' models
+        # must match for the classifications to match
+        crm = Crm114(["ham.css", "spam.css"], crmRunner = osb.OsbRunner(4096))
+        items = [LabeledItem("ham message %d about lunch %d" % (i, i % 3),
+                "ham.css") for i in range(10)] + \
+            [LabeledItem("spam offer %d buy now %d" % (i, i % 2), "spam.css")
+                for i in range(7)]
+
+        for workers in [None, 2]:
+            results = []
+            for validate in [crossValidate, mergeCrossValidate]:
+                random.seed(7)
+                classified = validate(crm, items, 3, logger, workers)
+                results.append([(item.data, item.classification.dict()) for
+                    item in classified])
+            self.assertEqual(results[0], results[1])
+            self.assertTrue(any(c["model"]["ham.css"]["hits"] > 0 for data, c
+                in results[0]))
+            # each fold used, and closed, a runner of its own
+            self.assertEqual(crm.crmRunner.models, {})
+
+        crm.trainOnError = True
+        self.assertRaises(ValueError, mergeCrossValidate, crm, items, 3, logger)
+
+    def test_search(self):
+        crm = Crm114(["ham.css", "spam.css"],
+            crmRunner = MockSearchCrmRunner())
+        items = [LabeledItem("ham%d" % i, "ham.css") for i in range(40)] + \
+            [LabeledItem("spam%d" % i, "spam.css") for i in range(40)]
+        candidates = [("", None), ("osb", None), ("", ["lower"]),
+            ("winnow", ["lower"]), ("osb unique", None)]
+
+        for workers in [None, 2]:
+            random.seed(7)
+            report = search(crm, items, candidates, logger, workers,
+                sample = 20, eta = 2, holdout = 0.5)
+
+            self.assertEqual([1, 2, 3, 4, 5], [r["rank"] for r in report])
+            self.assertEqual([("osb", None), ("winnow", ["lower"]),
+                ("osb unique", None)], [(r["classifier"], r["normalize"]) for
+                r in report[:3]])
+            self.assertEqual([3, 3, 2], [r["round"] for r in report[:3]])
+            self.assertEqual([1.0, 1.0, 1.0], [r["score"] for r in report[:3]])
+            self.assertEqual([80, 80, 40, 20, 20], [r["items"] for r in report])
+            self.assertEqual(["", ""], [r["classifier"] for r in report[3:]])
+            self.assertTrue(all(r["score"] < 1.0 for r in report[3:]))
+            self.assertTrue(all(r["error"] == None for r in report))
+
+        # a failing candidate is ranked last, and the search goes on
+        candidates.insert(1, ("bogus", None))
+        random.seed(7)
+        report = search(crm, items, candidates, logger, sample = 20, eta = 2,
+            holdout = 0.5)
+        self.assertEqual([("osb", None), ("winnow", ["lower"]),
+            ("osb unique", None)], [(r["classifier"], r["normalize"]) for r in
+            report[:3]])
+        self.assertEqual([1.0, 1.0, 1.0], [r["score"] for r in report[:3]])
+        self.assertEqual(("bogus", None, 1, None), (report[-1]["classifier"],
+            report[-1]["normalize"], report[-1]["round"], report[-1]["score"]))
+        self.assertEqual("Crm114Error: unsupported classifier",
+            report[-1]["error"])
+        self.assertEqual([1, 2, 3, 4, 5, 6], [r["rank"] for r in report])
+
+    def test_mergeShards(self):
+        testDir = tempfile.mkdtemp()
+        cssmergeBinary = crm114.cssmergeBinary
+        try:
+            # a stand-in for cssmerge, which appends the source to the target
+            crm114.cssmergeBinary = os.path.join(testDir, "cssmerge")
+            with open(crm114.cssmergeBinary, "w") as f:
+                f.write("#!/bin/sh\ncat \"$2\" >> \"$1\"\n")
+            os.chmod(crm114.cssmergeBinary, 0755)
+
+            shardModels = [[os.path.join(testDir, "%d%s" % (shard, name)) for
+                name in ["ham.css", "spam.css"]] for shard in range(3)]
+            for shard, name in [(0, "ham.css"), (1, "ham.css"), (2, "ham.css"),
+                    (1, "spam.css")]:
+                with open(os.path.join(testDir, "%d%s" % (shard, name)),
+                        "w") as f:
+                    f.write("%d%s\n" % (shard, name))
+
+            models = [os.path.join(testDir, "ham.css"),
+                os.path.join(testDir, "spam.css")]
+            mergeShards(Crm114(models), shardModels)
+            self.assertEqual(open(models[0]).read(),
+                "0ham.css\n1ham.css\n2ham.css\n")
+            self.assertEqual(open(models[1]).read(), "1spam.css\n")
+        finally:
+            crm114.cssmergeBinary = cssmergeBinary
+            shutil.rmtree(testDir)
+
+    def test_learnSharded(self):
+
+        class RecordingCrmRunner:
+            """
+            writes each learned document into its model file, and merges by
+            appending the source to the target
+            """
+            def run(self, data, command):
+                if command[0] == crm114.cssmergeBinary:
+                    with open(command[1], "a") as f:
+                        f.write(open(command[2]).read())
+                    return ""
+                model = re.search(r"learn <[^>]*> \( (.*?) \)",
+                    command[-1]).group(1)
+                with open(model, "a") as f:
+                    f.write(data + "\n")
+                return ""
+
+        testDir = tempfile.mkdtemp()
+        try:
+            models = [os.path.join(testDir, "ham.css"),
+                os.path.join(testDir, "spam.css")]
+            crm = Crm114(models, crmRunner = RecordingCrmRunner())
+            items = [LabeledItem("ham%d" % i, models[0]) for i in range(5)] + \
+                [LabeledItem("spam%d" % i, models[1]) for i in range(3)]
+
+            learnSharded(crm, items, logger, 3)
+            self.assertEqual(open(models[0]).read().split(),
+                ["ham%d" % i for i in range(5)])
+            self.assertEqual(open(models[1]).read().split(),
+                ["spam%d" % i for i in range(3)])
+        finally:
+            shutil.rmtree(testDir)
+
+    def test_ResultSet(self):
+        crm = Crm114(["ham.css", "spam.css"])
+
+        def items():
+            return [LabeledItem(None, actual, mock.classification(
+                [mock.model("ham.css", pr=ham, hits=3),
+                 mock.model("spam.css", pr=-ham)]))
+                for actual, ham in [("ham.css", 30.0), ("ham.css", -5.0),
+                    ("spam.css", 12.0), ("spam.css", -40.0),
+                    ("spam.css", -1.0)]]
+
+        results = resultSet(crm.models, items())
+        self.assertEqual(len(results), 5)
+        self.assertEqual(list(results.actual), [0, 0, 1, 1, 1])
+        self.assertEqual(list(results.bestMatch), [0, 1, 0, 1, 1])
+        self.assertEqual(list(results.hits[0]), [3] * 5)
+        self.assertEqual(list(results.features[1]), [7.0] * 5)
+
+        for threshold in [None, -10.0, 0.0, 20.0]:
+            self.assertEqual(accuracy(crm, results, threshold),
+                accuracy(crm, items(), threshold))
+        self.assertEqual(minMaxPr(results), minMaxPr(items()))
+        self.assertEqual(varyThreshold(crm, results, 7),
+            varyThreshold(crm, items(), 7))
+
+        merged = resultSet(crm.models, items()[:2])
+        merged.extend(resultSet(crm.models, items()[2:]))
+        self.assertEqual(list(merged.pr[1]), list(results.pr[1]))
+        self.assertEqual(list(merged.actual), list(results.actual))
+        renamed = resultSet(["a", "b"], [])
+        renamed.rename(crm.models)
+        renamed.extend(results)
+        self.assertEqual(list(renamed.bestMatch), list(results.bestMatch))
+        self.assertRaises(ValueError, renamed.extend, resultSet(["a", "b"], []))
+
+        self.assertRaises(ValueError, accuracy, Crm114(["spam.css", "ham.css"]),
+            results, None)
+
     def test_partition(self):
 
         self.assertEqual(partition([1,2,3], 1), [[1,2,3]])
@@ -120,6 +559,45 @@ class TestCorpus(unittest.TestCase):
                 (3, [1,2,3,4, 5,6,7], [8, 9, 10])
             ])
 
+        # relabeling a view copies only the items in its ranges, on access
+        items = [LabeledItem(i, "ham.css" if i < 5 else "spam.css") for i in
+            range(10)]
+        view = ItemView(items, [(3, 7)])
+        relabeled = relabel(view, {"ham.css" : "a", "spam.css" : "b"})
+        self.assertTrue(relabeled.items is items)
+        self.assertEqual([(item.data, item.actualModel) for item in relabeled],
+            [(3, "a"), (4, "a"), (5, "b"), (6, "b")])
+        self.assertEqual(relabeled[-1].actualModel, "b")
+        twice = relabel(relabeled, {"a" : "x", "b" : "y"})
+        self.assertEqual([item.actualModel for item in twice],
+            ["x", "x", "y", "y"])
+        self.assertEqual(items[3].actualModel, "ham.css")
+
+    def test_stratify(self):
+        items = [LabeledItem(i, "spam.css" if i % 5 else "ham.css") for i in
+            range(20)]
+        stratified = stratify(items, 4)
+        self.assertEqual(sorted(stratified), sorted(items))
+
+        for fold, learn, classify in genCrossValidate(stratified, 4):
+            self.assertEqual(1, sum(1 for item in classify if
+                item.actualModel == "ham.css"))
+            self.assertEqual(len(learn), 15)
+            self.assertEqual(sorted(list(learn) + list(classify)),
+                sorted(items))
+
+        # the 3 ham items go to folds 1, 2 and 3; the 8 spam items follow
+        self.assertEqual([[0, 2, 7], [5, 3, 8], [10, 4, 9], [1, 6]],
+            [[item.data for item in part] for part in
+            partition(stratify(items[:11], 4), 4)])
+
+        crm = Crm114(["ham.css", "spam.css"], crmRunner = MockCrmRunner())
+        items = [LabeledItem("ham%d" % i, "ham.css") for i in range(3)] + \
+            [LabeledItem("spam%d" % i, "spam.css") for i in range(12)]
+        for validate in [crossValidate, mergeCrossValidate]:
+            classified = validate(crm, items, 3, logger, stratified = True)
+            self.assertEqual(sorted(classified), sorted(items))
+
     def test_minMaxPr(self):
 
         classifyItems = [
@@ -205,6 +683,43 @@ class TestCorpus(unittest.TestCase):
 
         self.assertEquals(expected, result)
 
+        # the items are left untouched
+        self.assertEquals(["ham.css", "ham.css", "spam.css", "spam.css"],
+            [item.classification.bestMatch.model for item in items])
+
+        # a ResultSet gives the same sweep
+        results = resultSet(crm.models, items)
+        self.assertEquals(expected, varyThreshold(crm, results, 4))
+
+        # every distinct threshold matches accuracy()
+        result = varyThreshold(crm, results, None)
+        self.assertEquals([-100.0, -30.0, 20.0, 100.0],
+            sorted(result["ham.css"].keys()))
+        for threshold in result["ham.css"]:
+            self.assertEquals(accuracy(crm, results, threshold),
+                dict((m, result[m][threshold]) for m in crm.models))
+
+    def test_roc(self):
+
+        crm = Crm114(["ham.css", "spam.css"])
+
+        items = [
+            LabeledItem(None, model, mock.classification(
+                [mock.model("ham.css", pr=pr),
+                 mock.model("spam.css", pr=-pr)]))
+            for model, pr in [("ham.css", 100.0), ("spam.css", 50.0),
+                ("ham.css", 20.0), ("spam.css", -30.0), ("spam.css", -30.0)]
+            ]
+
+        result = roc(crm, items)
+        self.assertEquals([100.0, 50.0, 20.0, -30.0],
+            [p["threshold"] for p in result["points"]])
+        self.assertEquals([0.5, 0.5, 1.0, 1.0],
+            [p["tpr"] for p in result["points"]])
+        self.assertEquals([0.0, 1/3.0, 1/3.0, 1.0],
+            [p["fpr"] for p in result["points"]])
+        self.assertAlmostEquals(5/6.0, result["auc"])
+
 
 if __name__ == '__main__':
     unittest.main()
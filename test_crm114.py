@@ -16,9 +16,17 @@
 #
 
 from crm114 import *
+import crm114
+import gc
+import normalize
 import json
 import mock
 import os
+import pickle
+import socket
+import stat
+import sys
+import threading
 import unittest
 
 crmResultSpamString = mock.classificationString(
@@ -30,18 +38,45 @@ class MockCrmRunner:
     def run(self, data, command):
         return crmResultSpamString
 
+class MockLoopCrmRunner(CrmRunner):
+    """answers every framed document with crmResultSpamString"""
+    def run(self, data, command):
+        assert(command[-1].startswith("-{ window;"))
+        return (crmResultSpamString + "\n" + documentDelimiter + "\n") * \
+            data.count(documentDelimiter)
+
+# a stand-in for a looping crm114 program: echoes each framed document, and
+# exits when it reads a document that says "die"
+fakeLoopCrm = """
+import os, sys
+while True:
+    doc = ""
+    while not doc.endswith("%(delimiter)s\\n"):
+        line = sys.stdin.readline()
+        if line == "":
+            sys.exit(0)
+        doc += line
+    doc = doc[:-len("%(delimiter)s\\n")]
+    if doc == "die":
+        sys.exit(1)
+    sys.stdout.write("%%d %%s\\n%(delimiter)s\\n" %% (os.getpid(), doc))
+    sys.stdout.flush()
+""" % { "delimiter" : documentDelimiter }
+
 TEST_DIR = "testdata"
 HAM_TEXT = "ham1 ham2 ham3 ham4 ham5"
 SPAM_TEXT = "fooA fooB fooC fooD fooE"
 HAM_FILENAME = os.path.join(TEST_DIR, "ham.css")
 SPAM_FILENAME = os.path.join(TEST_DIR, "spam.css")
 TUNA_FILENAME = os.path.join(TEST_DIR, "tuna.css")
+SOURCE_FILENAME = os.path.join(TEST_DIR, "source.css")
 
 def freshTestDir():
     """creates a fresh testing directory if it doesn't already exist"""
     if not os.path.exists(TEST_DIR):
         os.mkdir(TEST_DIR)
-    for filename in [HAM_FILENAME, SPAM_FILENAME, TUNA_FILENAME]:
+    for filename in [HAM_FILENAME, SPAM_FILENAME, TUNA_FILENAME,
+            SOURCE_FILENAME]:
         if os.path.exists(filename):
             os.remove(filename)
 
@@ -52,7 +87,21 @@ class TestCrm114(unittest.TestCase):
         freshTestDir()
 
     def test_normalize(self):
-        pass
+        crm = Crm114(["spam.css", "ham.css"], normalizeFunction = str.upper)
+        self.assertEqual(crm.normalizeText("Foo"), "FOO")
+        self.assertEqual(crm.normalizeText(normalize.NormalizedText("Foo")),
+            "FOO")
+
+        lower = normalize.makeNormalizeFunction(["lower"])
+        crm = Crm114(["spam.css", "ham.css"], normalizeFunction = lower)
+        self.assertEqual(crm.normalizeText(normalize.NormalizedText("Foo",
+            normalize.pipelineKey(lower))), "Foo")
+        self.assertEqual(crm.normalizeText(normalize.NormalizedText("Foo",
+            normalize.pipelineKey(normalize.makeNormalizeFunction(
+            ["echen"])))), "foo")
+        text = pickle.loads(pickle.dumps(normalize.NormalizedText("Foo",
+            normalize.pipelineKey(lower)), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(crm.normalizeText(text), "Foo")
 
     def test_Classification_class(self):
         classification = Classification(crmResultSpamString)
@@ -70,6 +119,34 @@ class TestCrm114(unittest.TestCase):
         self.assertEqual(classification.model["ham.css"].hits, 301)
         self.assertEqual(classification.model["ham.css"].features, 856)
 
+    def test_parseClassification(self):
+        string = ("CLASSIFY succeeds; success probability: 0.5  pR: -1.2e+01\n" +
+            "Best match to file #1 (dir/a (b).css) weight: 3.2 pR: -12.0\n" +
+            "Total features in input file:   17\n")
+        modelLines = [
+            "#0 (spam.css): features: 1461, hits: 16572, prob: 1.00e+00, " +
+                "pR: 129.64 ",
+            "#1 (dir/a (b).css): features: 8 (12.5%), hits: 3, prob: 0.5, " +
+                "pR: 0.00",
+            "#0 (a.css): hits: 12, ufeats: 3, prob: 1.0, pR: 3.2",
+            "#0 (a.css): features: 12.00, unseen: 3.00e+00, " +
+                "weight: 1.2e+01, pR: 2.5",
+            "#0 (a.css):  pR: +4"]
+
+        self.assertEqual(parseClassification(string + "\n".join(modelLines)),
+            (17, "dir/a (b).css", modelLines))
+        self.assertEqual([parseModelLine(line) for line in modelLines], [
+            ("spam.css", 1461.0, 16572, 1.0, 129.64),
+            ("dir/a (b).css", 8.0, 3, 0.5, 0.0),
+            ("a.css", None, 12, 1.0, 3.2),
+            ("a.css", 12.0, None, None, 2.5),
+            ("a.css", None, None, None, 4.0)])
+
+        for bad in ["", "CLASSIFY fails;", string[:80]]:
+            self.assertRaises(ValueError, parseClassification, bad)
+        for bad in ["", "#0 (a.css): features: 1", "#0 (a.css) pR: 1"]:
+            self.assertRaises(ValueError, parseModelLine, bad)
+
     def test_Crm114_classify_mock(self):
 
         classification = Classification(crmResultSpamString)
@@ -127,27 +204,544 @@ class TestCrm114(unittest.TestCase):
         classification.bestMatch = classification.model["spam.css"]
         self.assertEqual(crm.classify("foo").dict(), classification.dict())
 
-    def test_Crm114_learn_mock(self):
-        
+    def test_Crm114_classifyMany_mock(self):
         classification = Classification(crmResultSpamString)
-        crm = Crm114(["spam.css", "ham.css"], threshold = None,
-            trainOnError = False, crmRunner = MockCrmRunner())
+
+        for runner in [MockCrmRunner(), MockLoopCrmRunner()]:
+            crm = Crm114(["ham.css", "spam.css"], threshold = 0.0,
+                crmRunner = runner)
+            self.assertEqual(crm.classifyMany([]), [])
+            classifications = crm.classifyMany(iter(["foo", "bar", "baz"]))
+            self.assertEqual(len(classifications), 3)
+            for c in classifications:
+                self.assertEqual(c.bestMatch.model, "spam.css")
+                self.assertEqual(c.dict()["model"], classification.dict()["model"])
+
+    def test_BatchScheduler(self):
+        class EchoingCrmRunner(CrmRunner):
+            """
+            answers each framed document "docN" with a classification of N
+            total features, so that results can be matched to documents
+            """
+            batches = []
+            def run(self, data, command):
+                documents = data.split(documentDelimiter + "\n")[:-1]
+                EchoingCrmRunner.batches.append(len(documents))
+                if "fail" in data:
+                    raise Crm114Error("failed")
+                return "".join(mock.classificationString([
+                    mock.model("spam.css"), mock.model("ham.css")],
+                    totalFeatures = int(document[3:])) + "\n" +
+                    documentDelimiter + "\n" for document in documents)
+
+        crm = Crm114(["spam.css", "ham.css"], crmRunner = EchoingCrmRunner())
+        scheduler = BatchScheduler(crm, window = 0.5, maxBatch = 4)
+        results = {}
+        def call(i, data):
+            try:
+                results[i] = scheduler.classify(data).totalFeatures
+            except Crm114Error, e:
+                results[i] = str(e)
+        threads = [threading.Thread(target = call, args = (i, "doc%d" % i))
+            for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict((i, i) for i in range(10)))
+        self.assertEqual(sum(EchoingCrmRunner.batches), 10)
+        self.assertTrue(all(batch <= 4 for batch in EchoingCrmRunner.batches))
+
+        call(10, "fail")
+        self.assertEqual(results[10], "failed")
+        scheduler.close()
+        self.assertFalse(scheduler.thread.is_alive())
+        self.assertRaises(Crm114Error, scheduler.classify, "doc11")
+        scheduler.close()
+
+    def test_Crm114_learnMany_mock(self):
+
+        class RecordingCrmRunner(CrmRunner):
+            def __init__(self):
+                self.calls = []
+            def run(self, data, command):
+                self.calls.append((data, command[-1]))
+                return ("\n" + documentDelimiter + "\n") * \
+                    data.count(documentDelimiter)
+
+        runner = RecordingCrmRunner()
+        crm = Crm114(["spam.css", "ham.css"], normalizeFunction = str.upper,
+            crmRunner = runner)
+        learned = crm.learnMany([("a", "spam.css"), ("b", "ham.css"),
+            ("c", "spam.css")])
+        self.assertEqual(learned, [True, True, True])
+
+        # one crm114 run per model, in order of first appearance
+        self.assertEqual(len(runner.calls), 2)
+        self.assertEqual(runner.calls[0][0],
+            frameDocument("A") + frameDocument("C"))
+        self.assertTrue("( spam.css )" in runner.calls[0][1])
+        self.assertEqual(runner.calls[1][0], frameDocument("B"))
+        self.assertTrue("( ham.css )" in runner.calls[1][1])
+
+        self.assertRaises(ValueError, crm.learnMany, [("a", "tuna.css")])
+
+    def test_Crm114_learn_mock(self):
+
+        output = mock.classificationString(
+            [mock.model(SPAM_FILENAME, pr=10.0),
+             mock.model(HAM_FILENAME, pr=-10.0)])
+
+        class TrainOnErrorCrmRunner:
+            """best match is always spam"""
+            def run(self, data, command):
+                if "alius" in command[-1]:
+                    learn = "( %s )" % SPAM_FILENAME not in command[-1]
+                    return output + "\n%s\n" % (learnedMarker if
+                        learn else notLearnedMarker)
+                return output
+
+        freshTestDir()
+        crm = Crm114([SPAM_FILENAME, HAM_FILENAME], threshold = None,
+            trainOnError = False, crmRunner = TrainOnErrorCrmRunner())
 
         # trainOnError == False
-        self.assertEqual(crm.learn("foo", "spam.css"), True)
-        self.assertEqual(crm.learn("foo", "ham.css"), True)
+        self.assertEqual(crm.learn("foo", SPAM_FILENAME), True)
+        self.assertEqual(crm.learn("foo", HAM_FILENAME), True)
 
+        # the models do not exist yet, so there is nothing to classify with
         crm.trainOnError = True
-        self.assertEqual(crm.learn("foo", "spam.css"), False)
-        self.assertEqual(crm.learn("foo", "ham.css"), True)
+        self.assertEqual(crm.learn("foo", SPAM_FILENAME), True)
+
+        for filename in [SPAM_FILENAME, HAM_FILENAME, TUNA_FILENAME]:
+            open(filename, "w").close()
+        self.assertEqual(crm.learn("foo", SPAM_FILENAME), False)
+        self.assertEqual(crm.learn("foo", HAM_FILENAME), True)
 
         # 3 models; crm.trainOnError == True
-        crm = Crm114(["spam.css", "ham.css", "foo.css"], threshold = None,
-            trainOnError = True, crmRunner = MockCrmRunner())
-        self.assertEqual(crm.learn("foo", "spam.css"), False)
-        self.assertEqual(crm.learn("foo", "ham.css"), True)
-        self.assertEqual(crm.learn("foo", "foo.css"), True)
+        crm = Crm114([SPAM_FILENAME, HAM_FILENAME, TUNA_FILENAME],
+            threshold = None, trainOnError = True,
+            crmRunner = TrainOnErrorCrmRunner())
+        self.assertEqual(crm.learn("foo", SPAM_FILENAME), False)
+        self.assertEqual(crm.learn("foo", HAM_FILENAME), True)
+        self.assertEqual(crm.learn("foo", TUNA_FILENAME), True)
+        freshTestDir()
 
+    def test_classifierConfigurations(self):
+        self.assertEqual(["osb", "osb unigram", "osb unique",
+            "osb unigram unique", "correlate", "correlate unique"],
+            crm114.classifierConfigurations(["osb", "correlate"],
+                ["unigram", "unique"]))
+        self.assertEqual(3 * 8 + 4 * 4,
+            len(crm114.classifierConfigurations()))
+
+    def test_loopProgram(self):
+        program = loopProgram("-{ learn <osb> ( a.css ) }")
+        self.assertTrue(program.startswith("-{ window;"))
+        self.assertTrue("learn <osb> ( a.css );" in program)
+        self.assertRaises(ValueError, loopProgram, "learn")
+
+        self.assertEqual(frameDocument("foo"), "foo" + documentDelimiter + "\n")
+        self.assertRaises(ValueError, frameDocument, documentDelimiter)
+        self.assertEqual(splitOutput("a\n\n%s\nb\n%s\n" %
+            (documentDelimiter, documentDelimiter)), ["a\n", "b"])
+        self.assertRaises(Crm114Error, splitOutput, "a")
+
+    def test_PersistentCrmRunner(self):
+        runner = PersistentCrmRunner()
+        command = [sys.executable, "-c", fakeLoopCrm, "-{ }"]
+
+        pid, data = runner.run("foo", command).split(" ", 1)
+        self.assertEqual(data, "foo")
+        pid2, data = runner.run("bar\nbaz\n", command).split(" ", 1)
+        self.assertEqual(data, "bar\nbaz\n")
+        self.assertEqual(pid, pid2)
+
+        # the process is restarted after it dies
+        self.assertRaises(Crm114Error, runner.run, "die", command)
+        pid3, data = runner.run("foo", command).split(" ", 1)
+        self.assertEqual(data, "foo")
+        self.assertNotEqual(pid, pid3)
+
+        # other commands, e.g. cssmerge, stop every process and run once
+        self.assertEqual(runner.run("abc", ["cat"]), "abc")
+        self.assertEqual(runner.processes, {})
+        pid4, data = runner.run("foo", command).split(" ", 1)
+        self.assertNotEqual(pid3, pid4)
+
+        runner.close()
+        self.assertEqual(runner.processes, {})
+
+    def test_AsyncCrmRunner(self):
+        runner = AsyncCrmRunner(maxInFlight = 4)
+        echo = [sys.executable, "-c",
+            "import sys; sys.stdout.write(sys.stdin.read()[::-1])"]
+
+        data = ["%d" % i * (i * 1000) for i in range(20)]
+        pendings = [runner.submit(d, echo) for d in data]
+        self.assertEqual(runner.running, 4)
+        self.assertEqual([p.result() for p in pendings],
+            [d[::-1] for d in data])
+        self.assertEqual(runner.running, 0)
+        self.assertEqual(runner.run("foo", echo), "oof")
+
+        fail = [sys.executable, "-c", "import sys; sys.exit(1)"]
+        self.assertRaises(Crm114Error, runner.run, "foo", fail)
+        pending = runner.submit("foo", fail).then(len)
+        self.assertRaises(Crm114Error, pending.result)
+        self.assertEqual(runner.submit("foo", echo).then(len).result(), 3)
+
+    def test_Crm114_aclassify(self):
+        freshTestDir()
+        fakeCrm = os.path.join(TEST_DIR, "fakecrm")
+        with open(fakeCrm, "w") as f:
+            f.write("#!/bin/sh\ncat > /dev/null\nprintf '%s' '" +
+                crmResultSpamString + "'\n")
+        os.chmod(fakeCrm, 0755)
+
+        crmBinary = crm114.crmBinary
+        try:
+            crm114.crmBinary = fakeCrm
+            crm = Crm114(["spam.css", "ham.css"],
+                crmRunner = AsyncCrmRunner())
+            pendings = [crm.aclassify("foo") for i in range(10)]
+            for pending in pendings:
+                self.assertEqual(pending.result().dict(),
+                    Classification(crmResultSpamString).dict())
+            self.assertEqual(crm.alearn("foo", "ham.css").result(), True)
+            self.assertRaises(ValueError, Crm114(["spam.css", "ham.css"])
+                .aclassify, "foo")
+        finally:
+            crm114.crmBinary = crmBinary
+            os.remove(fakeCrm)
+
+    def test_benchFakeCrm(self):
+        freshTestDir()
+        fakeCrm = os.path.join(TEST_DIR, "fakecrm")
+        with open(fakeCrm, "w") as f:
+            f.write("#!/bin/sh\nexec '%s' bench/fakecrm.py \"$@\"\n" %
+                sys.executable)
+        os.chmod(fakeCrm, 0755)
+
+        crmBinary = crm114.crmBinary
+        try:
+            crm114.crmBinary = fakeCrm
+            crm = Crm114([SPAM_FILENAME, HAM_FILENAME], trainOnError = True)
+            classifications = crm.classifyMany(["foo", "bar"])
+            self.assertEqual([sorted(c.model.keys()) for c in classifications],
+                [sorted(crm.models)] * 2)
+            self.assertEqual(crm.classify("bar").dict(),
+                classifications[1].dict())
+
+            self.assertEqual(crm.learnOnError("foo", SPAM_FILENAME),
+                (True, None))
+            self.assertEqual(crm.learnMany([("foo", HAM_FILENAME)]), [True])
+            learned, classification = crm.learnOnError("foo", HAM_FILENAME)
+            self.assertEqual(learned, False)
+            self.assertEqual(classification.dict(), classifications[0].dict())
+        finally:
+            crm114.crmBinary = crmBinary
+            os.remove(fakeCrm)
+            freshTestDir()
+
+    def test_Metrics(self):
+        metrics = Metrics()
+        for seconds in [0.0002, 0.0002, 0.003, 2.0]:
+            metrics.observe("wait", seconds)
+        with metrics.timer("parse"):
+            pass
+        metrics.count("bytesIn", 10)
+
+        self.assertEqual(metrics.quantile("wait", 0.5), 0.00025)
+        self.assertEqual(metrics.quantile("wait", 0.99), 2.5)
+        summary = metrics.dict()
+        self.assertEqual(summary["phases"]["wait"]["count"], 4)
+        self.assertEqual(summary["counters"], {"bytesIn" : 10})
+
+        merged = Metrics()
+        merged.merge(summary)
+        merged.merge(summary)
+        self.assertEqual(merged.dict()["phases"]["wait"]["histogram"],
+            [[0.00025, 4], [0.005, 2], [2.5, 2]])
+        self.assertEqual(merged.dict()["counters"], {"bytesIn" : 20})
+
+        text = metrics.prometheus()
+        self.assertTrue('crmpy_phase_seconds_bucket{phase="wait",le="0.001"} 2'
+            in text)
+        self.assertTrue('crmpy_phase_seconds_bucket{phase="wait",le="+Inf"} 4'
+            in text)
+        self.assertTrue('crmpy_phase_seconds_count{phase="parse"} 1' in text)
+        self.assertTrue("crmpy_bytesIn_total 10" in text)
+        self.assertTrue(metrics.report().startswith("phase"))
+
+        metrics.reset()
+        runner = CrmRunner(metrics)
+        self.assertEqual(runner.run("abc", ["cat"]), "abc")
+        self.assertRaises(Crm114Error, runner.run, "", ["sh", "-c",
+            "echo oops >&2"])
+        summary = metrics.dict()
+        self.assertEqual(sorted(summary["phases"].keys()), ["spawn", "wait",
+            "write"])
+        self.assertEqual(summary["counters"], {"runs" : 2, "bytesIn" : 3,
+            "bytesOut" : 3})
+
+        crm = Crm114(["spam.css", "ham.css"], normalizeFunction = str.upper,
+            crmRunner = MockCrmRunner(), metrics = metrics)
+        crm.classify("foo")
+        self.assertEqual(metrics.dict()["phases"]["normalize"]["count"], 1)
+        self.assertEqual(metrics.dict()["phases"]["parse"]["count"], 1)
+        self.assertTrue(crm.copy(crm.models).metrics is metrics)
+
+        for runner in [PersistentCrmRunner(), AsyncCrmRunner()]:
+            metrics = Metrics()
+            crm = Crm114(["spam.css", "ham.css"], crmRunner = runner,
+                metrics = metrics)
+            self.assertTrue(runner.metrics is metrics)
+            self.assertEqual(runner.run("abc", ["cat"]), "abc")
+            summary = metrics.dict()
+            self.assertEqual(sorted(summary["phases"].keys()), ["spawn",
+                "wait", "write"])
+            self.assertEqual(summary["counters"], {"runs" : 1, "bytesIn" : 3,
+                "bytesOut" : 3})
+
+        runner = CrmRunner(Metrics())
+        Crm114(["spam.css", "ham.css"], crmRunner = runner, metrics = metrics)
+        self.assertFalse(runner.metrics is metrics)
+
+    def test_Crm114Server(self):
+        class ClosingCrmRunner(MockCrmRunner):
+            closed = 0
+            def close(self):
+                ClosingCrmRunner.closed += 1
+
+        class FailingCrmRunner(ClosingCrmRunner):
+            def run(self, data, command):
+                if data == "fail":
+                    raise IOError("disk on fire")
+                return ClosingCrmRunner.run(self, data, command)
+
+        freshTestDir()
+        path = os.path.join(TEST_DIR, "crm.sock")
+
+        # a stale socket, which nothing listens on, is replaced
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        notSocket = os.path.join(TEST_DIR, "file")
+        with open(notSocket, "w") as f:
+            f.write("not a socket")
+        try:
+            self.assertRaises(Crm114Error, Crm114Server, notSocket, None)
+        finally:
+            os.remove(notSocket)
+
+        crm = Crm114(["spam.css", "ham.css"], crmRunner = MockCrmRunner())
+        server = Crm114Server(path, crm, 3, FailingCrmRunner)
+        thread = threading.Thread(target = server.serve_forever)
+        thread.start()
+        try:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0600)
+            self.assertRaises(Crm114Error, Crm114Server, path, crm)
+            client = Crm114Client(path)
+            self.assertRaises(Crm114Error, client.classify, "fail")
+            expected = Classification(crmResultSpamString).dict()
+            self.assertEqual(client.classify("foo"), expected)
+            self.assertEqual(client.classify(u"caf\xe9"), expected)
+            self.assertTrue(client.learn("foo", "ham.css"))
+            self.assertEqual(ClosingCrmRunner.closed, 2)
+            self.assertRaises(Crm114Error, client.request, {"op" : "forget",
+                "data" : "foo"})
+            self.assertRaises(Crm114Error, client.request, {"op" : "learn",
+                "data" : "foo"})
+            self.assertEqual(client.classify("foo"), expected)
+            client.close()
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(ClosingCrmRunner.closed, 5)
+
+    def test_ModelStore(self):
+        freshTestDir()
+        with open(SPAM_FILENAME, "w") as f:
+            f.write("spam")
+        os.chmod(SPAM_FILENAME, 0644)
+
+        class LearningCrmRunner(MockCrmRunner):
+            def run(self, data, command):
+                self.command = command
+                return MockCrmRunner.run(self, data, command)
+
+        crm = Crm114([SPAM_FILENAME, HAM_FILENAME],
+            crmRunner = LearningCrmRunner())
+        store = ModelStore(crm, directory = TEST_DIR)
+        staged = store.path(SPAM_FILENAME)
+        self.assertEqual(crm.models, [staged, store.path(HAM_FILENAME)])
+        self.assertTrue(staged in crm.classifyCommand[-1])
+        self.assertEqual(open(staged).read(), "spam")
+        self.assertFalse(os.path.exists(store.path(HAM_FILENAME)))
+        self.assertTrue(store in crm114.openModelStores)
+
+        # learning accepts the durable filename
+        self.assertTrue(crm.learn("foo", SPAM_FILENAME))
+        self.assertTrue(staged in crm.crmRunner.command[-1])
+        self.assertEqual(crm.learnMany([("foo", HAM_FILENAME)]), [True])
+        self.assertTrue(store.path(HAM_FILENAME) in crm.crmRunner.command[-1])
+
+        with open(staged, "w") as f:
+            f.write("learned spam")
+        with open(store.path(HAM_FILENAME), "w") as f:
+            f.write("learned ham")
+        store.sync()
+        self.assertEqual(open(SPAM_FILENAME).read(), "learned spam")
+        self.assertEqual(open(HAM_FILENAME).read(), "learned ham")
+        self.assertEqual(os.stat(SPAM_FILENAME).st_mode & 0777, 0644)
+
+        with open(staged, "w") as f:
+            f.write("more spam")
+        store.close()
+        self.assertEqual(open(SPAM_FILENAME).read(), "more spam")
+        self.assertEqual(crm.models, [SPAM_FILENAME, HAM_FILENAME])
+        self.assertFalse(os.path.exists(store.directory))
+        self.assertRaises(ValueError, store.sync)
+        self.assertFalse(store in crm114.openModelStores)
+        self.assertRaises(ValueError, crm.learn, "foo", staged)
+        store.close()
+
+        # an unreferenced store still writes back at exit
+        class AppendingCrmRunner(MockCrmRunner):
+            def run(self, data, command):
+                with open(crm.models[0], "a") as f:
+                    f.write(" " + data)
+                return MockCrmRunner.run(self, data, command)
+
+        crm.crmRunner = AppendingCrmRunner()
+        ModelStore(crm, directory = TEST_DIR)
+        gc.collect()
+        self.assertNotEqual(crm.models, [SPAM_FILENAME, HAM_FILENAME])
+        self.assertTrue(crm.learn("foo", SPAM_FILENAME))
+        self.assertEqual(open(SPAM_FILENAME).read(), "more spam")
+        crm114.closeModelStores()
+        self.assertEqual(open(SPAM_FILENAME).read(), "more spam foo")
+        self.assertEqual(crm.models, [SPAM_FILENAME, HAM_FILENAME])
+        self.assertEqual(crm114.openModelStores, set())
+        freshTestDir()
+
+    def test_ClassificationCache(self):
+
+        class CountingCrmRunner(MockLoopCrmRunner):
+            def __init__(self):
+                self.documents = 0
+            def run(self, data, command):
+                if command[-1].startswith("-{ window;"):
+                    self.documents += data.count(documentDelimiter)
+                    return MockLoopCrmRunner.run(self, data, command)
+                self.documents += 1
+                return crmResultSpamString
+
+        runner = CountingCrmRunner()
+        cache = ClassificationCache(maxEntries = 2)
+        crm = Crm114(["spam.css", "ham.css"], normalizeFunction = str.lower,
+            crmRunner = runner, cache = cache)
+
+        classification = Classification(crmResultSpamString).dict()
+        self.assertEqual(crm.classify("foo").dict(), classification)
+        self.assertEqual(crm.classify("FOO").dict(), classification)
+        self.assertEqual((cache.hits, cache.misses, runner.documents), (1, 1, 1))
+
+        # batches only run the misses, and each distinct miss once
+        self.assertEqual(len(crm.classifyMany(["foo", "bar", "bar"])), 3)
+        self.assertEqual((cache.hits, cache.misses, runner.documents), (2, 3, 2))
+
+        # the least recently used entry is evicted
+        crm.classify("baz")
+        self.assertEqual(len(cache.entries), 2)
+        crm.classify("foo")
+        self.assertEqual((cache.hits, cache.misses), (2, 5))
+
+        # learning invalidates
+        crm.learn("foo", "ham.css")
+        crm.classify("foo")
+        self.assertEqual((cache.hits, cache.misses), (2, 6))
+
+        # a different model set does not share entries
+        other = Crm114(["spam.css", "tuna.css"], crmRunner = runner,
+            cache = cache)
+        other.classify("foo")
+        self.assertEqual((cache.hits, cache.misses), (2, 7))
+
+        # merging invalidates
+        freshTestDir()
+        source = SOURCE_FILENAME
+        with open(source, "w") as f:
+            f.write("ham")
+        merged = Crm114([SPAM_FILENAME, HAM_FILENAME], crmRunner = runner,
+            cache = cache)
+        merged.classify("foo")
+        merged.classify("foo")
+        self.assertEqual((cache.hits, cache.misses), (3, 8))
+        merged.merge(HAM_FILENAME, [source])
+        self.assertEqual(open(HAM_FILENAME).read(), "ham")
+        merged.classify("foo")
+        self.assertEqual((cache.hits, cache.misses), (3, 9))
+        freshTestDir()
+
+        cache = ClassificationCache(maxBytes = len(crmResultSpamString) * 2)
+        crm.cache = cache
+        crm.classifyMany(["a", "b", "c"])
+        self.assertEqual(cache.stats(), { "hits" : 0, "misses" : 3,
+            "entries" : 2, "bytes" : len(crmResultSpamString) * 2 })
+
+    def test_Crm114_learnOnError_mock(self):
+
+        output = mock.classificationString(
+            [mock.model(SPAM_FILENAME, pr=10.0),
+             mock.model(HAM_FILENAME, pr=-10.0)])
+
+        class LearnOnErrorCrmRunner:
+            """best match is always spam; records the programs it runs"""
+            def __init__(self):
+                self.programs = []
+            def run(self, data, command):
+                program = command[-1]
+                self.programs.append(program)
+                if "alius" in program:
+                    learn = "( %s )" % SPAM_FILENAME not in program
+                    return output + "\n%s\n" % (learnedMarker if
+                        learn else notLearnedMarker)
+                elif "classify" in program:
+                    return output
+                return ""
+
+        freshTestDir()
+        runner = LearnOnErrorCrmRunner()
+        crm = Crm114([SPAM_FILENAME, HAM_FILENAME], trainOnError = True,
+            crmRunner = runner)
+
+        # models do not exist yet, so always learn
+        self.assertEqual(crm.learnOnError("foo", SPAM_FILENAME), (True, None))
+
+        for filename in [SPAM_FILENAME, HAM_FILENAME]:
+            open(filename, "w").close()
+        runner.programs = []
+
+        learned, classification = crm.learnOnError("foo", SPAM_FILENAME)
+        self.assertEqual(learned, False)
+        self.assertEqual(classification.bestMatch.model, SPAM_FILENAME)
+        self.assertEqual(crm.learn("foo", HAM_FILENAME), True)
+        # one crm114 process per call
+        self.assertEqual(len(runner.programs), 2)
+        self.assertTrue(all("alius" in p for p in runner.programs))
+
+        # with a threshold, classify, then learn only on error
+        runner.programs = []
+        crm.threshold = 0.0
+        self.assertEqual(crm.learn("foo", HAM_FILENAME), True)
+        self.assertEqual(len(runner.programs), 2)
+        self.assertEqual(crm.learn("foo", SPAM_FILENAME), False)
+        self.assertEqual(len(runner.programs), 3)
+        freshTestDir()
 
     def test_Crm114_correctly_parse(self):
         """make sure the Crm114 class can parse output for each classifier"""
@@ -16,7 +16,9 @@
 #
 
 from normalize import *
+import normalize
 
+import string
 import unittest
 
 class TestPreprocess(unittest.TestCase):
@@ -42,6 +44,64 @@ class TestPreprocess(unittest.TestCase):
         self.assertRaises(ValueError, makeNormalizeFunction, [None])
         self.assertRaises(ValueError, makeNormalizeFunction, ["nonexistant"])
 
+    def test_compileNormalizeFunction(self):
+        def reverse(string):
+            return string[::-1]
+
+        pipelines = [[], [identity], [lower], [rmPunctuation, lower],
+            [startEnd, lower], [lower, startEnd, rmPunctuation, startEnd],
+            [echen], [echen, echen], [lower, reverse, startEnd],
+            [reverse, echen, reverse]]
+        strings = ["", "Foo-BaR!", "START foo END", string.printable,
+            "\xc9t\xc9 \x00 'Quoted,' (said) [HE]\n"]
+
+        for functions in pipelines:
+            f = compileNormalizeFunction(functions)
+            self.assertTrue(f is compileNormalizeFunction(list(functions)))
+            for s in strings:
+                expected = reduce(lambda s, f: f(s), functions, s)
+                self.assertEqual(f(s), expected)
+                self.assertEqual(f(unicode(s, "latin-1")),
+                    reduce(lambda s, f: f(s), functions, unicode(s, "latin-1")))
+
+        self.assertTrue(compileNormalizeFunction([identity]) is identity)
+        self.assertTrue(makeNormalizeFunction(["lower"]) is
+            makeNormalizeFunction([lower]))
+        self.assertEqual(makeNormalizeFunction(["echen"])("Foo-BaR"),
+            "START foobar END")
+
+        self.assertEqual(pipelineKey(makeNormalizeFunction(None)), ())
+        self.assertEqual(pipelineKey(makeNormalizeFunction(["identity"])), ())
+        self.assertEqual(pipelineKey(makeNormalizeFunction(["echen"])),
+            (functionKey(echen),))
+        self.assertEqual(pipelineKey(compileNormalizeFunction([lower, identity,
+            startEnd])), (functionKey(lower), functionKey(startEnd)))
+        self.assertEqual(pipelineKey(str.upper), None)
+
+    def test_functionKey(self):
+        def lower(s):
+            return s.upper()
+        def upper(s):
+            return s.upper()
+        def suffix(s):
+            return s + "a"
+        a = suffix
+        def suffix(s):
+            return s + "b"
+
+        self.assertEqual(functionKey(echen)[:2], ("normalize", "echen"))
+        self.assertEqual(functionKey(echen), functionKey(echen))
+        self.assertNotEqual(functionKey(lower), functionKey(normalize.lower))
+        self.assertNotEqual(functionKey(lower), functionKey(upper))
+        self.assertNotEqual(functionKey(a), functionKey(suffix))
+
+        # no stable identity
+        self.assertEqual(functionKey(lambda s: s), None)
+        self.assertEqual(functionKey(str.upper), None)
+        self.assertEqual(functionKey(chain([lower])), None)
+        self.assertEqual(pipelineKey(compileNormalizeFunction([normalize.lower,
+            lambda s: s])), None)
+
     def test_echen(self):
         self.assertEqual(echen("foo"), "START foo END")
         self.assertEqual(echen("Foo!"), "START foo END")
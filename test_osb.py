@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# Copyright 2012 Michael N. Gagnon
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+from crm114 import *
+import osb
+
+import os
+import shutil
+import tempfile
+import unittest
+
+HAM = ["the meeting is at noon on monday in the usual room",
+    "lunch with the team on friday at the usual place",
+    "please review the notes from the meeting on monday"]
+SPAM = ["buy cheap watches now with free shipping today",
+    "you have won a free prize claim now before midnight",
+    "cheap pills free shipping buy now limited offer"]
+
+class TestOsb(unittest.TestCase):
+
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        self.models = [os.path.join(self.testDir, "ham.css"),
+            os.path.join(self.testDir, "spam.css")]
+        self.runner = osb.OsbRunner(buckets = 1 << 12)
+        self.crm = Crm114(self.models, crmRunner = self.runner)
+
+    def tearDown(self):
+        self.runner.close()
+        shutil.rmtree(self.testDir)
+
+    def learn(self):
+        self.crm.learnMany([(text, self.models[0]) for text in HAM] +
+            [(text, self.models[1]) for text in SPAM])
+
+    def test_features(self):
+        self.assertEqual(osb.features("a"), [])
+        self.assertEqual(len(osb.features("a b c d e f", unique = False)),
+            1 + 2 + 3 + 4 + 4)
+        self.assertEqual(len(osb.features("a a a", unique = False,
+            unigram = True)), 3)
+        self.assertEqual(len(osb.features("a a a", unigram = True)), 1)
+
+    def test_classify(self):
+        self.assertRaises(Crm114Error, self.crm.classify, "foo")
+        self.learn()
+
+        ham = self.crm.classify("see the notes from the meeting at noon")
+        self.assertEqual(ham.bestMatch.model, self.models[0])
+        self.assertTrue(ham.model[self.models[0]].pr > 0)
+        self.assertTrue(ham.model[self.models[1]].pr < 0)
+        self.assertAlmostEqual(1.0, sum(m.prob for m in ham.model.values()),
+            places = 1)
+
+        spam = self.crm.classify("free shipping buy now")
+        self.assertEqual(spam.bestMatch.model, self.models[1])
+
+        documents = ["free shipping buy now", "the meeting on monday"]
+        self.assertEqual([c.dict() for c in self.crm.classifyMany(documents)],
+            [self.crm.classify(d).dict() for d in documents])
+
+        # other runners see what one runner learns
+        crm = Crm114(self.models, crmRunner = osb.OsbRunner())
+        self.assertEqual(crm.classify("the meeting").dict(),
+            self.crm.classify("the meeting").dict())
+        self.crm.learn("the meeting", self.models[1])
+        self.assertEqual(crm.classify("the meeting").dict(),
+            self.crm.classify("the meeting").dict())
+
+        self.assertRaises(Crm114Error, Crm114(self.models, "winnow",
+            crmRunner = self.runner).classify, "foo")
+
+    def test_learnOnError(self):
+        self.crm.trainOnError = True
+        self.assertEqual(self.crm.learnOnError(HAM[0], self.models[0]),
+            (True, None))
+        self.assertEqual(self.crm.learnOnError(SPAM[0], self.models[1]),
+            (True, None))
+
+        learned, classification = self.crm.learnOnError(HAM[1], self.models[0])
+        self.assertEqual(learned, classification.bestMatch.model !=
+            self.models[0])
+        learned, classification = self.crm.learnOnError(HAM[0], self.models[0])
+        self.assertEqual(learned, False)
+        self.assertEqual(classification.bestMatch.model, self.models[0])
+
+    def test_mergeModels(self):
+        self.learn()
+        before = self.crm.classify("the meeting").dict()
+
+        target = os.path.join(self.testDir, "merged.css")
+        mergeModels(target, [self.models[0], self.models[0]], self.runner)
+        merged = self.runner.model(target)
+        model = self.runner.model(self.models[0])
+        self.assertEqual(merged.documents, 2 * len(HAM))
+        self.assertEqual(list(merged.counts), [2 * c for c in model.counts])
+
+        self.assertEqual(self.crm.classify("the meeting").dict(), before)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        crm = Crm114(self.models, crmRunner = self.runner, metrics = metrics)
+        self.assertTrue(self.runner.metrics is metrics)
+        self.assertTrue(self.runner.copy().metrics is metrics)
+        self.learn()
+        crm.classify("the meeting")
+        summary = metrics.dict()
+        self.assertEqual(summary["phases"]["learn"]["count"],
+            len(HAM) + len(SPAM))
+        self.assertEqual(summary["phases"]["classify"]["count"], 1)
+        self.assertEqual(summary["counters"]["runs"], len(HAM) + len(SPAM) + 1)
+
+if __name__ == '__main__':
+    unittest.main()